@@ -30,6 +30,10 @@ setup(
         'urllib3>=2.0.2',
         'xarray>=0.19'
     ],
+    extras_require={
+        'parquet': ['pyarrow>=7.0.0'],
+        'zarr': ['zarr>=2.10.0']
+    },
     author='WRF-Hydro Team',
     author_email='@ucar.edu',
     description='API for the WRF-Hydro model',
@@ -2,7 +2,8 @@ from .core import ioutils
 from .core import namelist
 from .core import outputdiffs
 from .core import schedulers
-from .core.collection import open_whp_dataset
+from .core.collection import \
+    CollectionCache, CollectionSession, iter_whp_dataset, open_whp_dataset
 from .core.cycle import *
 # from .core.cycle import CycleSimulation
 from .core.domain import *
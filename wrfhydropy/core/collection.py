@@ -1,12 +1,30 @@
 import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import dask
 import dask.bag
 from datetime import datetime
+import fnmatch
+import functools
+import gc
+import hashlib
 import itertools
 from multiprocessing.pool import Pool
 import numpy as np
+import os
+import pandas as pd
 import pathlib
-from wrfhydropy.core.ioutils import timesince
+import pickle
+import re
+import threading
+from typing import Union
+import uuid
+import warnings
+import weakref
+from wrfhydropy.core.ioutils import \
+    calc_valid_time, CollectionProfile, feature_id_index, file_fingerprint, peak_rss, \
+    process_rss, profile_span, read_wh_file_times, select_feature_index, session_compute, \
+    session_compute_kwargs, span_elapsed, span_start
 import xarray as xr
 
 
@@ -46,125 +64,1260 @@ def merge_time(ds_list: list) -> xr.Dataset:
     return xr.concat(ds_list, dim='time', coords='minimal')
 
 
+# Timestamps in the wrf-hydro output file names and their formats.
+whp_filename_time_formats = [
+    (re.compile(r'^(\d{12})\.'), '%Y%m%d%H%M'),
+    (re.compile(r'^(\d{10})\.'), '%Y%m%d%H'),
+    (re.compile(r'^RESTART\.(\d{10})_'), '%Y%m%d%H'),
+    (re.compile(r'^HYDRO_RST\.(\d{4}-\d{2}-\d{2}_\d{2}[:_]\d{2})'), '%Y-%m-%d_%H:%M'),
+    (re.compile(r'^nudgingLastObs\.(\d{4}-\d{2}-\d{2}_\d{2}[:_]\d{2}[:_]\d{2})'),
+     '%Y-%m-%d_%H:%M:%S'),
+]
+
+
+def whp_filename_time(name: str) -> datetime:
+    """Parse the time from a wrf-hydro output file name, None if it can not be parsed."""
+    for regex, fmt in whp_filename_time_formats:
+        match = regex.match(name)
+        if match:
+            stamp = match.group(1)
+            # Some systems replace the colons with underscores.
+            stamp = stamp[:11] + stamp[11:].replace('_', ':')
+            return datetime.strptime(stamp, fmt)
+    return None
+
+
+def whp_dir_info(dir_path: pathlib.Path) -> dict:
+    """Identify the ensemble member and cycle cast of a directory of wrf-hydro output from the
+    wrfhydropy member_mmm and cast_YYYYMMDDHH directory naming conventions.
+    Args:
+        dir_path: The directory containing the output files.
+    Returns:
+        A dict with 'member' (int or None) and 'cast_dir' (pathlib.Path or None).
+    """
+    dir_path = pathlib.Path(dir_path)
+    info = {'member': None, 'cast_dir': None}
+
+    # Assumption is that parent dir is member_mmm
+    if 'member' in dir_path.name:
+        # This is a double check that this convention is because of wrf_hydro_py
+        assert dir_path.parent.joinpath('WrfHydroEns.pkl').exists()
+        info['member'] = int(dir_path.name.split('_')[-1])
+
+    # Assumption is that parent (cycle) or grandparent (ensemble cycle) dir is cast_yymmddHH
+    if 'cast_' in dir_path.name:
+        info['cast_dir'] = dir_path
+    elif 'cast_' in dir_path.parent.name:
+        info['cast_dir'] = dir_path.parent
+
+    return info
+
+
+def cast_reference_time(cast_dir: pathlib.Path) -> datetime:
+    """The reference time of a cycle cast from its cast_YYYYMMDDHH directory name."""
+    # This is a double check that this convention is because of wrf_hydro_py
+    assert cast_dir.parent.joinpath('WrfHydroCycle.pkl').exists()
+    return datetime.strptime(cast_dir.name, 'cast_%Y%m%d%H')
+
+
+def walk_files(root, file_glob: str = '*') -> list:
+    """The sorted paths of the files under root matching file_glob, from one scandir walk
+    of the tree. Symlinked directories are followed."""
+    file_list = []
+    dir_stack = [str(root)]
+    while len(dir_stack):
+        with os.scandir(dir_stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dir_stack.append(entry.path)
+                elif fnmatch.fnmatchcase(entry.name, file_glob) and entry.is_file():
+                    file_list.append(pathlib.Path(entry.path))
+    return sorted(file_list)
+
+
+def scan_whp_files(
+    paths,
+    file_glob: str = '*'
+) -> list:
+    """Build the file information records of scan_whp_manifest, see that function. The
+    records are plain dicts which can be passed to preprocess_whp_data as file_info."""
+
+    if isinstance(paths, (str, pathlib.Path)):
+        file_list = walk_files(paths, file_glob)
+        dir_files = None
+    else:
+        # List each parent directory once instead of checking each file exists.
+        file_list = [pathlib.Path(pp) for pp in paths]
+        dir_files = {}
+        for dir_path in set(pp.parent for pp in file_list):
+            try:
+                with os.scandir(str(dir_path)) as entries:
+                    dir_files[dir_path] = set(ee.name for ee in entries if ee.is_file())
+            except OSError:
+                dir_files[dir_path] = set()
+
+    # The member and cast of a directory (and their sentinel file checks) are done once.
+    dir_infos = {}
+    cast_times = {}
+    records = []
+    for path in file_list:
+        if dir_files is not None and path.name not in dir_files[path.parent]:
+            continue
+        if path.parent not in dir_infos:
+            dir_infos[path.parent] = whp_dir_info(path.parent)
+        info = dir_infos[path.parent]
+        cast_dir = info['cast_dir']
+        if cast_dir is not None and cast_dir not in cast_times:
+            cast_times[cast_dir] = cast_reference_time(cast_dir)
+        reference_time = cast_times[cast_dir] if cast_dir is not None else None
+        time = whp_filename_time(path.name)
+        if reference_time is not None and time is not None:
+            lead_time = time - reference_time
+        else:
+            lead_time = None
+        records.append({
+            'path': path,
+            'member': info['member'],
+            'cast_dir': cast_dir,
+            'reference_time': reference_time,
+            'time': time,
+            'lead_time': lead_time
+        })
+
+    return records
+
+
+def scan_whp_manifest(
+    paths,
+    file_glob: str = '*'
+) -> pd.DataFrame:
+    """Scan wrf-hydro output files from a simulation, ensemble, cycle, or ensemble cycle
+    without opening them. The member is taken from member_mmm directories, the reference time
+    from cast_YYYYMMDDHH directories and the time from the file name. This gives the grouping,
+    ordering, and size of a collection before any netcdf I/O.
+    Args:
+        paths: A directory to walk (once, with os.scandir) or a list of file paths. Files in
+            the list which do not exist are dropped.
+        file_glob: The pattern matched against file names when walking a directory,
+            e.g. '*CHRTOUT_DOMAIN1'.
+    Returns:
+        A pandas.DataFrame with columns path, member, reference_time, time, and lead_time.
+        Missing values are <NA>/NaT.
+    """
+    records = scan_whp_files(paths, file_glob=file_glob)
+    columns = ['path', 'member', 'reference_time', 'time', 'lead_time']
+    manifest = pd.DataFrame(
+        [[rr[cc] for cc in columns] for rr in records], columns=columns)
+    manifest['member'] = manifest['member'].astype('Int64')
+    manifest['reference_time'] = pd.to_datetime(manifest['reference_time'])
+    manifest['time'] = pd.to_datetime(manifest['time'])
+    manifest['lead_time'] = pd.to_timedelta(manifest['lead_time'])
+    return manifest
+
+
+# Variables the preprocessing needs, beyond the dimension coordinates.
+whp_required_variables = ['time', 'reference_time', 'Times']
+
+
+def whp_variables_to_drop(nc_variables: dict, variables: list) -> list:
+    """The variables of a file which are not needed for the requested variables.
+    Args:
+        nc_variables: The netCDF4.Dataset.variables of the file.
+        variables: The variables requested.
+    Returns:
+        The list of the other variables, to be dropped at open. The requested variables are
+        kept with their coordinates (dimension coordinates and the variables named in their
+        coordinates and grid_mapping attributes) and the variables used by
+        preprocess_whp_data.
+    """
+    keep = set(variables).union(whp_required_variables)
+    dims = set()
+    for name in set(variables).intersection(nc_variables):
+        var = nc_variables[name]
+        dims.update(var.dimensions)
+        for att in ['coordinates', 'grid_mapping']:
+            if att in var.ncattrs():
+                keep.update(var.getncattr(att).split())
+    keep.update(dims)
+    return [name for name in nc_variables if name not in keep]
+
+
+class CollectionConvention(object):
+    """A file convention of the collection engine (open_whp_dataset): how the member,
+    reference_time and time of the files are found, and how an opened file becomes one slot
+    of the collection. The scan, parallel open, assembly (concat, block, raw), transports and
+    file chunking are shared by all the conventions. Other formats can be collected by
+    registering a subclass:
+        class MyConvention(CollectionConvention):
+            name = 'mine'
+            def preprocess(self, ds, path, file_info):
+                ds.coords['member'] = ds.attrs['member']
+                return ds
+        register_convention(MyConvention())
+        ds = open_whp_dataset(files, convention='mine')
+    The instance is shipped to the workers, so the subclass must be importable there.
+    """
+
+    name = None
+    # Keyword arguments of xr.open_dataset.
+    open_kwargs = {}
+    # Skip the files which can not be opened (with a message), else raise.
+    skip_unopenable = True
+    # The raw reader (assembly='raw') takes the slot of a file from its time and
+    # reference_time variables and the member of its file_info.
+    raw_reader = True
+    # The file_info keys which file_keys reads from the files when their names lack them,
+    # and the global attributes read for them.
+    header_keys = []
+    header_attrs = []
+
+    def file_info(self, path) -> dict:
+        """The record of a file, from its path alone. The member, reference_time, time and
+        lead_time (and the cast_dir of cycles) are None when not known from the path."""
+        return {
+            'path': pathlib.Path(path), 'member': None, 'cast_dir': None,
+            'reference_time': None, 'time': None, 'lead_time': None}
+
+    def scan(self, paths, file_glob: str = '*') -> list:
+        """The file_info records of a directory (walked) or a list of paths (files which
+        do not exist are dropped)."""
+        if isinstance(paths, (str, pathlib.Path)):
+            file_list = walk_files(paths, file_glob)
+        else:
+            file_list = [pathlib.Path(pp) for pp in paths if os.path.exists(str(pp))]
+        return [self.file_info(pp) for pp in file_list]
+
+    def file_keys(self, file_infos: list) -> list:
+        """The file_info records with the header_keys their names lack read from the files
+        (see header_info), for the planners which place the files before opening them: the
+        memmap and zarr transports, aggregate, append and iter_whp_dataset. Files which do not
+        open are dropped (or raise, see skip_unopenable)."""
+        keyed = []
+        for info in file_infos:
+            if all(info[key] is not None for key in self.header_keys):
+                keyed.append(info)
+                continue
+            try:
+                header = read_wh_file_times(info['path'], global_attrs=self.header_attrs)
+            except OSError:
+                if not self.skip_unopenable:
+                    raise
+                print("Skipping file, unable to open: ", info['path'])
+                continue
+            keyed.append(self.header_info(dict(info), header))
+        return keyed
+
+    def header_info(self, info: dict, header: dict) -> dict:
+        """Fill the header_keys of a file_info record from the file's header, the decoded
+        times and header_attrs from ioutils.read_wh_file_times."""
+        return info
+
+    def preprocess(self, ds: xr.Dataset, path, file_info: dict) -> xr.Dataset:
+        """Give an opened file (after drop_variables) its member, reference_time and
+        lead_time, or time, coordinates."""
+        return ds
+
+    def finish(self, ds: xr.Dataset) -> xr.Dataset:
+        """Touches to the assembled collection (after valid_time and the attributes)."""
+        return ds
+
+
+class WhpConvention(CollectionConvention):
+    """Simulations, ensembles, cycles and ensemble cycles run by wrfhydropy: members from the
+    member_mmm and reference times from the cast_YYYYMMDDHH directories, times of restart
+    files from their Times or Restart_Time."""
+
+    name = 'whp'
+
+    def file_info(self, path) -> dict:
+        info = super().file_info(path)
+        info.update(whp_dir_info(info['path'].parent))
+        return info
+
+    def scan(self, paths, file_glob: str = '*') -> list:
+        return scan_whp_files(paths, file_glob=file_glob)
+
+    def preprocess(self, ds: xr.Dataset, path, file_info: dict) -> xr.Dataset:
+        # Exception for RESTART.YYMMDDHHMM_DOMAIN1 files
+        if 'RESTART.' in str(path):
+            time = datetime.strptime(ds.Times.values[0].decode('utf-8'), '%Y-%m-%d_%H:%M:%S')
+            ds = ds.squeeze('Time')
+            ds = ds.drop_vars(['Times'])
+            ds = ds.assign_coords(time=time)
+
+        # Exception for HYDRO_RST.YY-MM-DD_HH:MM:SS_DOMAIN1 files
+        if 'HYDRO_RST.' in str(path):
+            time = datetime.strptime(ds.attrs['Restart_Time'], '%Y-%m-%d_%H:%M:%S')
+            ds = ds.assign_coords(time=time)
+
+        # Member preprocess
+        if file_info['member'] is not None:
+            ds.coords['member'] = file_info['member']
+
+        # Lead time preprocess
+        if file_info['cast_dir'] is not None:
+            # Exception for cast HYDRO_RST.YY-MM-DD_HH:MM:SS_DOMAIN1 and
+            # RESTART.YYMMDDHHMM_DOMAIN1 files
+            if 'HYDRO_RST.' in str(path) or 'RESTART' in str(path):
+                reference_time = file_info.get('reference_time')
+                if reference_time is None:
+                    reference_time = cast_reference_time(file_info['cast_dir'])
+                ds.coords['reference_time'] = reference_time
+            ds.coords['lead_time'] = np.array(
+                ds.time.values - ds.reference_time.values,
+                dtype='timedelta64[ns]'
+            )
+            ds = ds.drop_vars('time')
+
+            # Could create a valid time variable here, but I'm guessing it's more efficient
+            # after all the data are collected.
+            # ds['valid_time'] = np.datetime64(int(ds.lead_time) + int(ds.reference_time), 'ns')
+
+        else:
+            if 'reference_time' in ds.variables:
+                ds = ds.drop_vars('reference_time')
+
+        return ds
+
+
+class NwmConvention(CollectionConvention):
+    """National Water Model output files, nwm.tHHz.range.type_m.fFFF.domain.nc: the member
+    is the m of the type, the lead_time is from the time and reference_time of the file
+    (read from the header by file_keys). Read without mask_and_scale."""
+
+    name = 'nwm'
+    open_kwargs = {'mask_and_scale': False}
+    header_keys = ['reference_time', 'time']
+
+    def file_info(self, path) -> dict:
+        info = super().file_info(path)
+        try:
+            info['member'] = int(info['path'].name.split('.')[3].split('_')[-1])
+        except (ValueError, IndexError):
+            pass
+        return info
+
+    def header_info(self, info: dict, header: dict) -> dict:
+        # The name only has the hour of the reference_time.
+        info['reference_time'] = pd.Timestamp(header['reference_time'][0]).to_pydatetime()
+        info['time'] = pd.Timestamp(header['time'][0]).to_pydatetime()
+        info['lead_time'] = info['time'] - info['reference_time']
+        return info
+
+    def preprocess(self, ds: xr.Dataset, path, file_info: dict) -> xr.Dataset:
+        # TODO JLM? Check range (e.g. "medium_range")
+        # TODO JLM? Check file type (e.g "channel_rt")
+        if file_info['member'] is not None:
+            ds.coords['member'] = file_info['member']
+        ds.coords['lead_time'] = np.array(
+            ds.time.values - ds.reference_time.values,
+            dtype='timedelta64[ns]'
+        )
+        return ds.drop_vars('time')
+
+    def finish(self, ds: xr.Dataset) -> xr.Dataset:
+        # The nwm valid_time is on (reference_time, lead_time).
+        if 'valid_time' in ds.coords:
+            ds.coords['valid_time'] = ds.valid_time.transpose('reference_time', 'lead_time')
+        elif 'valid_time' in ds.variables:
+            ds['valid_time'] = ds.valid_time.transpose('reference_time', 'lead_time')
+        return ds
+
+
+class DartConvention(CollectionConvention):
+    """DART (wrf-hydro restart) member files: the member is the last word of the
+    DART_file_information attribute (and the time from the time variable, both read from the
+    header by file_keys). Every variable gets the time dimension. Files which do not open
+    raise."""
+
+    name = 'dart'
+    # I kinda dont think this should be optional for dart experiment/run collection.
+    skip_unopenable = False
+    raw_reader = False
+    header_keys = ['member', 'time']
+    header_attrs = ['DART_file_information']
+
+    def header_info(self, info: dict, header: dict) -> dict:
+        info['member'] = int(header['DART_file_information'].split()[-1])
+        info['time'] = pd.Timestamp(header['time'][0]).to_pydatetime()
+        return info
+
+    def preprocess(self, ds: xr.Dataset, path, file_info: dict) -> xr.Dataset:
+        for key in list(ds.variables.keys()):
+            if 'time' not in ds[key].dims:
+                ds[key] = ds[key].expand_dims('time')
+        ds.coords['member'] = int(ds.attrs['DART_file_information'].split()[-1])
+        return ds
+
+    def finish(self, ds: xr.Dataset) -> xr.Dataset:
+        # The existing DART convention.
+        return ds.transpose('time', 'member', ...)
+
+
+# The registered conventions, by name.
+collection_conventions = collections.OrderedDict()
+
+
+def register_convention(convention: CollectionConvention):
+    """Register a convention (instance) under its name for the convention argument of
+    open_whp_dataset."""
+    collection_conventions[convention.name] = convention
+
+
+def get_convention(convention: Union[str, CollectionConvention] = None) -> CollectionConvention:
+    """The convention of a name (None for 'whp'), or the convention itself."""
+    if convention is None:
+        convention = 'whp'
+    if isinstance(convention, CollectionConvention):
+        return convention
+    if convention not in collection_conventions:
+        raise ValueError(
+            'Unknown convention ' + str(convention) + ', the registered conventions are: ' +
+            ', '.join(collection_conventions.keys()))
+    return collection_conventions[convention]
+
+
+register_convention(WhpConvention())
+register_convention(NwmConvention())
+register_convention(DartConvention())
+
+
+class SerializableRLock(dask.utils.SerializableLock):
+    """A reentrant dask SerializableLock: per process, and the same lock after pickling."""
+
+    _locks = weakref.WeakValueDictionary()
+
+    def __init__(self, token: str = None):
+        self.token = token or str(uuid.uuid4())
+        self.lock = SerializableRLock._locks.get(self.token)
+        if self.lock is None:
+            self.lock = threading.RLock()
+            SerializableRLock._locks[self.token] = self.lock
+
+    def locked(self):
+        # An RLock can not tell, try it.
+        if self.lock.acquire(blocking=False):
+            self.lock.release()
+            return False
+        return True
+
+
+# NetCDF-C and HDF5 are not thread safe and xarray only locks the file opens and data
+# reads, not the metadata reads of the open. The collection holds this (reentrant) lock
+# over its opens and passes it to xarray for the later reads, so thread workers are safe.
+whp_netcdf_lock = SerializableRLock('wrfhydropy-collection-netcdf')
+
+
 def preprocess_whp_data(
     path,
     isel: dict = None,
-    drop_variables: list = None
+    drop_variables: list = None,
+    file_info: dict = None,
+    variables: list = None,
+    feature_index: dict = None,
+    profile: bool = False,
+    convention: Union[str, CollectionConvention] = None,
+    chunks: dict = None
 ) -> xr.Dataset:
+    convention = get_convention(convention)
+
+    # With profile, the open and preprocess times are returned in ds.encoding['profile'].
+    if profile:
+        start = span_start()
     try:
-        ds = xr.open_dataset(path)
+        with whp_netcdf_lock:
+            if variables is None:
+                ds = xr.open_dataset(
+                    path, chunks=chunks, lock=whp_netcdf_lock, **convention.open_kwargs)
+            else:
+                # Only the requested variables (and their coordinates) are decoded.
+                store = xr.backends.NetCDF4DataStore.open(str(path), lock=whp_netcdf_lock)
+                ds = xr.open_dataset(
+                    store, drop_variables=whp_variables_to_drop(store.ds.variables, variables),
+                    chunks=chunks, **convention.open_kwargs)
     except OSError:
+        if not convention.skip_unopenable:
+            raise
         print("Skipping file, unable to open: ", path)
         return None
 
+    if profile:
+        open_elapsed = span_elapsed(start)
+        start = span_start()
+
     if drop_variables is not None:
         to_drop = set(ds.variables).intersection(set(drop_variables))
         if to_drop != set():
             ds = ds.drop_vars(to_drop)
 
-    # Exception for RESTART.YYMMDDHHMM_DOMAIN1 files
-    if 'RESTART.' in str(path):
-        time = datetime.strptime(ds.Times.values[0].decode('utf-8'), '%Y-%m-%d_%H:%M:%S')
-        ds = ds.squeeze('Time')
-        ds = ds.drop_vars(['Times'])
-        ds = ds.assign_coords(time=time)
+    # The member and times come from the file names, unless already scanned.
+    if file_info is None:
+        file_info = convention.file_info(path)
+    ds = convention.preprocess(ds, path, file_info)
 
-    # Exception for HYDRO_RST.YY-MM-DD_HH:MM:SS_DOMAIN1 files
-    if 'HYDRO_RST.' in str(path):
-        time = datetime.strptime(ds.attrs['Restart_Time'], '%Y-%m-%d_%H:%M:%S')
-        ds = ds.assign_coords(time=time)
+    # Spatial subsetting
+    if isel is not None:
+        ds = ds.isel(isel)
+    if feature_index is not None:
+        ds = select_feature_index(ds, feature_index, path)
 
-    filename_parent = pathlib.Path(path).parent
-    filename_grandparent = pathlib.Path(path).parent.parent
+    if profile:
+        ds.encoding['profile'] = {
+            'open': open_elapsed,
+            'preprocess': span_elapsed(start),
+            'nbytes': os.path.getsize(path),
+            'peak_rss': peak_rss()}
 
-    # Member preprocess
-    # Assumption is that parent dir is member_mmm
-    # member = None
-    if 'member' in filename_parent.name:
-        # This is a double check that this convention is because of wrf_hydro_py
-        assert filename_parent.parent.joinpath('WrfHydroEns.pkl').exists()
-        member = int(filename_parent.name.split('_')[-1])
-        ds.coords['member'] = member
-
-    # Lead time preprocess
-    # Assumption is that parent dir is cast_yymmddHH
-    if 'cast_' in filename_parent.name or 'cast_' in filename_grandparent.name:
-        # Exception for cast HYDRO_RST.YY-MM-DD_HH:MM:SS_DOMAIN1 and
-        # RESTART.YYMMDDHHMM_DOMAIN1 files
-        if 'HYDRO_RST.' in str(path) or 'RESTART' in str(path):
-            cast_fmt = 'cast_%Y%m%d%H'
-            if 'cast_' in filename_parent.name:
-                # This is a double check that this convention is because of wrf_hydro_py
-                assert filename_parent.parent.joinpath('WrfHydroCycle.pkl').exists()
-                ds.coords['reference_time'] = datetime.strptime(filename_parent.name, cast_fmt)
-            elif 'cast_' in filename_grandparent.name:
-                # This is a double check that this convention is because of wrf_hydro_py
-                assert filename_grandparent.parent.joinpath('WrfHydroCycle.pkl').exists()
-                ds.coords['reference_time'] = \
-                    datetime.strptime(filename_grandparent.name, cast_fmt)
-        ds.coords['lead_time'] = np.array(
-            ds.time.values - ds.reference_time.values,
-            dtype='timedelta64[ns]'
-        )
-        ds = ds.drop_vars('time')
+    return ds
+
+
+def preprocess_whp_record(
+    file_info: dict,
+    isel: dict = None,
+    drop_variables: list = None,
+    variables: list = None,
+    feature_index: dict = None,
+    profile: bool = False,
+    convention: Union[str, CollectionConvention] = None,
+    chunks: dict = None
+) -> xr.Dataset:
+    """preprocess_whp_data for a record from scan_whp_files (or a convention's scan)."""
+    return preprocess_whp_data(
+        file_info['path'], isel=isel, drop_variables=drop_variables, file_info=file_info,
+        variables=variables, feature_index=feature_index, profile=profile,
+        convention=convention, chunks=chunks)
 
-        # Could create a valid time variable here, but I'm guessing it's more efficient
-        # after all the data are collected.
-        # ds['valid_time'] = np.datetime64(int(ds.lead_time) + int(ds.reference_time), 'ns')
 
+def block_concat_dims(have_members: bool, have_lead_time: bool) -> list:
+    """The dimensions along which files are assembled, in the order the cascaded
+    concatenation in open_whp_dataset_inner applies them."""
+    if have_lead_time:
+        if have_members:
+            return ['reference_time', 'member', 'lead_time']
+        return ['reference_time', 'lead_time']
+    if have_members:
+        return ['time', 'member']
+    return ['time']
+
+
+def block_key(ds: xr.Dataset, dim: str):
+    """The (single) coordinate value of a preprocessed file along dim."""
+    values = np.atleast_1d(ds[dim].values)
+    if len(values) != 1:
+        raise ValueError(
+            "Block assembly requires one " + dim + " per file, found " + str(len(values)))
+    return values[0]
+
+
+def block_grid(keys: dict, concat_dims: list) -> tuple:
+    """The coordinate grid of a block assembly and the position of each file on it.
+    A simulation keeps the order of the files (like concat), everything else is sorted.
+    Args:
+        keys: Dict of the per-file coordinate values along each of the concat_dims.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+    Returns:
+        Tuple of dicts (index, positions) keyed by dimension.
+    """
+    if concat_dims == ['time']:
+        index = {'time': np.array(keys['time'])}
+        positions = {'time': np.arange(len(keys['time']))}
     else:
-        if 'reference_time' in ds.variables:
-            ds = ds.drop_vars('reference_time')
+        index = {dim: np.unique(np.array(keys[dim])) for dim in concat_dims}
+        positions = {
+            dim: np.searchsorted(index[dim], np.array(keys[dim])) for dim in concat_dims}
+    return index, positions
+
+
+def block_layout(
+    template: dict,
+    concat_dims: list,
+    index: dict,
+    has_holes: dict
+) -> tuple:
+    """The output variables of a block assembly. Coordinates without an assembly
+    dimension are not concatenated (coords='minimal'), data variables get every assembly
+    dimension (data_vars='all') prepended as concat would do it. Variables with holes
+    in the grid are promoted to hold missing values.
+    Args:
+        template: Dict of name: (variable, is_coord) from a preprocessed file.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+        index: The grid, from block_grid.
+        has_holes: Dict of name: bool, if the variable is missing for some grid slots.
+    Returns:
+        Tuple of (layout, static). layout is a dict of name: dict with the dims, shape,
+        dtype, fill_value (None without holes), and is_coord of the output variables.
+        static is a dict of name: variable of the coordinates which are not assembled.
+    """
+    layout = collections.OrderedDict()
+    static = collections.OrderedDict()
+    for name, (var, is_coord) in template.items():
+        if is_coord and not set(var.dims).intersection(concat_dims):
+            static[name] = var
+            continue
+        if is_coord:
+            dims = var.dims
+        else:
+            dims = tuple(reversed([dd for dd in concat_dims if dd not in var.dims])) + var.dims
+        shape = tuple(
+            len(index[dd]) if dd in concat_dims else var.sizes[dd] for dd in dims)
+        if has_holes[name]:
+            dtype, fill_value = xr.core.dtypes.maybe_promote(var.dtype)
+        else:
+            dtype, fill_value = var.dtype, None
+        layout[name] = {
+            'dims': dims, 'shape': shape, 'dtype': dtype,
+            'fill_value': fill_value, 'is_coord': is_coord}
+    return layout, static
+
+
+def block_slot(file_var: xr.Variable, out_dims: tuple, file_positions: dict) -> tuple:
+    """The index of a file's variable in its block assembly output variable.
+    Args:
+        file_var: The variable from the preprocessed file.
+        out_dims: The dimensions of the output variable.
+        file_positions: Dict of the file's position along each assembly dimension.
+    """
+    return tuple(
+        (slice(file_positions[dd], file_positions[dd] + 1) if dd in file_var.dims
+         else file_positions[dd]) if dd in file_positions else slice(None)
+        for dd in out_dims)
+
+
+def block_index_coords(ds: xr.Dataset, concat_dims: list) -> dict:
+    """The index coordinates of a preprocessed file which are not assembled (e.g.
+    feature_id, or x and y), which every file of a block assembly must share."""
+    return {
+        dim: ds[dim].values for dim in ds.dims
+        if dim in ds.coords and dim not in concat_dims}
+
+
+def block_index_error(name: str, path=None) -> ValueError:
+    """The error for a file whose index coordinate differs from the template file's."""
+    return ValueError(
+        'The ' + name + ' coordinate of the file differs from the template file: ' +
+        str(path) + ". Block assembly needs the same " + name + " in every file, " +
+        "use assembly='concat'.")
+
+
+def check_block_index(ds: xr.Dataset, index_coords: dict, path=None):
+    """Check that a preprocessed file has the index coordinates of the template file, its
+    values are copied into the template's slots by position."""
+    for name, values in index_coords.items():
+        if name not in ds.coords or not np.array_equal(ds[name].values, values):
+            raise block_index_error(name, path)
+
+
+def fill_block_holes(var: xr.Variable, filled: np.ndarray, concat_dims: list) -> xr.Variable:
+    """Promote an assembled variable to hold missing values and set them where its grid
+    slots were not filled, as block_layout does for holes.
+    Args:
+        var: The assembled variable.
+        filled: Boolean array on the grid (of concat_dims), True where a file was copied.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+    """
+    dtype, fill_value = xr.core.dtypes.maybe_promote(var.dtype)
+    values = var.values.astype(dtype)
+    holes = xr.Variable(concat_dims, ~filled).set_dims(var.sizes)
+    values[holes.transpose(*var.dims).values] = fill_value
+    return xr.Variable(var.dims, values, attrs=var.attrs, encoding=var.encoding)
+
+
+def assemble_whp_blocks(ds_list: list, concat_dims: list) -> xr.Dataset:
+    """Assemble preprocessed per-file datasets into a single dataset by preallocating
+    the output arrays on the full coordinate grid and copying each file into its slot.
+    The files must share the index coordinates which are not assembled (e.g. feature_id),
+    else a ValueError is raised where the cascaded xr.concat of open_whp_dataset_inner
+    would outer join them. Otherwise the result matches that concat (with its ordering),
+    but each value is copied once.
+    Args:
+        ds_list: List of datasets returned by preprocess_whp_data. Entries are
+            released (set to None) as they are copied.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+    Returns:
+        An xarray dataset.
+    """
+    n_files = len(ds_list)
+    keys = {dim: [block_key(ds, dim) for ds in ds_list] for dim in concat_dims}
+    dim_templates = {dim: ds_list[0].variables[dim] for dim in concat_dims}
+    index_coords = block_index_coords(ds_list[0], concat_dims)
+    index, positions = block_grid(keys, concat_dims)
+    grid_shape = tuple(len(index[dim]) for dim in concat_dims)
+    slots = np.ravel_multi_index(
+        tuple(positions[dim] for dim in concat_dims), grid_shape)
+
+    # Variables are templated on the first file in which they appear.
+    template = collections.OrderedDict()
+    var_slots = collections.defaultdict(list)
+    for ii, ds in enumerate(ds_list):
+        for name, var in ds.variables.items():
+            if name in concat_dims:
+                continue
+            if name not in template:
+                template[name] = (var, name in ds.coords)
+            var_slots[name].append(slots[ii])
+    n_grid = int(np.prod(grid_shape))
+    has_holes = {name: len(np.unique(var_slots[name])) < n_grid for name in template}
+
+    # Preallocate.
+    layout, static = block_layout(template, concat_dims, index, has_holes)
+    out_vars = collections.OrderedDict()
+    out_coords = collections.OrderedDict()
+    out_data = collections.OrderedDict()
+    for name, spec in layout.items():
+        if spec['fill_value'] is not None:
+            data = np.full(spec['shape'], spec['fill_value'], dtype=spec['dtype'])
+        else:
+            data = np.empty(spec['shape'], dtype=spec['dtype'])
+        out_data[name] = data
+        var = template[name][0]
+        new_var = xr.Variable(spec['dims'], data, attrs=var.attrs, encoding=var.encoding)
+        if spec['is_coord']:
+            out_coords[name] = new_var
+        else:
+            out_vars[name] = new_var
+
+    # Copy each file into its slot, releasing the file as we go.
+    attrs = ds_list[0].attrs
+    for ii in range(n_files):
+        ds = ds_list[ii]
+        check_block_index(ds, index_coords, ds.encoding.get('source'))
+        file_positions = {dim: positions[dim][ii] for dim in concat_dims}
+        for name, data in out_data.items():
+            if name not in ds.variables:
+                continue
+            file_var = ds.variables[name].transpose(*template[name][0].dims)
+            data[block_slot(file_var, layout[name]['dims'], file_positions)] = \
+                file_var.values
+        ds_list[ii] = None
+
+    for dim in concat_dims:
+        dim_var = dim_templates[dim]
+        out_coords[dim] = xr.Variable(
+            dim, index[dim], attrs=dim_var.attrs, encoding=dim_var.encoding)
+
+    whp_ds = xr.Dataset(out_vars, coords={**out_coords, **static}, attrs=attrs)
+    return whp_ds
 
-    # Spatial subsetting
-    if isel is not None:
-        ds = ds.isel(isel)
 
-    return ds
+def read_raw_variable(nc_var, isel: dict = None, feature_index: dict = None) -> np.ndarray:
+    """Read the raw (undecoded) values of a netCDF4 variable with the isel and feature_index
+    selections of preprocess_whp_data. Single int or slice selections are passed to the
+    read, others (lists, or both on one dimension) are applied to the values read."""
+    nc_index = []
+    post_steps = []
+    for dim in nc_var.dimensions:
+        steps = []
+        if isel is not None and dim in isel:
+            steps.append(isel[dim])
+        if feature_index is not None and dim == feature_index['dim']:
+            steps.append(feature_index['positions'])
+        if len(steps) == 1 and isinstance(steps[0], (int, np.integer, slice)):
+            nc_index.append(steps[0])
+            if not isinstance(steps[0], slice):
+                continue
+            steps = []
+        else:
+            nc_index.append(slice(None))
+        post_steps.append(steps)
+
+    data = np.asarray(nc_var[tuple(nc_index)])
+    axis = 0
+    for steps in post_steps:
+        for step in steps:
+            if isinstance(step, slice):
+                data = data[(slice(None),) * axis + (step,)]
+            else:
+                data = np.take(data, step, axis=axis)
+        # An int step drops the axis.
+        if len(steps) == 0 or not isinstance(steps[-1], (int, np.integer)):
+            axis += 1
+    return data
+
+
+def whp_raw_spec(
+    template: xr.Dataset,
+    path,
+    concat_dims: list,
+    isel: dict = None,
+    feature_index: dict = None
+) -> dict:
+    """The schema of a raw collection from a template file: the variables to read from
+    every file with their raw dtypes, shapes and attributes (as in the file, before
+    decoding).
+    Args:
+        template: The template file, as returned by preprocess_whp_data.
+        path: The template file path.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+        isel: As for preprocess_whp_data.
+        feature_index: As for preprocess_whp_data.
+    Returns:
+        A dict, small enough to ship to every worker.
+    """
+    import netCDF4
+    spec = {
+        'variables': collections.OrderedDict(), 'time': collections.OrderedDict(),
+        'isel': isel, 'feature_index': feature_index}
+    with netCDF4.Dataset(str(path)) as nc:
+        nc.set_auto_maskandscale(False)
+        nc.set_auto_chartostring(False)
+        for name, var in template.variables.items():
+            is_coord = name in template.coords
+            if name in concat_dims or (is_coord and not set(var.dims).intersection(concat_dims)):
+                continue
+            if name not in nc.variables:
+                raise ValueError(
+                    "The raw reader only reads variables from the files, " + name +
+                    " is not in " + str(path) + ". Use assembly='block'.")
+            raw = read_raw_variable(nc.variables[name], isel, feature_index)
+            # The raw dimensions can differ from the decoded, e.g. for character arrays.
+            raw_dims = tuple(
+                dim for dim in nc.variables[name].dimensions
+                if isel is None or not isinstance(isel.get(dim), (int, np.integer)))
+            spec['variables'][name] = {
+                'file_dims': raw_dims, 'shape': raw.shape, 'dtype': raw.dtype,
+                'attrs': {att: nc.variables[name].getncattr(att)
+                          for att in nc.variables[name].ncattrs()},
+                'is_coord': is_coord}
+        # The index coordinates which are not assembled, every file must share them. The
+        # feature_index is checked against its own ids.
+        spec['index'] = collections.OrderedDict(
+            (dim, read_raw_variable(nc.variables[dim], isel, feature_index))
+            for dim in template.dims
+            if dim in template.coords and dim not in concat_dims and dim in nc.variables and
+            (feature_index is None or dim != feature_index['dim']))
+        # The times which locate a file in the collection.
+        time_names = ['reference_time', 'time'] if 'lead_time' in concat_dims else ['time']
+        for name in time_names:
+            spec['time'][name] = {
+                att: nc.variables[name].getncattr(att) for att in nc.variables[name].ncattrs()}
+    return spec
+
+
+def read_whp_raw(file_info: dict, spec: dict) -> dict:
+    """Read the raw variable values and time values of a file for assemble_whp_raw. The
+    file is checked against the spec's index coordinates, shapes and dtypes and, as by
+    select_feature_index, to have the feature ordering of the feature_index at its
+    positions.
+    Args:
+        file_info: A record from scan_whp_files.
+        spec: From whp_raw_spec.
+    Returns:
+        A dict with the file_info, the raw 'times' and 'data' by variable name. None if the
+        file does not open.
+    """
+    import netCDF4
+    with whp_netcdf_lock:
+        try:
+            nc = netCDF4.Dataset(str(file_info['path']))
+        except OSError:
+            print("Skipping file, unable to open: ", file_info['path'])
+            return None
+        with nc:
+            nc.set_auto_maskandscale(False)
+            nc.set_auto_chartostring(False)
+            feature_index = spec['feature_index']
+            if feature_index is not None:
+                dim = feature_index['dim']
+                if (dim not in nc.variables or
+                        nc.dimensions[dim].size != feature_index['size'] or
+                        not np.array_equal(
+                            nc.variables[dim][feature_index['positions']],
+                            feature_index['feature_ids'])):
+                    raise ValueError(
+                        'The ' + dim + ' ordering of the file differs from the indexed file: ' +
+                        str(file_info['path']))
+            for name, values in spec['index'].items():
+                if name not in nc.variables or not np.array_equal(
+                        read_raw_variable(
+                            nc.variables[name], spec['isel'], spec['feature_index']),
+                        values):
+                    raise block_index_error(name, file_info['path'])
+            data = {}
+            for name, var_spec in spec['variables'].items():
+                raw = read_raw_variable(nc.variables[name], spec['isel'], spec['feature_index'])
+                if raw.shape != var_spec['shape'] or raw.dtype != var_spec['dtype']:
+                    raise ValueError(
+                        "The variable " + name + " of " + str(file_info['path']) + " differs " +
+                        "from the template file, the raw reader needs homogeneous files. " +
+                        "Use assembly='block'.")
+                data[name] = raw
+            # The time units can differ between files.
+            times = {
+                name: (nc.variables[name][0],
+                       tuple(nc.variables[name].getncattr(att)
+                             if att in nc.variables[name].ncattrs() else None
+                             for att in ['units', 'calendar']))
+                for name in spec['time']}
+    return {'info': file_info, 'times': times, 'data': data}
+
+
+def assemble_whp_raw(
+    records: list,
+    spec: dict,
+    template: xr.Dataset,
+    concat_dims: list
+) -> xr.Dataset:
+    """Assemble the raw reads of read_whp_raw like assemble_whp_blocks. The raw values are
+    copied into preallocated arrays and decoded (mask, scale, times) once per variable.
+    Args:
+        records: List of dicts from read_whp_raw. Entries are released as they are copied.
+        spec: From whp_raw_spec.
+        template: The template file, as returned by preprocess_whp_data.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+    Returns:
+        An xarray dataset.
+    """
+    # Decode the file times at once for each of their units.
+    times = {}
+    for name, attrs in spec['time'].items():
+        units = [rec['times'][name][1] for rec in records]
+        raw = np.array([rec['times'][name][0] for rec in records])
+        for unit in set(units):
+            which = np.array([uu == unit for uu in units])
+            unit_attrs = dict(attrs, units=unit[0])
+            if unit[1] is not None:
+                unit_attrs['calendar'] = unit[1]
+            decoded = xr.conventions.decode_cf_variable(
+                name, xr.Variable('file', raw[which], attrs=unit_attrs)).values
+            if name not in times:
+                times[name] = np.empty(len(records), dtype=decoded.dtype)
+            times[name][which] = decoded
+
+    keys = {}
+    if 'lead_time' in concat_dims:
+        keys['reference_time'] = times['reference_time']
+        keys['lead_time'] = np.array(
+            times['time'] - times['reference_time'], dtype='timedelta64[ns]')
+    else:
+        keys['time'] = times['time']
+    if 'member' in concat_dims:
+        keys['member'] = [rec['info']['member'] for rec in records]
+    index, positions = block_grid(keys, concat_dims)
+    grid_shape = tuple(len(index[dim]) for dim in concat_dims)
+    filled = np.zeros(grid_shape, dtype=bool)
+    filled[tuple(positions[dim] for dim in concat_dims)] = True
+
+    # Preallocate, in the raw dtypes. Holes are masked after decoding.
+    layout, _ = block_layout(
+        collections.OrderedDict(
+            (name, (xr.Variable(var_spec['file_dims'], np.empty(var_spec['shape'],
+                                dtype=var_spec['dtype'])), var_spec['is_coord']))
+            for name, var_spec in spec['variables'].items()),
+        concat_dims, index, {name: False for name in spec['variables']})
+    out_data = collections.OrderedDict(
+        (name, np.empty(var_layout['shape'], dtype=var_layout['dtype']))
+        for name, var_layout in layout.items())
+
+    for ii in range(len(records)):
+        file_positions = {dim: positions[dim][ii] for dim in concat_dims}
+        for name, data in out_data.items():
+            out_dims = layout[name]['dims']
+            slot = tuple(file_positions[dd] if dd in file_positions else slice(None)
+                         for dd in out_dims)
+            data[slot] = records[ii]['data'][name]
+        records[ii] = None
+
+    out_vars = collections.OrderedDict()
+    out_coords = collections.OrderedDict()
+    for name, data in out_data.items():
+        var_spec = spec['variables'][name]
+        raw_var = xr.Variable(layout[name]['dims'], data, attrs=var_spec['attrs'])
+        # Only the characters along a dimension of the file are joined.
+        var = xr.conventions.decode_cf_variable(
+            name, raw_var, concat_characters=len(var_spec['file_dims']) > 0,
+            mask_and_scale=spec.get('mask_and_scale', True))
+        var = xr.Variable(var.dims, var.values, attrs=template[name].attrs,
+                          encoding=template[name].encoding)
+        if not filled.all():
+            var = fill_block_holes(var, filled, concat_dims)
+        if var_spec['is_coord']:
+            out_coords[name] = var
+        else:
+            out_vars[name] = var
 
+    for dim in concat_dims:
+        dim_var = template.variables[dim]
+        out_coords[dim] = xr.Variable(
+            dim, index[dim], attrs=dim_var.attrs, encoding=dim_var.encoding)
 
-def open_whp_dataset_inner(
-    paths: list,
-    chunks: dict = None,
-    attrs_keep: list = ['featureType', 'proj4',
-                        'station_dimension', 'esri_pe_string',
-                        'Conventions', 'model_version'],
+    # The coordinates which are not assembled come from the template.
+    static = collections.OrderedDict(
+        (name, var) for name, var in template.coords.variables.items()
+        if name not in concat_dims and not set(var.dims).intersection(concat_dims))
+
+    return xr.Dataset(out_vars, coords={**out_coords, **static}, attrs=template.attrs)
+
+
+def open_whp_raw(
+    file_infos: list,
     isel: dict = None,
     drop_variables: list = None,
     npartitions: int = None,
-    profile: int = False
+    profile: CollectionProfile = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
 ) -> xr.Dataset:
+    """The raw reader of open_whp_dataset_inner (assembly='raw'). The first file which
+    opens is preprocessed as the template, the other files are only read for their raw
+    variable values and times and these are assembled as by assemble_whp_blocks.
+    Args:
+        file_infos: Records from scan_whp_files.
+        Others: As for preprocess_whp_data.
+    Returns:
+        The assembled dataset (before finish_whp_dataset), None if no file opens.
+    """
+    convention = get_convention(convention)
+    if not convention.raw_reader:
+        raise ValueError(
+            "The " + convention.name + " convention can not use assembly='raw'.")
+    with profile_span(profile, 'template'):
+        template = None
+        for file_info in file_infos:
+            template = preprocess_whp_record(
+                file_info, isel=isel, drop_variables=drop_variables, variables=variables,
+                feature_index=feature_index, convention=convention)
+            if template is not None:
+                break
+        if template is None:
+            return None
+        if 'RESTART.' in str(file_info['path']) or 'HYDRO_RST.' in str(file_info['path']):
+            raise ValueError(
+                "The raw reader does not read restart files. Use assembly='block'.")
+        concat_dims = block_concat_dims(
+            'member' in template.coords, 'lead_time' in template.coords)
+        spec = whp_raw_spec(
+            template, file_info['path'], concat_dims, isel=isel, feature_index=feature_index)
+        spec['mask_and_scale'] = convention.open_kwargs.get('mask_and_scale', True)
+
+    paths_bag = dask.bag.from_sequence(file_infos, npartitions=npartitions)
+    with profile_span(profile, 'gather') as span:
+        records = paths_bag.map(read_whp_raw, spec=spec).filter(is_not_none).compute(
+            **session_compute_kwargs())
+        span['n_files'] = len(records)
+
+    with profile_span(profile, 'merge', n_files=len(records)):
+        whp_ds = assemble_whp_raw(records, spec, template, concat_dims)
+    return whp_ds
 
-    if profile:
-        then = timesince()
 
-    # This is totally arbitrary be seems to work ok.
-    # if npartitions is None:
-    #     npartitions = dask.config.get('pool')._processes * 4
-    # This choice does not seem to work well or at all, error?
-    # npartitions = len(sorted(paths))
-    paths_bag = dask.bag.from_sequence(paths, npartitions=npartitions)
+# The reductions of aggregate=, see parse_aggregate.
+aggregate_hows = ['mean', 'max', 'min', 'sum']
+
+# The most files of a window that a worker reduces at once, longer windows (e.g. months of
+# hourly files) are split across workers and their partial aggregates combined.
+aggregate_batch_files = 48
+
+
+def parse_aggregate(aggregate: dict) -> dict:
+    """Check the aggregate argument of open_whp_dataset: a dict of the resample frequency
+    (pandas, e.g. '1D', '6h', 'MS') and the reduction, e.g. {'freq': '1D', 'how': 'mean'}."""
+    if not isinstance(aggregate, dict) or 'freq' not in aggregate:
+        raise ValueError("aggregate must be a dict with a freq, e.g. {'freq': '1D'}.")
+    how = aggregate.get('how', 'mean')
+    if how not in aggregate_hows:
+        raise ValueError('aggregate how must be one of ' + str(aggregate_hows))
+    return {'freq': aggregate['freq'], 'how': how}
+
+
+def aggregate_windows(file_infos: list, freq: str) -> list:
+    """The window (label) of each file's time, binned as by xarray/pandas resample. The
+    times come from the file names."""
+    times = []
+    for info in file_infos:
+        if info['cast_dir'] is not None or info['lead_time'] is not None:
+            raise ValueError(
+                'aggregate applies to simulations and ensembles (time), not cycles.')
+        if info['time'] is None:
+            raise ValueError(
+                'aggregate needs the time of each file from its name or header, not found '
+                'for ' + str(info['path']))
+        times.append(info['time'])
+    positions = pd.Series(np.arange(len(times)), index=pd.DatetimeIndex(times)).sort_index()
+    labels = [None] * len(times)
+    for label, group in positions.resample(freq):
+        for pos in group.values:
+            labels[pos] = np.datetime64(label, 'ns')
+    return labels
+
+
+def plan_aggregate_batches(file_infos: list, labels: list) -> list:
+    """The worker batches of an aggregation: the files of a member and window in time order,
+    at most aggregate_batch_files of them."""
+    windows = collections.OrderedDict()
+    order = sorted(range(len(file_infos)), key=lambda ii: (labels[ii], file_infos[ii]['time']))
+    for ii in order:
+        windows.setdefault((file_infos[ii]['member'], labels[ii]), []).append(file_infos[ii])
+    batches = []
+    for (member, window), infos in windows.items():
+        for start in range(0, len(infos), aggregate_batch_files):
+            batches.append({
+                'member': member, 'window': window,
+                'infos': infos[start:(start + aggregate_batch_files)]})
+    return batches
+
+
+def aggregate_whp_batch(
+    batch: dict,
+    how: str,
+    isel: dict = None,
+    drop_variables: list = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
+) -> dict:
+    """Open the files of a batch and reduce them over time to a partial aggregate. Runs in
+    the collection workers, only the partial aggregate goes back to the parent. The numeric
+    variables along time are reduced, the others take their first value.
+    Args:
+        batch: From plan_aggregate_batches.
+        how: One of aggregate_hows.
+        isel, drop_variables, variables, feature_index, convention: As for
+            preprocess_whp_data.
+    Returns:
+        A dict of the member and window of the batch, the reduced 'values' (sums for mean),
+        their 'count' (for mean) and the 'rest' of the variables. None if no files of the
+        batch could be opened.
+    """
+    ds_list = []
+    for info in batch['infos']:
+        ds = preprocess_whp_record(
+            info, isel=isel, drop_variables=drop_variables, variables=variables,
+            feature_index=feature_index, convention=convention)
+        if ds is not None:
+            ds_list.append(ds)
+    if len(ds_list) == 0:
+        return None
+    ds = merge_time(ds_list)
+    del ds_list
 
-    if profile:
-        then = timesince(then)
-        print('after paths_bag')
+    reduced_names = [
+        name for name, var in ds.data_vars.items()
+        if 'time' in var.dims and var.dtype.kind in 'iufb']
+    reduced = ds[reduced_names]
+    count = None
+    if how == 'mean':
+        # The sums are accumulated in double precision.
+        values = reduced.astype(np.float64).sum('time', skipna=True, keep_attrs=True)
+        count = reduced.count('time')
+    else:
+        values = getattr(reduced, how)('time', skipna=True, keep_attrs=True)
+
+    return {
+        'member': batch['member'],
+        'window': batch['window'],
+        'values': values,
+        'count': count,
+        'rest': ds.drop_vars(reduced_names).isel(time=0).drop_vars('time').load(),
+        'dtypes': {name: reduced[name].dtype for name in reduced_names},
+        'encodings': {name: reduced[name].encoding for name in reduced_names},
+        'time_encoding': ds['time'].encoding}
+
+
+def combine_aggregate_parts(parts: list, how: str) -> xr.Dataset:
+    """Combine the partial aggregates of a member and window (in time order) into its slot
+    of the collection: a dataset with the window as its time."""
+    with xr.set_options(keep_attrs=True):
+        if how in ['mean', 'sum']:
+            values = functools.reduce(
+                lambda aa, bb: aa + bb, [part['values'] for part in parts])
+        else:
+            ufunc = np.fmax if how == 'max' else np.fmin
+            values = functools.reduce(
+                lambda aa, bb: xr.apply_ufunc(ufunc, aa, bb),
+                [part['values'] for part in parts])
+        if how == 'mean':
+            count = functools.reduce(
+                lambda aa, bb: aa + bb, [part['count'] for part in parts])
+            values = values / count.where(count > 0)
+
+    first = parts[0]
+    for name, dtype in first['dtypes'].items():
+        # Floats keep their precision as in a resample, means of integers are double.
+        if dtype.kind == 'f' or how != 'mean':
+            values[name] = values[name].astype(dtype)
+        if values[name].dtype == dtype:
+            values[name].encoding = first['encodings'][name]
+
+    ds = first['rest'].assign(values.data_vars)
+    ds = ds.expand_dims(time=[first['window']])
+    ds['time'].encoding = first['time_encoding']
+    return ds
 
-    ds_list = paths_bag.map(
-        preprocess_whp_data,
-        isel=isel,
-        drop_variables=drop_variables
-    ).filter(is_not_none).compute()
 
-    if len(ds_list) == 0:
+def fill_aggregate_windows(ds: xr.Dataset, freq: str) -> xr.Dataset:
+    """Add the windows without files, between the first and last windows of an aggregated
+    collection, as missing values (NaN) as resample has them. The variables promoted to
+    hold them lose their encoding, as in finish_whp_dataset."""
+    if ds is None:
+        return None
+    windows = pd.Series(0, index=pd.DatetimeIndex(ds['time'].values)).resample(freq).count()
+    if len(windows) == ds.sizes['time']:
+        return ds
+    filled = ds.reindex(time=windows.index.values)
+    for name, var in filled.variables.items():
+        if var.dtype != ds[name].dtype:
+            var.encoding = {'_FillValue': None}
+    filled['time'].encoding = ds['time'].encoding
+    return filled
+
+
+def collect_whp_aggregate(
+    file_infos: list,
+    aggregate: dict,
+    isel: dict = None,
+    drop_variables: list = None,
+    npartitions: int = None,
+    profile: CollectionProfile = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
+) -> list:
+    """Collect time windows aggregated (e.g. daily means) in the workers, see the
+    aggregate argument of open_whp_dataset. Run it under a dask scheduler/pool.
+    Args:
+        file_infos: Records from scan_whp_files (or a convention's scan).
+        aggregate: From parse_aggregate.
+        isel, drop_variables, npartitions, variables, feature_index, convention: As for
+            open_whp_dataset_inner.
+        profile: A CollectionProfile, or None.
+    Returns:
+        The list of the datasets of each member and window, None if no files opened.
+    """
+    file_infos = get_convention(convention).file_keys(file_infos)
+    labels = aggregate_windows(file_infos, aggregate['freq'])
+    batches = plan_aggregate_batches(file_infos, labels)
+
+    with profile_span(profile, 'gather', n_files=len(file_infos)):
+        parts = dask.bag.from_sequence(batches, npartitions=npartitions).map(
+            aggregate_whp_batch,
+            how=aggregate['how'],
+            isel=isel,
+            drop_variables=drop_variables,
+            variables=variables,
+            feature_index=feature_index,
+            convention=convention
+        ).filter(is_not_none).compute(**session_compute_kwargs())
+    if len(parts) == 0:
         return None
 
-    if profile:
-        then = timesince(then)
-        print("after ds_list preprocess/filter")
+    with profile_span(profile, 'merge'):
+        windows = collections.OrderedDict()
+        for part in parts:
+            windows.setdefault((part['member'], part['window']), []).append(part)
+        return [combine_aggregate_parts(ww, aggregate['how']) for ww in windows.values()]
+
+
+def merge_whp_groups(
+    ds_list: list,
+    have_members: bool,
+    have_lead_time: bool,
+    npartitions: int = None,
+    profile: CollectionProfile = None
+) -> xr.Dataset:
+    """Assemble preprocessed per-file datasets by cascaded grouping and xr.concat. The
+    sort, group and merge steps are timed into the profile, if any."""
 
-    # Group by and merge by choices
-    have_members = 'member' in ds_list[0].coords
-    have_lead_time = 'lead_time' in ds_list[0].coords
     if have_lead_time:
         if have_members:
             group_list = [group_member_lead_time, group_lead_time]
@@ -180,60 +1333,68 @@ def open_whp_dataset_inner(
             group_list = [group_identity]
             merge_list = [merge_time]
 
+    n_files = len(ds_list)
     for group, merge in zip(group_list, merge_list):
 
-        if profile:
-            then = timesince(then)
-            print('before sort')
+        with profile_span(profile, 'sort'):
+            the_sort = sorted(ds_list, key=group)
 
-        the_sort = sorted(ds_list, key=group)
+        with profile_span(profile, 'group'):
+            ds_groups = [list(it) for k, it in itertools.groupby(the_sort, group)]
 
-        if profile:
-            then = timesince(then)
-            print('after sort, before group')
+        with profile_span(profile, 'merge'):
+            # npartitons = len(ds_groups)
+            group_bag = dask.bag.from_sequence(ds_groups, npartitions=npartitions)
+            ds_list = group_bag.map(merge).compute(**session_compute_kwargs())
 
-        ds_groups = [list(it) for k, it in itertools.groupby(the_sort, group)]
+        del group_bag, ds_groups, the_sort
 
-        if profile:
-            then = timesince(then)
-            print('after group, before merge')
+    # The files are counted once, on the final merge.
+    with profile_span(profile, 'merge', n_files=n_files):
+        if have_lead_time:
+            nwm_dataset = merge_lead_time(ds_list)
+        elif have_members:
+            nwm_dataset = merge_member(ds_list)
+        else:
+            nwm_dataset = ds_list[0]
 
-        # npartitons = len(ds_groups)
-        group_bag = dask.bag.from_sequence(ds_groups, npartitions=npartitions)
-        ds_list = group_bag.map(merge).compute()
+    del ds_list
 
-        if profile:
-            then = timesince(then)
-            print('after merge')
+    # Impose some order.
+    with profile_span(profile, 'sort'):
+        if have_members:
+            nwm_dataset = nwm_dataset.sortby(['member'])
+        if have_lead_time:
+            nwm_dataset = nwm_dataset.sortby(['reference_time', 'lead_time'])
 
-        del group_bag, ds_groups, the_sort
+    return nwm_dataset
 
-    if have_lead_time:
-        nwm_dataset = merge_lead_time(ds_list)
-    elif have_members:
-        nwm_dataset = merge_member(ds_list)
+
+def add_valid_time(nwm_dataset: xr.Dataset, lazy_valid_time: bool = False):
+    """Add (in place) the valid_time of a forecast collection, as a lazy coordinate with
+    lazy_valid_time, else a data variable."""
+    valid_time = calc_valid_time(nwm_dataset, lazy=lazy_valid_time)
+    valid_time = valid_time.transpose('lead_time', 'reference_time')
+    if lazy_valid_time:
+        nwm_dataset.coords['valid_time'] = valid_time
     else:
-        nwm_dataset = ds_list[0]
+        nwm_dataset['valid_time'] = valid_time
 
-    del ds_list
 
-    # Impose some order.
-    if have_members:
-        nwm_dataset = nwm_dataset.sortby(['member'])
-    if have_lead_time:
-        nwm_dataset = nwm_dataset.sortby(['reference_time', 'lead_time'])
+def finish_whp_dataset(
+    nwm_dataset: xr.Dataset,
+    have_lead_time: bool,
+    attrs_keep: list,
+    lazy_valid_time: bool = False
+) -> xr.Dataset:
+    """Add valid_time, set fill value encodings, and clean up the global attributes of an
+    assembled collection. With lazy_valid_time, valid_time is a dask-backed coordinate
+    instead of a data variable."""
 
     # Create a valid_time variable. I'm estimating that doing it here is more efficient
     # than adding more data to the collection processes.
-    def calc_valid_time(ref, lead):
-        return np.datetime64(int(ref) + int(lead), 'ns')
     if have_lead_time:
-        nwm_dataset['valid_time'] = xr.apply_ufunc(
-            calc_valid_time,
-            nwm_dataset['reference_time'],
-            nwm_dataset['lead_time'],
-            vectorize=True
-        ).transpose()  # Not sure this is consistently anti-transposed.
+        add_valid_time(nwm_dataset, lazy_valid_time)
 
     # Xarray sets nan as the fill value when there is none. Dont allow that...
     for key, val in nwm_dataset.variables.items():
@@ -249,9 +1410,141 @@ def open_whp_dataset_inner(
 
     nwm_dataset.attrs = new_attrs
 
+    return nwm_dataset
+
+
+def open_whp_dataset_inner(
+    paths: list,
+    chunks: dict = None,
+    attrs_keep: list = ['featureType', 'proj4',
+                        'station_dimension', 'esri_pe_string',
+                        'Conventions', 'model_version'],
+    isel: dict = None,
+    drop_variables: list = None,
+    npartitions: int = None,
+    profile: Union[bool, CollectionProfile] = False,
+    assembly: str = 'concat',
+    variables: list = None,
+    feature_index: dict = None,
+    lazy_valid_time: bool = False,
+    transport: str = None,
+    convention: Union[str, CollectionConvention] = None,
+    aggregate: dict = None
+) -> xr.Dataset:
+
+    convention = get_convention(convention)
+    if assembly not in ['concat', 'block', 'raw']:
+        raise ValueError("assembly must be one of 'concat', 'block' or 'raw'.")
+    if transport not in [None, 'memmap']:
+        raise ValueError("transport must be None or 'memmap'.")
+    if transport == 'memmap' and assembly == 'raw':
+        raise ValueError("transport='memmap' does not apply to assembly='raw'.")
+    if aggregate is not None:
+        aggregate = parse_aggregate(aggregate)
+        if assembly == 'raw' or transport is not None:
+            raise ValueError("aggregate is collected by assembly 'concat' or 'block'.")
+
+    print_profile = profile is True
+    if print_profile:
+        profile = CollectionProfile()
+
+    # This is totally arbitrary be seems to work ok.
+    # if npartitions is None:
+    #     npartitions = dask.config.get('pool')._processes * 4
+    # This choice does not seem to work well or at all, error?
+    # npartitions = len(sorted(paths))
+    # Scan the member/cast conventions once per directory, not once per file.
+    with profile_span(profile, 'scan') as span:
+        file_infos = convention.scan(paths)
+        span['n_files'] = len(file_infos)
+    if len(file_infos) == 0:
+        return None
+
+    if assembly == 'raw':
+        nwm_dataset = open_whp_raw(
+            file_infos, isel=isel, drop_variables=drop_variables, npartitions=npartitions,
+            profile=profile, variables=variables, feature_index=feature_index,
+            convention=convention)
+        if nwm_dataset is None:
+            return None
+        have_lead_time = 'lead_time' in nwm_dataset.coords
+
+    elif aggregate is not None:
+        ds_list = collect_whp_aggregate(
+            file_infos, aggregate, isel=isel, drop_variables=drop_variables,
+            npartitions=npartitions, profile=profile, variables=variables,
+            feature_index=feature_index, convention=convention)
+        if ds_list is None:
+            return None
+        have_members = 'member' in ds_list[0].coords
+        have_lead_time = False
+        if assembly == 'block':
+            with profile_span(profile, 'merge', n_files=len(ds_list)):
+                nwm_dataset = assemble_whp_blocks(
+                    ds_list, block_concat_dims(have_members, have_lead_time))
+        else:
+            nwm_dataset = merge_whp_groups(
+                ds_list, have_members, have_lead_time, npartitions, profile)
+        del ds_list
+
+    elif transport == 'memmap':
+        nwm_dataset = collect_whp_memmap(
+            file_infos, isel=isel, drop_variables=drop_variables, npartitions=npartitions,
+            profile=profile, variables=variables, feature_index=feature_index,
+            convention=convention)
+        if nwm_dataset is None:
+            return None
+        have_lead_time = 'lead_time' in nwm_dataset.coords
+
+    else:
+        paths_bag = dask.bag.from_sequence(file_infos, npartitions=npartitions)
+
+        with profile_span(profile, 'gather') as span:
+            ds_list = paths_bag.map(
+                preprocess_whp_record,
+                isel=isel,
+                drop_variables=drop_variables,
+                variables=variables,
+                feature_index=feature_index,
+                profile=bool(profile),
+                convention=convention
+            ).filter(is_not_none).compute(**session_compute_kwargs())
+            span['n_files'] = len(ds_list)
+
+        if profile:
+            profile.add_worker_timings(
+                [ds.encoding.pop('profile') for ds in ds_list if 'profile' in ds.encoding])
+
+        if len(ds_list) == 0:
+            return None
+
+        # Group by and merge by choices
+        have_members = 'member' in ds_list[0].coords
+        have_lead_time = 'lead_time' in ds_list[0].coords
+
+        if assembly == 'block':
+            with profile_span(profile, 'merge', n_files=len(ds_list)):
+                nwm_dataset = assemble_whp_blocks(
+                    ds_list, block_concat_dims(have_members, have_lead_time))
+            del ds_list
+
+        else:
+            nwm_dataset = merge_whp_groups(
+                ds_list, have_members, have_lead_time, npartitions, profile)
+            del ds_list
+
+    with profile_span(profile, 'valid_time'):
+        nwm_dataset = finish_whp_dataset(
+            nwm_dataset, have_lead_time, attrs_keep, lazy_valid_time=lazy_valid_time)
+    nwm_dataset = convention.finish(nwm_dataset)
+
     # Break into chunked dask array
     if chunks is not None:
-        nwm_dataset = nwm_dataset.chunk(chunks=chunks)
+        with profile_span(profile, 'chunk'):
+            nwm_dataset = nwm_dataset.chunk(chunks=chunks)
+
+    if print_profile:
+        print(profile.report())
 
     # I submitted a PR fix to xarray.
     # I will leave this here until the PR is merged.
@@ -265,6 +1558,83 @@ def open_whp_dataset_inner(
     return nwm_dataset
 
 
+def warm_collection_worker():
+    # Pay the netcdf import once per worker, not per task.
+    import netCDF4  # noqa: F401
+
+
+class CollectionSession(object):
+    """Warm collection workers which persist across file chunks and across calls of
+    open_whp_dataset (and SimulationOutput.open, EnsembleSimulation.collect,
+    CycleSimulation.open_output). The pool is started on first use and lives until
+    close(), or the end of the with block:
+        with CollectionSession(n_cores=8) as session:
+            chrtout = open_whp_dataset(chrtout_files, session=session)
+            ldasout = open_whp_dataset(ldasout_files, session=session)
+    NetCDF-C and HDF5 are not thread safe, so all the file opens and reads of a process
+    hold whp_netcdf_lock: thread workers give no read concurrency, only the preprocessing
+    and assembly of the files run in parallel. Use processes for parallel reads.
+    """
+
+    def __init__(self, n_cores: int = 1, workers: str = 'processes'):
+        """Args:
+            n_cores: The number of workers.
+            workers: 'processes' (default) or 'threads'. Threads avoid the process start up
+                and transfer of the results but the netcdf opens and reads are serialized.
+        """
+        if workers not in ['processes', 'threads']:
+            raise ValueError("workers must be 'processes' or 'threads'.")
+        self.n_cores = n_cores
+        self.workers = workers
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pool(self):
+        """The worker pool, started if not running."""
+        if self._pool is None:
+            if self.workers == 'processes':
+                self._pool = Pool(self.n_cores, initializer=warm_collection_worker)
+            else:
+                self._pool = ThreadPoolExecutor(self.n_cores)
+        return self._pool
+
+    @contextlib.contextmanager
+    def scheduler(self):
+        """A context to compute on the session's workers. The scheduler and pool are passed
+        to the compute calls of the collection in this thread (session_compute_kwargs), the
+        global dask config is not changed, so other threads are not affected (e.g. the main
+        thread while iter_whp_dataset collects in the background)."""
+        previous = session_compute_kwargs()
+        session_compute.kwargs = {'scheduler': self.workers, 'pool': self.pool}
+        try:
+            yield
+        finally:
+            session_compute.kwargs = previous
+
+    def close(self):
+        """Stop the workers. The session can be used again, it starts new workers."""
+        if self._pool is None:
+            return
+        if self.workers == 'processes':
+            self._pool.close()
+            self._pool.join()
+        else:
+            self._pool.shutdown()
+        self._pool = None
+
+    def __getstate__(self):
+        # The pool does not travel (e.g. with a pickled simulation).
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+
 def open_whp_dataset_orig(
     paths: list,
     chunks: dict = None,
@@ -274,16 +1644,31 @@ def open_whp_dataset_orig(
     isel: dict = None,
     drop_variables: list = None,
     npartitions: int = None,
-    profile: int = False,
-    n_cores: int = 1
+    profile: Union[bool, CollectionProfile] = False,
+    n_cores: int = 1,
+    assembly: str = 'concat',
+    session: CollectionSession = None,
+    variables: list = None,
+    feature_ids: list = None,
+    lazy_valid_time: bool = False
 ) -> xr.Dataset:
 
     import sys
     import os
 
     # print('n_cores', str(n_cores))
-    the_pool = Pool(n_cores)
-    with dask.config.set(scheduler='processes', pool=the_pool):
+    if session is None:
+        with CollectionSession(n_cores) as session:
+            return open_whp_dataset_orig(
+                paths, chunks, attrs_keep, isel, drop_variables, npartitions,
+                profile, n_cores, assembly, session, variables, feature_ids,
+                lazy_valid_time)
+
+    feature_index = None
+    if feature_ids is not None:
+        feature_index = feature_id_index(paths, feature_ids)
+
+    with session.scheduler():
         whp_ds = open_whp_dataset_inner(
             paths,
             chunks,
@@ -291,12 +1676,945 @@ def open_whp_dataset_orig(
             isel,
             drop_variables,
             npartitions,
-            profile
+            profile,
+            assembly,
+            variables,
+            feature_index,
+            lazy_valid_time
         )
-    the_pool.close()
     return whp_ds
 
 
+# The variable encodings carried from the netcdf files to a zarr store.
+zarr_encoding_keys = ['units', 'calendar', 'dtype', '_FillValue', 'scale_factor', 'add_offset']
+
+
+# The dtypes of the assembly coordinates.
+whp_key_dtypes = {
+    'member': 'int64', 'time': 'datetime64[ns]',
+    'reference_time': 'datetime64[ns]', 'lead_time': 'timedelta64[ns]'}
+
+
+def plan_whp_grid(file_infos: list, concat_dims: list) -> tuple:
+    """The block assembly grid planned from the file and directory names, before any file
+    is opened.
+    Args:
+        file_infos: Records from scan_whp_files.
+        concat_dims: The assembly dimensions, from block_concat_dims.
+    Returns:
+        Tuple of (keys, index, positions, any_holes): the per-file coordinate values along
+        each of the concat_dims, the grid and file positions of block_grid and if some
+        grid slots have no file.
+    """
+    keys = {}
+    for dim in concat_dims:
+        keys[dim] = [info[dim] for info in file_infos]
+        if any(key is None for key in keys[dim]):
+            raise ValueError(
+                'Can not determine the ' + dim + ' of all the files from their names or '
+                'headers.')
+        keys[dim] = np.array(keys[dim], dtype=whp_key_dtypes[dim])
+    index, positions = block_grid(keys, concat_dims)
+    grid_shape = tuple(len(index[dim]) for dim in concat_dims)
+    slots = np.ravel_multi_index(
+        tuple(positions[dim] for dim in concat_dims), grid_shape)
+    any_holes = len(np.unique(slots)) < int(np.prod(grid_shape))
+    return keys, index, positions, any_holes
+
+
+def write_whp_region(
+    record: dict,
+    zarr_store: str,
+    layout: dict,
+    isel: dict = None,
+    drop_variables: list = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None,
+    index_coords: dict = None
+) -> int:
+    """Preprocess one file and write it into its region of a zarr store initialized by
+    collect_whp_zarr. Runs in the collection workers.
+    Args:
+        record: Dict with the file_info (from scan_whp_files) of the file and its
+            file_keys (coordinate values) and file_positions on the assembly dimensions.
+        zarr_store: The zarr store.
+        layout: The output variables, from block_layout.
+        isel: Dictionary of positional (dimension) indices to select from each file.
+        drop_variables: List of variables to drop from each file.
+        variables: List of the variables to open from each file.
+        feature_index: The feature selection, from ioutils.feature_id_index.
+        convention: The file convention, see CollectionConvention.
+        index_coords: The index coordinates of the template file, from block_index_coords.
+    Returns:
+        1 if the file was written, 0 if it could not be opened.
+    """
+    file_info = record['file_info']
+    file_positions = record['file_positions']
+    ds = preprocess_whp_data(
+        file_info['path'], isel=isel, drop_variables=drop_variables, file_info=file_info,
+        variables=variables, feature_index=feature_index, convention=convention)
+    if ds is None:
+        return 0
+
+    # The grid comes from the file and directory names, make sure the data agree.
+    for dim, key in record['file_keys'].items():
+        if block_key(ds, dim) != key:
+            raise ValueError(
+                'The ' + dim + ' of ' + str(file_info['path']) + ' does not match its name.')
+    if index_coords is not None:
+        check_block_index(ds, index_coords, file_info['path'])
+
+    slab = collections.OrderedDict()
+    for name, spec in layout.items():
+        if name not in ds.variables:
+            continue
+        file_var = ds.variables[name]
+        file_var = file_var.transpose(*[dd for dd in spec['dims'] if dd in file_var.dims])
+        # Keep the (length one) assembly dimensions in the slab.
+        shape = tuple(
+            1 if dd in file_positions else spec['shape'][ii]
+            for ii, dd in enumerate(spec['dims']))
+        values = file_var.values.reshape(shape).astype(spec['dtype'])
+        slab[name] = xr.Variable(spec['dims'], values)
+
+    region = {dim: slice(pos, pos + 1) for dim, pos in file_positions.items()}
+    xr.Dataset(slab).to_zarr(zarr_store, region=region)
+    return 1
+
+
+def collect_whp_zarr(
+    paths: list,
+    zarr_store: Union[str, pathlib.Path],
+    chunks: dict = None,
+    attrs_keep: list = None,
+    isel: dict = None,
+    drop_variables: list = None,
+    npartitions: int = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
+) -> xr.Dataset:
+    """Collect wrf-hydro output files into a chunked zarr store. The grid is planned from the
+    file and directory names (scan_whp_files) and the variables from the first file, the
+    store metadata are written, and then each worker writes its files straight into their
+    regions of the store. Nothing is gathered in the calling process. Run it under a dask
+    scheduler/pool as open_whp_dataset does.
+    Args:
+        paths: List of file paths to wrf-hydro netcdf output files.
+        zarr_store: The path of the zarr store to (over)write.
+        chunks: Chunk sizes for the dimensions which are not assembled (e.g. feature_id).
+            The assembly dimensions (member, reference_time, lead_time or time) are chunked
+            one file per chunk, so that workers never write the same chunk.
+        attrs_keep: A list of the global attributes to be retained.
+        isel: Dictionary of positional (dimension) indices to select from each file.
+        drop_variables: List of variables to drop from each file.
+        npartitions: The number of dask.bag partitions.
+        variables: List of the variables to open from each file.
+        feature_index: The feature selection, from ioutils.feature_id_index.
+        convention: The file convention, see CollectionConvention.
+    Returns:
+        The xarray dataset lazily opened from the store, None if there were no files.
+    """
+    import dask.array
+
+    zarr_store = str(zarr_store)
+    convention = get_convention(convention)
+    file_infos = convention.file_keys(convention.scan(paths))
+
+    # The first file that opens gives the variables.
+    template_ds = None
+    for info in file_infos:
+        template_ds = preprocess_whp_data(
+            info['path'], isel=isel, drop_variables=drop_variables, file_info=info,
+            variables=variables, feature_index=feature_index, convention=convention)
+        if template_ds is not None:
+            break
+    if template_ds is None:
+        return None
+
+    have_members = 'member' in template_ds.coords
+    have_lead_time = 'lead_time' in template_ds.coords
+    concat_dims = block_concat_dims(have_members, have_lead_time)
+    keys, index, positions, any_holes = plan_whp_grid(file_infos, concat_dims)
+
+    template = collections.OrderedDict(
+        (name, (var, name in template_ds.coords))
+        for name, var in template_ds.variables.items() if name not in concat_dims)
+    layout, static = block_layout(
+        template, concat_dims, index, {name: any_holes for name in template})
+
+    # Initialize the store: coordinates are written now, the (dask) data later by region.
+    if chunks is None:
+        chunks = {}
+    out_vars = collections.OrderedDict()
+    out_coords = collections.OrderedDict()
+    for name, spec in layout.items():
+        var = template[name][0]
+        if spec['dtype'].kind == 'O':
+            # Zarr can not hold the NaN holes of (promoted) character variables, they are
+            # left empty instead.
+            spec['dtype'] = var.dtype
+            spec['fill_value'] = None
+        var_chunks = tuple(
+            1 if dd in concat_dims else chunks.get(dd, size)
+            for dd, size in zip(spec['dims'], spec['shape']))
+        fill_value = spec['fill_value']
+        if fill_value is None or spec['dtype'].kind not in 'fc':
+            fill_value = 0
+        data = dask.array.full(
+            spec['shape'], fill_value, dtype=spec['dtype'], chunks=var_chunks)
+        encoding = {
+            key: val for key, val in var.encoding.items() if key in zarr_encoding_keys}
+        if spec['fill_value'] is not None:
+            encoding = {'_FillValue': spec['fill_value']}
+        new_var = xr.Variable(spec['dims'], data, attrs=var.attrs, encoding=encoding)
+        if spec['is_coord']:
+            out_coords[name] = new_var
+        else:
+            out_vars[name] = new_var
+    for dim in concat_dims:
+        dim_var = template_ds.variables[dim]
+        out_coords[dim] = xr.Variable(
+            dim, index[dim], attrs=dim_var.attrs,
+            encoding={
+                key: val for key, val in dim_var.encoding.items()
+                if key in zarr_encoding_keys})
+    for name, var in static.items():
+        static[name] = xr.Variable(
+            var.dims, var.values, attrs=var.attrs,
+            encoding={
+                key: val for key, val in var.encoding.items() if key in zarr_encoding_keys})
+
+    store_ds = xr.Dataset(
+        out_vars, coords={**out_coords, **static}, attrs=template_ds.attrs)
+    store_ds = finish_whp_dataset(store_ds, have_lead_time, attrs_keep)
+    store_ds.to_zarr(zarr_store, mode='w', compute=False)
+    index_coords = block_index_coords(template_ds, concat_dims)
+    del store_ds, template_ds
+
+    records = [
+        {'file_info': info,
+         'file_keys': {dim: keys[dim][ii] for dim in concat_dims},
+         'file_positions': {dim: int(positions[dim][ii]) for dim in concat_dims}}
+        for ii, info in enumerate(file_infos)]
+    records_bag = dask.bag.from_sequence(records, npartitions=npartitions)
+    n_written = records_bag.map(
+        write_whp_region,
+        zarr_store=zarr_store,
+        layout=layout,
+        isel=isel,
+        drop_variables=drop_variables,
+        variables=variables,
+        feature_index=feature_index,
+        convention=convention,
+        index_coords=index_coords
+    ).sum().compute(**session_compute_kwargs())
+    if n_written < len(file_infos):
+        warnings.warn(
+            str(len(file_infos) - n_written) + ' files could not be opened, their ' +
+            'regions of ' + zarr_store + ' hold the fill value.')
+
+    return convention.finish(xr.open_zarr(zarr_store))
+
+
+# The dimensions a collection is assembled along, the others are space (feature) dimensions.
+whp_record_dims = ['member', 'reference_time', 'lead_time', 'time']
+
+
+def block_regions(sizes: dict, block: dict) -> list:
+    """The regions (dicts of slices) tiling sizes in blocks, in order."""
+    dims = list(sizes.keys())
+    starts = [range(0, sizes[dd], block[dd]) for dd in dims]
+    return [
+        {dd: slice(ss, min(ss + block[dd], sizes[dd])) for dd, ss in zip(dims, start)}
+        for start in itertools.product(*starts)]
+
+
+def rechunk_block(sizes: dict, space_dims: list, itemsize: int, max_mem: int) -> dict:
+    """The largest block over the record dimensions of a variable, full on its space
+    dimensions, which fits in max_mem. Grown from the innermost dimension."""
+    budget = max_mem // (itemsize * int(np.prod([sizes[dd] for dd in space_dims])))
+    if budget < 1:
+        raise ValueError(
+            'A single record over ' + str(space_dims) + ' does not fit in max_mem.')
+    block = {dd: sizes[dd] for dd in space_dims}
+    for dd in reversed([dd for dd in sizes if dd not in space_dims]):
+        block[dd] = max(min(sizes[dd], budget), 1)
+        budget = budget // block[dd]
+    return block
+
+
+def copy_regions(
+    source: xr.Variable,
+    name: str,
+    store: str,
+    regions: list
+) -> None:
+    """Copy the regions of a variable into the same regions of a zarr store, one read
+    (and write) per region."""
+    for region in regions:
+        values = source[region].values
+        xr.Dataset({name: xr.Variable(source.dims, values)}).to_zarr(store, region=region)
+
+
+def rechunk_whp_dataset(
+    source: Union[xr.Dataset, str, pathlib.Path],
+    target_store: Union[str, pathlib.Path],
+    chunks: dict = None,
+    space_chunk: int = 100,
+    max_mem: Union[int, str] = '1GB',
+    temp_store: Union[str, pathlib.Path] = None
+) -> xr.Dataset:
+    """Write a feature-major copy of a collection to a zarr store, for reading long time
+    series of a few features (e.g. gages). Collections are chunked as their files, one
+    time with all the features per chunk, so reading one feature touches every chunk. The
+    copy has chunks of all the times (member, reference_time, lead_time, time) and few
+    features (feature_id, or the other space dimensions).
+    Memory is bounded by max_mem. When a row of target chunks (their times by all the
+    features) fits, it is read and written in one pass. Otherwise the source is first
+    copied to an intermediate store in blocks of as many times as fit, chunked as the
+    target over the space dimensions, and the target chunks are then read from it.
+    Args:
+        source: A collected dataset (e.g. from open_whp_dataset) or the path of a zarr store
+            of one (e.g. its zarr_store).
+        target_store: The path of the zarr store to (over)write.
+        chunks: The target chunk sizes by dimension. The record dimensions default to their
+            full length and the space dimensions to space_chunk.
+        space_chunk: The default chunk size of the space dimensions.
+        max_mem: Bytes, or a string such as '1GB', held by a read at a time.
+        temp_store: The path of the intermediate zarr store, removed at the end. By
+            default, target_store with a .tmp suffix.
+    Returns:
+        The xarray dataset lazily opened from the target store.
+    """
+    import dask.array
+    import shutil
+
+    if not isinstance(source, xr.Dataset):
+        source = xr.open_zarr(str(source))
+    target_store = str(target_store)
+    if temp_store is None:
+        temp_store = target_store + '.tmp'
+    temp_store = str(temp_store)
+    if isinstance(max_mem, str):
+        max_mem = dask.utils.parse_bytes(max_mem)
+    if chunks is None:
+        chunks = {}
+
+    def target_chunks(var):
+        return {
+            dd: min(chunks.get(dd, size if dd in whp_record_dims else space_chunk), size)
+            for dd, size in zip(var.dims, var.shape)}
+
+    # The variables over both record and space dimensions are rechunked, the others are
+    # small and written with the metadata.
+    rechunk = collections.OrderedDict()
+    out_vars = collections.OrderedDict()
+    for name, var in source.variables.items():
+        encoding = {
+            key: val for key, val in var.encoding.items() if key in zarr_encoding_keys}
+        space_dims = [dd for dd in var.dims if dd not in whp_record_dims]
+        if len(space_dims) == 0 or len(space_dims) == len(var.dims):
+            out_vars[name] = xr.Variable(
+                var.dims, var.values, attrs=var.attrs, encoding=encoding)
+            continue
+        rechunk[name] = space_dims
+        var_chunks = target_chunks(var)
+        data = dask.array.zeros(
+            var.shape, dtype=var.dtype, chunks=tuple(var_chunks[dd] for dd in var.dims))
+        out_vars[name] = xr.Variable(var.dims, data, attrs=var.attrs, encoding=encoding)
+    coord_names = [name for name in out_vars if name in source.coords]
+    target_ds = xr.Dataset(out_vars, attrs=source.attrs).set_coords(coord_names)
+    target_ds.to_zarr(target_store, mode='w', compute=False)
+    del target_ds
+
+    for name, space_dims in rechunk.items():
+        var = source.variables[name]
+        sizes = dict(zip(var.dims, var.shape))
+        var_chunks = target_chunks(var)
+        itemsize = var.dtype.itemsize
+        row = {dd: sizes[dd] if dd in space_dims else var_chunks[dd] for dd in var.dims}
+        if itemsize * np.prod(list(row.values())) <= max_mem:
+            # One pass: rows of target chunks.
+            copy_regions(var, name, target_store, block_regions(sizes, row))
+            continue
+
+        if itemsize * np.prod(list(var_chunks.values())) > max_mem:
+            raise ValueError(
+                'The target chunks of ' + name + ' do not fit in max_mem, use smaller chunks.')
+        # Two passes: blocks of times into the intermediate store, then the target chunks
+        # out of it.
+        block = rechunk_block(sizes, space_dims, itemsize, max_mem)
+        temp_chunks = {dd: var_chunks[dd] if dd in space_dims else block[dd] for dd in var.dims}
+        temp_data = dask.array.zeros(
+            var.shape, dtype=var.dtype, chunks=tuple(temp_chunks[dd] for dd in var.dims))
+        xr.Dataset({name: xr.Variable(var.dims, temp_data)}).to_zarr(
+            temp_store, mode='w', compute=False)
+        copy_regions(var, name, temp_store, block_regions(sizes, block))
+        temp_var = xr.open_zarr(temp_store)[name].variable
+        copy_regions(temp_var, name, target_store, block_regions(sizes, var_chunks))
+        shutil.rmtree(temp_store)
+
+    return xr.open_zarr(target_store)
+
+
+def write_whp_slot(
+    record: dict,
+    layout: dict,
+    isel: dict = None,
+    drop_variables: list = None,
+    variables: list = None,
+    feature_index: dict = None,
+    profile: bool = False,
+    convention: Union[str, CollectionConvention] = None,
+    index_coords: dict = None
+) -> dict:
+    """Preprocess one file and write its (decoded) values into its slots of the memory
+    mapped arrays of collect_whp_memmap. Runs in the collection workers.
+    Args:
+        record: Dict with the file_info (from scan_whp_files) of the file and its
+            file_keys (coordinate values) and file_positions on the assembly dimensions.
+        layout: The output variables, from block_layout, with the 'memmap' path of each
+            array (None for the variables returned instead).
+        index_coords: The index coordinates of the template file, from block_index_coords.
+        Others: As for preprocess_whp_data.
+    Returns:
+        A small dict with the file_positions, the names of the variables written, the
+        values of the variables not memory mapped (characters) and the profile timings.
+        None if the file could not be opened.
+    """
+    file_info = record['file_info']
+    file_positions = record['file_positions']
+    ds = preprocess_whp_data(
+        file_info['path'], isel=isel, drop_variables=drop_variables, file_info=file_info,
+        variables=variables, feature_index=feature_index, profile=profile,
+        convention=convention)
+    if ds is None:
+        return None
+
+    # The grid comes from the file and directory names, make sure the data agree.
+    for dim, key in record['file_keys'].items():
+        if block_key(ds, dim) != key:
+            raise ValueError(
+                'The ' + dim + ' of ' + str(file_info['path']) + ' does not match its name.')
+    if index_coords is not None:
+        check_block_index(ds, index_coords, file_info['path'])
+
+    result = {
+        'file_positions': file_positions, 'written': [], 'values': {},
+        'profile': ds.encoding.pop('profile', None)}
+    for name, spec in layout.items():
+        if name not in ds.variables:
+            continue
+        file_var = ds.variables[name]
+        file_var = file_var.transpose(*[dd for dd in spec['dims'] if dd in file_var.dims])
+        if spec['memmap'] is None:
+            result['values'][name] = (file_var.dims, file_var.values)
+        else:
+            data = np.load(spec['memmap'], mmap_mode='r+')
+            data[block_slot(file_var, spec['dims'], file_positions)] = file_var.values
+            del data
+        result['written'].append(name)
+    return result
+
+
+def collect_whp_memmap(
+    file_infos: list,
+    scratch_dir: Union[str, pathlib.Path] = None,
+    isel: dict = None,
+    drop_variables: list = None,
+    npartitions: int = None,
+    profile: CollectionProfile = None,
+    variables: list = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
+) -> xr.Dataset:
+    """Block assembly where the workers write the decoded values of their files straight
+    into the output arrays, instead of returning them. The grid is planned from the file and
+    directory names (as collect_whp_zarr) and the variables from the first file, the output
+    arrays are preallocated as memory mapped .npy files in a scratch directory, and the
+    workers only return small descriptors. The files are unlinked once mapped by the
+    calling process, so the memory is released with the dataset. Character variables are
+    returned by the workers. Run it under a dask scheduler/pool as open_whp_dataset does.
+    Args:
+        file_infos: Records from scan_whp_files.
+        scratch_dir: Where the scratch directory is made. By default /dev/shm (shared
+            memory) when it exists, else the temporary directory.
+        Others: As for preprocess_whp_data.
+    Returns:
+        The assembled dataset (before finish_whp_dataset), None if no file opens.
+    """
+    import shutil
+    import tempfile
+
+    file_infos = get_convention(convention).file_keys(file_infos)
+    with profile_span(profile, 'template'):
+        template_ds = None
+        for info in file_infos:
+            template_ds = preprocess_whp_data(
+                info['path'], isel=isel, drop_variables=drop_variables, file_info=info,
+                variables=variables, feature_index=feature_index, convention=convention)
+            if template_ds is not None:
+                break
+        if template_ds is None:
+            return None
+
+    concat_dims = block_concat_dims(
+        'member' in template_ds.coords, 'lead_time' in template_ds.coords)
+    keys, index, positions, any_holes = plan_whp_grid(file_infos, concat_dims)
+    grid_shape = tuple(len(index[dim]) for dim in concat_dims)
+    template = collections.OrderedDict(
+        (name, (var, name in template_ds.coords))
+        for name, var in template_ds.variables.items() if name not in concat_dims)
+    layout, static = block_layout(
+        template, concat_dims, index, {name: any_holes for name in template})
+
+    if scratch_dir is None and os.path.isdir('/dev/shm'):
+        scratch_dir = '/dev/shm'
+    scratch = tempfile.mkdtemp(prefix='whp_memmap_', dir=scratch_dir)
+    try:
+        out_data = collections.OrderedDict()
+        for ii, (name, spec) in enumerate(layout.items()):
+            if spec['dtype'].kind not in 'biufcmM':
+                spec['memmap'] = None
+                data = np.empty(spec['shape'], dtype=spec['dtype'])
+            else:
+                spec['memmap'] = os.path.join(scratch, 'variable_' + str(ii) + '.npy')
+                data = np.lib.format.open_memmap(
+                    spec['memmap'], mode='w+', dtype=spec['dtype'], shape=spec['shape'])
+            if spec['fill_value'] is not None:
+                data[...] = spec['fill_value']
+            out_data[name] = data
+            del data
+
+        records = [
+            {'file_info': info,
+             'file_keys': {dim: keys[dim][ii] for dim in concat_dims},
+             'file_positions': {dim: int(positions[dim][ii]) for dim in concat_dims}}
+            for ii, info in enumerate(file_infos)]
+        records_bag = dask.bag.from_sequence(records, npartitions=npartitions)
+        with profile_span(profile, 'gather') as span:
+            results = records_bag.map(
+                write_whp_slot,
+                layout=layout,
+                isel=isel,
+                drop_variables=drop_variables,
+                variables=variables,
+                feature_index=feature_index,
+                profile=bool(profile),
+                convention=convention,
+                index_coords=block_index_coords(template_ds, concat_dims)
+            ).filter(is_not_none).compute(**session_compute_kwargs())
+            span['n_files'] = len(results)
+        if len(results) == 0:
+            return None
+        if profile:
+            profile.add_worker_timings(
+                [result['profile'] for result in results if result['profile'] is not None])
+
+        with profile_span(profile, 'merge', n_files=len(results)):
+            filled = {name: np.zeros(grid_shape, dtype=bool) for name in layout}
+            for result in results:
+                grid_slot = tuple(result['file_positions'][dim] for dim in concat_dims)
+                for name in result['written']:
+                    filled[name][grid_slot] = True
+                for name, (dims, values) in result['values'].items():
+                    file_var = xr.Variable(dims, values)
+                    out_data[name][block_slot(
+                        file_var, layout[name]['dims'], result['file_positions'])] = values
+            del results
+
+            out_vars = collections.OrderedDict()
+            out_coords = collections.OrderedDict()
+            for name, spec in layout.items():
+                data = out_data[name]
+                if spec['memmap'] is not None:
+                    # Copy on write, the dataset can not change the shared pages.
+                    data = np.load(spec['memmap'], mmap_mode='c')
+                var = template[name][0]
+                new_var = xr.Variable(spec['dims'], data, attrs=var.attrs, encoding=var.encoding)
+                # Files which did not open (or lacked the variable) in a planned grid.
+                if spec['fill_value'] is None and not filled[name].all():
+                    new_var = fill_block_holes(new_var, filled[name], concat_dims)
+                if spec['is_coord']:
+                    out_coords[name] = new_var
+                else:
+                    out_vars[name] = new_var
+            del out_data
+    finally:
+        # The mapped files are kept (by the dataset) until they are released.
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for dim in concat_dims:
+        # In the files' dtype (e.g. the time resolution of restart files).
+        dim_var = template_ds.variables[dim]
+        out_coords[dim] = xr.Variable(
+            dim, index[dim].astype(dim_var.dtype), attrs=dim_var.attrs,
+            encoding=dim_var.encoding)
+
+    return xr.Dataset(
+        out_vars, coords={**out_coords, **static}, attrs=template_ds.attrs)
+
+
+def cumulative_files_path(write_cumulative_file: pathlib.Path) -> pathlib.Path:
+    """The .files.pkl sidecar listing the files collected into a cumulative file."""
+    write_cumulative_file = pathlib.Path(write_cumulative_file)
+    return write_cumulative_file.parent / (write_cumulative_file.stem + '.files.pkl')
+
+
+def whp_record_dim(ds: xr.Dataset) -> str:
+    """The dimension a collection grows along: reference_time for cycles, else time."""
+    if 'lead_time' in ds.coords:
+        return 'reference_time'
+    return 'time'
+
+
+class MemoryBudget(object):
+    """Sizes the file chunks of a collection so that the parent process stays under a
+    memory limit. The decoded size of a file is first estimated from the (lazily opened)
+    variables of the first file and then measured on each collected chunk. The next chunk is
+    sized from the memory left, so the workers are only handed as many files as the parent
+    can take back.
+    """
+
+    # Parent memory per file of a chunk, relative to its decoded size: the datasets
+    # returned by the workers, the assembled chunk and its merge into the collection.
+    chunk_factor = 3
+
+    def __init__(
+        self,
+        memory_limit: Union[int, str],
+        file_infos: list,
+        isel: dict = None,
+        drop_variables: list = None,
+        variables: list = None,
+        feature_index: dict = None,
+        convention: Union[str, CollectionConvention] = None
+    ):
+        """Args:
+            memory_limit: Bytes, or a string such as '4GB'.
+            file_infos: Records from scan_whp_files, the first which opens is measured.
+            isel, drop_variables, variables, feature_index, convention: As for
+                preprocess_whp_data.
+        """
+        if isinstance(memory_limit, str):
+            memory_limit = dask.utils.parse_bytes(memory_limit)
+        self.memory_limit = memory_limit
+        self.file_nbytes = None
+        for info in file_infos:
+            ds = preprocess_whp_record(
+                info, isel=isel, drop_variables=drop_variables, variables=variables,
+                feature_index=feature_index, convention=convention)
+            if ds is not None:
+                self.file_nbytes = max(ds.nbytes, 1)
+                ds.close()
+                break
+        self.warned = False
+
+    def chunk_size(self, collected_nbytes: int = 0) -> int:
+        """The number of files to collect next.
+        Args:
+            collected_nbytes: The size of the collection so far, which is copied when the
+                next chunk is merged into it.
+        """
+        if self.file_nbytes is None:
+            return 1
+        gc.collect()
+        rss = process_rss()
+        if rss is None:
+            rss = 0
+        available = self.memory_limit - rss - collected_nbytes
+        n_files = int(available // (self.chunk_factor * self.file_nbytes))
+        if n_files < 1:
+            if not self.warned:
+                warnings.warn(
+                    'The collection exceeds the memory_limit, continuing one file at a time. '
+                    'Consider write_cumulative_file with append or zarr_store.')
+                self.warned = True
+            n_files = 1
+        return n_files
+
+    def update(self, ds_chunk: xr.Dataset, n_chunk_files: int):
+        """Measure the decoded size per file on a collected chunk."""
+        if ds_chunk is not None and n_chunk_files > 0:
+            self.file_nbytes = max(ds_chunk.nbytes // n_chunk_files, 1)
+
+
+def plan_record_chunks(file_infos: list, file_chunk_size: int) -> list:
+    """Split scanned files into chunks of about file_chunk_size files which never split a
+    record (a cast for cycles or a time for simulations and ensembles) across chunks,
+    in record order.
+    Args:
+        file_infos: Records from scan_whp_files.
+        file_chunk_size: The target number of files per chunk.
+    Returns:
+        A list of lists of file records.
+    """
+    def record_key(info):
+        if info['cast_dir'] is not None or info['lead_time'] is not None:
+            return info['reference_time']
+        if info['time'] is None:
+            raise ValueError(
+                'Can not determine the time of file ' + str(info['path']) +
+                ' from its name or header')
+        return info['time']
+
+    records = collections.OrderedDict()
+    for info in sorted(file_infos, key=record_key):
+        records.setdefault(record_key(info), []).append(info)
+
+    file_chunks = [[]]
+    for record_infos in records.values():
+        if len(file_chunks[-1]) and \
+           len(file_chunks[-1]) + len(record_infos) > file_chunk_size:
+            file_chunks.append([])
+        file_chunks[-1] += record_infos
+    return [chunk for chunk in file_chunks if len(chunk)]
+
+
+def append_whp_dataset(
+    ds_chunk: xr.Dataset,
+    write_cumulative_file: pathlib.Path,
+    record_dim: str
+) -> None:
+    """Append the new records of a collected chunk to a cumulative netcdf file (along its
+    unlimited record dimension) or Zarr store (paths ending in .zarr), creating it if
+    needed. Records already in the file are not written again and only the variables with
+    the record dimension are written after the first chunk.
+    Args:
+        ds_chunk: The collected chunk.
+        write_cumulative_file: The netcdf file or Zarr store.
+        record_dim: The dimension to append along, see whp_record_dim.
+    """
+    write_cumulative_file = pathlib.Path(write_cumulative_file)
+    is_zarr = write_cumulative_file.suffix == '.zarr'
+
+    if not write_cumulative_file.exists():
+        if not write_cumulative_file.parent.exists():
+            write_cumulative_file.parent.mkdir()
+        # Fix the time units so later records can be encoded the same way.
+        for key, val in ds_chunk.variables.items():
+            if val.dtype.kind == 'M' and record_dim in val.dims:
+                val.encoding.update(
+                    {'units': 'minutes since 1970-01-01 00:00:00', 'dtype': 'int64'})
+        if is_zarr:
+            ds_chunk.to_zarr(str(write_cumulative_file), mode='w')
+        else:
+            ds_chunk.to_netcdf(write_cumulative_file, unlimited_dims=[record_dim])
+        return None
+
+    if is_zarr:
+        existing = xr.open_zarr(str(write_cumulative_file))
+    else:
+        existing = xr.open_dataset(write_cumulative_file)
+    with existing:
+        for dim in ds_chunk.dims:
+            if dim == record_dim:
+                continue
+            same = dim in existing.dims and existing.sizes[dim] == ds_chunk.sizes[dim]
+            if same and dim in ds_chunk.coords and dim in existing.coords:
+                same = np.array_equal(existing[dim].values, ds_chunk[dim].values)
+            if not same:
+                raise ValueError(
+                    'Can not append to ' + str(write_cumulative_file) + ', the ' + dim +
+                    ' dimension differs from the existing file.')
+        is_new = ~np.isin(ds_chunk[record_dim].values, existing[record_dim].values)
+        if is_new.any() and \
+           ds_chunk[record_dim].values[is_new].min() < existing[record_dim].values.max():
+            warnings.warn(
+                'Appending ' + record_dim + ' records to ' + str(write_cumulative_file) +
+                ' which precede its existing records, the result is not sorted.')
+        encodings = {key: existing[key].encoding for key in existing.variables}
+        n_existing = existing.sizes[record_dim]
+
+    ds_chunk = ds_chunk.isel({record_dim: np.where(is_new)[0]})
+    if ds_chunk.sizes[record_dim] == 0:
+        return None
+    ds_chunk = ds_chunk.drop_vars(
+        [key for key, val in ds_chunk.variables.items() if record_dim not in val.dims])
+
+    if is_zarr:
+        ds_chunk.to_zarr(str(write_cumulative_file), append_dim=record_dim)
+        return None
+
+    import netCDF4
+    n_new = ds_chunk.sizes[record_dim]
+    with netCDF4.Dataset(str(write_cumulative_file), mode='a') as nc:
+        nc.set_auto_maskandscale(False)
+        for key, val in ds_chunk.variables.items():
+            # Encode (units, dtype, fill, scale) exactly as the existing variable. Values
+            # read without mask_and_scale keep their fill and scale in their attributes.
+            val = val.copy(deep=False)
+            val.encoding = {
+                att: value for att, value in encodings[key].items() if att not in val.attrs}
+            encoded = xr.conventions.encode_cf_variable(val, name=key)
+            if encoded.attrs.get('units') != getattr(nc.variables[key], 'units', None):
+                raise ValueError(
+                    'Can not append ' + key + ' to ' + str(write_cumulative_file) +
+                    ' in its existing units.')
+            slot = tuple(
+                slice(n_existing, n_existing + n_new) if dim == record_dim else slice(None)
+                for dim in encoded.dims)
+            nc.variables[key][slot] = encoded.values
+    return None
+
+
+def cache_token(value):
+    """A repr-able, content-complete form of a collection argument (numpy arrays are
+    truncated by repr)."""
+    if isinstance(value, dict):
+        return sorted((str(key), cache_token(val)) for key, val in value.items())
+    if isinstance(value, (list, tuple, np.ndarray, pd.Index)):
+        return [cache_token(val) for val in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class CollectionCache(object):
+    """An on-disk cache of collected datasets, see the cache argument of open_whp_dataset.
+    Each entry is a netcdf file of a collection with a manifest of the files collected into
+    it and their (size, mtime, inode) fingerprints, keyed by the collection arguments. An
+    entry is used when its files are unchanged: as is when they are all the files asked
+    for, or extended by collecting only the new files when files were added (e.g. to a run
+    still going). Entries with a changed file are removed. The least recently used entries
+    are removed to keep the cache under max_size.
+    """
+
+    def __init__(self, cache_dir: Union[str, pathlib.Path], max_size: Union[int, str] = '20GB'):
+        """Args:
+            cache_dir: The cache directory, created if needed.
+            max_size: The maximum size of the cache in bytes, or a string such as '20GB'.
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        if isinstance(max_size, str):
+            max_size = dask.utils.parse_bytes(max_size)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def args_key(**kwargs) -> str:
+        """The hash of the collection arguments which change the collected dataset."""
+        return hashlib.sha1(repr(cache_token(kwargs)).encode()).hexdigest()[0:16]
+
+    def entries(self, args_key: str = '') -> list:
+        """The entry directories (of the args_key)."""
+        return sorted(
+            pp for pp in self.cache_dir.glob(args_key + '*-*') if not pp.name.startswith('.'))
+
+    def entry_size(self, entry: pathlib.Path) -> int:
+        return sum(pp.stat().st_size for pp in entry.iterdir())
+
+    def remove(self, entry: pathlib.Path):
+        import shutil
+        shutil.rmtree(str(entry), ignore_errors=True)
+
+    def clear(self):
+        """Remove all the entries."""
+        for entry in self.entries():
+            self.remove(entry)
+
+    def lookup(
+        self,
+        args_key: str,
+        fingerprints: dict,
+        open_kwargs: dict = {},
+        extend: bool = True
+    ) -> tuple:
+        """Find the entry with the most of the files, all unchanged and none of them extra.
+        Args:
+            args_key: From args_key.
+            fingerprints: {path: file_fingerprint} of the files asked for.
+            open_kwargs: The open_dataset kwargs of the convention, so the dataset reads
+                back as collected.
+            extend: Use an entry of only some of the files, else only one of all of them.
+        Returns:
+            (entry, dataset, new_paths): the entry and its (loaded) dataset or None and
+            None, and the paths not in the entry.
+        """
+        best = None
+        best_files = {}
+        for entry in self.entries(args_key):
+            try:
+                entry_files = pickle.load(open(str(entry / 'manifest.pkl'), 'rb'))
+            except Exception:
+                self.remove(entry)
+                continue
+            if any(fingerprints.get(path, fp) != fp for path, fp in entry_files.items()):
+                # Files of the entry were rewritten.
+                self.remove(entry)
+                continue
+            if not set(entry_files).issubset(fingerprints):
+                continue
+            if not extend and len(entry_files) != len(fingerprints):
+                continue
+            if len(entry_files) > len(best_files):
+                best = entry
+                best_files = entry_files
+
+        new_paths = [path for path in fingerprints if path not in best_files]
+        if best is None:
+            return None, None, new_paths
+
+        # Used now, for the LRU.
+        os.utime(str(best / 'manifest.pkl'))
+        with xr.open_dataset(best / 'collection.nc', **open_kwargs) as ds:
+            ds = ds.load()
+        return best, ds, new_paths
+
+    def store(
+        self,
+        args_key: str,
+        fingerprints: dict,
+        ds: xr.Dataset,
+        replaces: pathlib.Path = None
+    ) -> pathlib.Path:
+        """Store a collection of the files as an entry, then evict down to max_size.
+        Args:
+            args_key: From args_key.
+            fingerprints: {path: file_fingerprint} of the files collected.
+            ds: The collected dataset.
+            replaces: An entry this one extends, which is removed.
+        Returns:
+            The entry.
+        """
+        files_key = hashlib.sha1(
+            repr(sorted(fingerprints.items())).encode()).hexdigest()[0:16]
+        entry = self.cache_dir / (args_key + '-' + files_key)
+        # Write aside and rename, so a partial entry is never found.
+        tmp_entry = self.cache_dir / ('.tmp-' + uuid.uuid4().hex)
+        tmp_entry.mkdir()
+        try:
+            ds.to_netcdf(tmp_entry / 'collection.nc')
+            pickle.dump(fingerprints, open(str(tmp_entry / 'manifest.pkl'), 'wb'))
+            if entry.exists():
+                self.remove(entry)
+            os.rename(str(tmp_entry), str(entry))
+        finally:
+            if tmp_entry.exists():
+                self.remove(tmp_entry)
+        if replaces is not None and replaces != entry:
+            self.remove(replaces)
+        self.evict()
+        return entry
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is under max_size."""
+        if self.max_size is None:
+            return None
+        entries = [
+            (entry, (entry / 'manifest.pkl').stat().st_mtime, self.entry_size(entry))
+            for entry in self.entries() if (entry / 'manifest.pkl').exists()]
+        total = sum(size for _, _, size in entries)
+        for entry, _, size in sorted(entries, key=lambda ee: ee[1]):
+            if total <= self.max_size:
+                break
+            self.remove(entry)
+            total -= size
+        return None
+
+
 def open_whp_dataset(
     paths: list,
     file_chunk_size: int = None,
@@ -307,10 +2625,109 @@ def open_whp_dataset(
     isel: dict = None,
     drop_variables: list = None,
     npartitions: int = None,
-    profile: int = False,
+    profile: Union[bool, CollectionProfile] = False,
     n_cores: int = 1,
-    write_cumulative_file: pathlib.Path = None
+    write_cumulative_file: pathlib.Path = None,
+    assembly: str = 'concat',
+    append: bool = False,
+    zarr_store: Union[str, pathlib.Path] = None,
+    session: CollectionSession = None,
+    variables: list = None,
+    feature_ids: list = None,
+    lazy_valid_time: bool = False,
+    memory_limit: Union[int, str] = None,
+    transport: str = None,
+    convention: Union[str, CollectionConvention] = 'whp',
+    cache: Union[str, pathlib.Path, CollectionCache] = None,
+    aggregate: dict = None
 ) -> xr.Dataset:
+    """Open a multi-file wrf-hydro output dataset from a simulation, ensemble, cycle, or
+    ensemble cycle run by wrfhydropy.
+    Args:
+        paths: List of file paths to wrf-hydro netcdf output files.
+        file_chunk_size: The number of files to collect at a time, the chunks are merged.
+        chunks: chunks argument passed on to xarray DataFrame.chunk() method
+        attrs_keep: A list of the global attributes to be retained.
+        isel: Dictionary of positional (dimension) indices to select from each file.
+        drop_variables: List of variables to drop from each file.
+        npartitions: The number of dask.bag partitions.
+        profile: True to print a report of the timing spans of the collection (scan, open,
+            preprocess, gather, group, merge, sort, valid_time, chunk, cache), or a
+            ioutils.CollectionProfile to collect the spans into (see its report and to_json).
+        n_cores: The number of processes used to collect.
+        write_cumulative_file: Path of a netcdf file to (re)write after each file chunk.
+            The files collected are listed in a .files.pkl file next to it.
+        assembly: 'concat' (default) assembles files by cascaded xr.concat. 'block'
+            preallocates the output on the full member/reference_time/lead_time (or time)
+            grid and copies each file into its slot once, which is much faster and uses
+            less memory for large collections. 'raw' assembles like 'block' but only the
+            first file is opened with xarray, the workers read just the raw variable values
+            and times of the others with netCDF4 and decoding is done once on the
+            assembled arrays. For many files of one schema and feature ordering (e.g.
+            CHRTOUT, LAKEOUT, GWOUT), not restart files. With 'block' and 'raw', a file
+            whose coordinates which are not assembled (e.g. feature_id) differ from the
+            first file's raises a ValueError.
+        append: Append each file chunk's new records to write_cumulative_file instead of
+            rewriting it, along its unlimited record dimension (time, or reference_time for
+            cycles) or into a Zarr store if the path ends in .zarr. Files already listed in
+            the .files.pkl sidecar are skipped, so collection of a growing run can be
+            resumed. Chunks are formed from whole records. Each record is assumed complete
+            when it is first collected.
+        zarr_store: Path of a zarr store to collect into instead of memory. The workers
+            write their files straight into the store's regions, one chunk per file along
+            member/reference_time/lead_time (or time), chunks applies to the other
+            dimensions. See collect_whp_zarr. Requires zarr (wrfhydropy[zarr]).
+        session: A CollectionSession whose warm workers are used (n_cores is then ignored).
+            Without one, a pool of n_cores processes is used for the call (all its file
+            chunks).
+        variables: List of the variables to collect. Only these variables and their
+            coordinates are read from each file, which is much cheaper than dropping the
+            others when the files have many variables (e.g. only streamflow from CHRTOUT).
+        feature_ids: List of the feature_ids to collect (e.g. gages). The ids are resolved to
+            positions once from the first file, each file is checked to have the same
+            ordering at those positions and only they are read. The features are returned in
+            file order.
+        lazy_valid_time: Add valid_time as a lazy (dask) coordinate instead of a data
+            variable. Not used with append or zarr_store, which store valid_time.
+        memory_limit: Memory budget (bytes, or e.g. '8GB') of the calling process. When
+            file_chunk_size is not given, the files are collected in chunks sized to the
+            memory left, from the decoded size of the files (see MemoryBudget). A warning is
+            given when the collection itself does not fit.
+        transport: How the workers hand their files to the calling process. None (default)
+            returns (pickles) each file's dataset. 'memmap' plans the block assembly grid
+            from the file and directory names and has the workers write the decoded values
+            straight into preallocated memory mapped arrays (in /dev/shm when it exists),
+            returning only small descriptors, see collect_whp_memmap. The result is as for
+            assembly='block'. Not for assembly='raw'.
+        convention: The file convention, 'whp' (default, run by wrfhydropy), 'nwm'
+            (National Water Model files) or 'dart' (DART member files), or another
+            registered CollectionConvention. It gives the member and times of each file,
+            from its name or, where the options place the files before opening them
+            (transport='memmap', zarr_store, aggregate, append), its header. The options
+            apply to every convention, but aggregate is for simulations and ensembles (not
+            cycles, such as nwm forecasts) and dart files are not read by assembly='raw'.
+        cache: A CollectionCache, or its directory, to keep the collected dataset in. When
+            the same files are collected again with the same arguments (attrs_keep, isel,
+            drop_variables, variables, feature_ids, convention) and unchanged (size, mtime,
+            inode), the dataset is read from the cache. When files were added, only the new
+            ones are collected and merged with the cached dataset. The dataset is returned
+            loaded, but for the lazy valid_time coordinate of lazy_valid_time which is made
+            on the way out (the cache holds valid_time as data). Not with
+            write_cumulative_file or zarr_store, which keep the collection themselves.
+        aggregate: Collect time windows reduced in the workers instead of every output time,
+            e.g. {'freq': '1D', 'how': 'mean'} for daily means. freq is a pandas resample
+            frequency and how one of 'mean' (default), 'max', 'min' or 'sum', the result is
+            as for .resample(time=freq) of the full collection (windows without files are
+            missing values). The numeric variables along time are reduced, the others take
+            their first value in the window. The workers reduce batches of the files of a
+            member and window and their partial aggregates are combined in the calling
+            process. File chunks are formed from whole windows. For simulations and
+            ensembles with the times in the file names, not with assembly='raw',
+            transport, append or zarr_store.
+    Returns:
+        An xarray dataset. With append or zarr_store, the dataset is lazily opened from the
+        file or store.
+    """
 
     import sys
     import os
@@ -318,6 +2735,32 @@ def open_whp_dataset(
     import multiprocessing
     import pickle
 
+    if session is None or profile is True:
+        # Provide the session (for the call) and the profile (to print), then call again.
+        print_profile = profile is True
+        if print_profile:
+            profile = CollectionProfile()
+        own_session = session is None
+        if own_session:
+            session = CollectionSession(n_cores)
+        try:
+            whp_ds = open_whp_dataset(
+                paths, file_chunk_size=file_chunk_size, chunks=chunks,
+                attrs_keep=attrs_keep, isel=isel, drop_variables=drop_variables,
+                npartitions=npartitions, profile=profile, n_cores=n_cores,
+                write_cumulative_file=write_cumulative_file, assembly=assembly,
+                append=append, zarr_store=zarr_store, session=session,
+                variables=variables, feature_ids=feature_ids,
+                lazy_valid_time=lazy_valid_time, memory_limit=memory_limit,
+                transport=transport, convention=convention, cache=cache,
+                aggregate=aggregate)
+        finally:
+            if own_session:
+                session.close()
+        if print_profile:
+            print(profile.report())
+        return whp_ds
+
     n_files = len(paths)
     print('n_files', str(n_files))
 
@@ -327,12 +2770,128 @@ def open_whp_dataset(
             print("removing file since it doesn't exist:", str(p))
             paths.remove(p)
 
+    if cache is not None:
+        if write_cumulative_file is not None or zarr_store is not None:
+            raise ValueError('cache is not used with write_cumulative_file or zarr_store.')
+        if not isinstance(cache, CollectionCache):
+            cache = CollectionCache(cache)
+        args_key = cache.args_key(
+            attrs_keep=attrs_keep, isel=isel, drop_variables=drop_variables,
+            variables=variables, feature_ids=feature_ids,
+            convention=get_convention(convention).name, aggregate=aggregate)
+        with profile_span(profile, 'cache'):
+            fingerprints = {str(pp): file_fingerprint(pp) for pp in paths}
+            # New files can fall in the aggregate windows of an entry, it is not extended.
+            entry, whp_ds, new_paths = cache.lookup(
+                args_key, fingerprints, get_convention(convention).open_kwargs,
+                extend=aggregate is None)
+        if len(new_paths):
+            ds_new = open_whp_dataset(
+                [pathlib.Path(pp) for pp in new_paths], file_chunk_size=file_chunk_size,
+                attrs_keep=attrs_keep, isel=isel, drop_variables=drop_variables,
+                npartitions=npartitions, profile=profile, assembly=assembly,
+                session=session, variables=variables, feature_ids=feature_ids,
+                memory_limit=memory_limit, transport=transport, convention=convention,
+                aggregate=aggregate)
+            if whp_ds is None:
+                whp_ds = ds_new
+            elif ds_new is not None:
+                with profile_span(profile, 'merge'):
+                    whp_ds = xr.merge([whp_ds, ds_new])
+            if whp_ds is not None:
+                with profile_span(profile, 'cache'):
+                    cache.store(args_key, fingerprints, whp_ds, replaces=entry)
+        if whp_ds is not None and lazy_valid_time and 'valid_time' in whp_ds.data_vars:
+            whp_ds = whp_ds.drop_vars('valid_time')
+            add_valid_time(whp_ds, lazy_valid_time=True)
+            whp_ds['valid_time'].encoding.update({'_FillValue': None})
+        if whp_ds is not None and chunks is not None:
+            whp_ds = whp_ds.chunk(chunks=chunks)
+        return whp_ds
+
+    # Resolve the feature_ids to positions once for all the files (and file chunks).
+    feature_index = None
+    if feature_ids is not None:
+        feature_index = feature_id_index(paths, feature_ids)
+
+    memory_budget = None
+    if memory_limit is not None and file_chunk_size is None and zarr_store is None:
+        memory_budget = MemoryBudget(
+            memory_limit, get_convention(convention).scan(paths), isel=isel,
+            drop_variables=drop_variables, variables=variables, feature_index=feature_index,
+            convention=convention)
+        file_chunk_size = memory_budget.chunk_size()
+
     if file_chunk_size is None:
         file_chunk_size = n_files
 
+    if aggregate is not None and (append or zarr_store is not None):
+        raise ValueError('aggregate is not used with append or zarr_store.')
+
+    if zarr_store is not None:
+        with session.scheduler():
+            whp_ds = collect_whp_zarr(
+                paths=paths,
+                zarr_store=zarr_store,
+                chunks=chunks,
+                attrs_keep=attrs_keep,
+                isel=isel,
+                drop_variables=drop_variables,
+                npartitions=npartitions,
+                variables=variables,
+                feature_index=feature_index,
+                convention=convention
+            )
+        return whp_ds
+
+    if append:
+        if write_cumulative_file is None:
+            raise ValueError('append requires write_cumulative_file.')
+        write_cumulative_file = pathlib.Path(write_cumulative_file)
+        cumulative_files_file = cumulative_files_path(write_cumulative_file)
+
+        # Resume: skip the files already collected.
+        collected = []
+        if write_cumulative_file.exists() and cumulative_files_file.exists():
+            collected = pickle.load(open(str(cumulative_files_file), 'rb'))
+        collected_set = set(str(pp) for pp in collected)
+        new_infos = get_convention(convention).file_keys([
+            info for info in get_convention(convention).scan(paths)
+            if str(info['path']) not in collected_set])
+
+        for chunk_infos in plan_record_chunks(new_infos, file_chunk_size):
+            chunk_paths = [info['path'] for info in chunk_infos]
+            with session.scheduler():
+                ds_chunk = open_whp_dataset_inner(
+                    paths=chunk_paths,
+                    chunks=None,
+                    attrs_keep=attrs_keep,
+                    isel=isel,
+                    drop_variables=drop_variables,
+                    npartitions=npartitions,
+                    profile=profile,
+                    assembly=assembly,
+                    variables=variables,
+                    feature_index=feature_index,
+                    transport=transport,
+                    convention=convention
+                )
+
+            if ds_chunk is not None:
+                append_whp_dataset(
+                    ds_chunk, write_cumulative_file, whp_record_dim(ds_chunk))
+            del ds_chunk
+            collected = collected + chunk_paths
+            pickle.dump(collected, open(str(cumulative_files_file), 'wb'))
+
+        if not write_cumulative_file.exists():
+            return None
+        if write_cumulative_file.suffix == '.zarr':
+            return xr.open_zarr(str(write_cumulative_file), chunks=chunks)
+        return xr.open_dataset(write_cumulative_file, chunks=chunks)
+
     if file_chunk_size >= n_files:
-        the_pool = Pool(n_cores)
-        with dask.config.set(scheduler='processes', pool=the_pool):
+        with session.scheduler():
             whp_ds = open_whp_dataset_inner(
                 paths=paths,
                 chunks=chunks,
@@ -340,21 +2899,39 @@ def open_whp_dataset(
                 isel=isel,
                 drop_variables=drop_variables,
                 npartitions=npartitions,
-                profile=profile
+                profile=profile,
+                assembly=assembly,
+                variables=variables,
+                feature_index=feature_index,
+                lazy_valid_time=lazy_valid_time,
+                transport=transport,
+                convention=convention,
+                aggregate=aggregate
             )
-        the_pool.close()
+        if aggregate is not None:
+            whp_ds = fill_aggregate_windows(whp_ds, parse_aggregate(aggregate)['freq'])
 
     else:
 
-        n_file_chunks = math.ceil(n_files / file_chunk_size)
-        start_list = [file_chunk_size * ii for ii in range(n_file_chunks)]
-        end_list = [file_chunk_size * (ii + 1) - 1 for ii in range(n_file_chunks)]
-#        adsf
+        if aggregate is not None:
+            # The file chunks are formed from whole windows.
+            convention = get_convention(convention)
+            file_infos = convention.file_keys(convention.scan(paths))
+            labels = aggregate_windows(file_infos, parse_aggregate(aggregate)['freq'])
+            order = sorted(
+                range(len(file_infos)), key=lambda ii: (labels[ii], file_infos[ii]['time']))
+            paths = [file_infos[ii]['path'] for ii in order]
+            labels = [labels[ii] for ii in order]
+            n_files = len(paths)
 
         whp_ds = None
-        for start_ind, end_ind in zip(start_list, end_list):
-            the_pool = Pool(n_cores)
-            with dask.config.set(scheduler='processes', pool=the_pool):
+        start_ind = 0
+        while start_ind < n_files:
+            end_ind = min(start_ind + file_chunk_size, n_files) - 1
+            if aggregate is not None:
+                while end_ind + 1 < n_files and labels[end_ind + 1] == labels[end_ind]:
+                    end_ind += 1
+            with session.scheduler():
                 ds_chunk = open_whp_dataset_inner(
                     paths=paths[start_ind:(end_ind+1)],
                     chunks=chunks,
@@ -362,23 +2939,437 @@ def open_whp_dataset(
                     isel=isel,
                     drop_variables=drop_variables,
                     npartitions=npartitions,
-                    profile=profile
+                    profile=profile,
+                    assembly=assembly,
+                    variables=variables,
+                    feature_index=feature_index,
+                    lazy_valid_time=lazy_valid_time,
+                    transport=transport,
+                    convention=convention,
+                    aggregate=aggregate
                 )
-            the_pool.close()
 
             if ds_chunk is not None:
                 if whp_ds is None:
                     whp_ds = ds_chunk
                 else:
-                    whp_ds = xr.merge([whp_ds, ds_chunk])
+                    with profile_span(profile, 'merge'):
+                        whp_ds = xr.merge([whp_ds, ds_chunk])
+                if aggregate is not None:
+                    whp_ds = fill_aggregate_windows(
+                        whp_ds, parse_aggregate(aggregate)['freq'])
                 if write_cumulative_file is not None:
                     if not write_cumulative_file.parent.exists():
                         write_cumulative_file.parent.mkdir()
                     whp_ds.to_netcdf(write_cumulative_file)
-                    cumulative_files_file = write_cumulative_file.parent / (
-                        write_cumulative_file.stem + '.files.pkl')
+                    cumulative_files_file = cumulative_files_path(write_cumulative_file)
                     pickle.dump(
-                        paths[0:end_ind],
+                        paths[0:(end_ind+1)],
                         open(str(cumulative_files_file), 'wb'))
 
+            if memory_budget is not None:
+                memory_budget.update(ds_chunk, end_ind + 1 - start_ind)
+                del ds_chunk
+                collected_nbytes = 0 if whp_ds is None else whp_ds.nbytes
+                file_chunk_size = memory_budget.chunk_size(collected_nbytes)
+            start_ind = end_ind + 1
+
     return whp_ds
+
+
+def iter_whp_dataset(
+    paths: list,
+    by: str = None,
+    prefetch: int = 1,
+    session: CollectionSession = None,
+    n_cores: int = 1,
+    convention: Union[str, CollectionConvention] = 'whp',
+    **kwargs
+):
+    """Iterate over a collection one reference_time (cast) or member at a time, in order,
+    while the next ones are collected in the background. Each is the collection of its
+    files by open_whp_dataset, so a job over many casts holds only about prefetch + 1 of
+    them in memory:
+        for cast_ds in iter_whp_dataset(files, session=session):
+            plot(cast_ds)
+    Args:
+        paths: List of file paths to wrf-hydro netcdf output files.
+        by: 'reference_time' or 'member'. By default reference_time for cycles (and
+            ensemble cycles) and member for ensembles.
+        prefetch: The number of the next groups collected in the background.
+        session: A CollectionSession whose workers collect the groups. Without one, a
+            session of n_cores processes is used for the iteration.
+        n_cores: The number of processes of the session, without one.
+        convention: The file convention, see CollectionConvention.
+        **kwargs: Passed to open_whp_dataset (e.g. variables, isel, assembly). Not
+            write_cumulative_file, append or zarr_store.
+    Yields:
+        The xarray dataset of each reference_time or member, with that dimension of
+        length one.
+    """
+    for key in ['write_cumulative_file', 'append', 'zarr_store']:
+        if kwargs.get(key):
+            raise ValueError(key + ' is not used by iter_whp_dataset.')
+
+    file_infos = get_convention(convention).file_keys(get_convention(convention).scan(paths))
+    if by is None:
+        if any(info['reference_time'] is not None for info in file_infos):
+            by = 'reference_time'
+        elif any(info['member'] is not None for info in file_infos):
+            by = 'member'
+    if by not in ['reference_time', 'member']:
+        raise ValueError(
+            "by must be 'reference_time' or 'member', for cycles or ensembles.")
+    groups = collections.OrderedDict()
+    for info in file_infos:
+        if info[by] is None:
+            raise ValueError('The ' + by + ' of ' + str(info['path']) + ' is not known.')
+        groups.setdefault(info[by], []).append(info['path'])
+    groups = [groups[key] for key in sorted(groups)]
+
+    own_session = session is None
+    if own_session:
+        session = CollectionSession(n_cores)
+    # One background thread collects the groups ahead, on the session's workers.
+    executor = ThreadPoolExecutor(1)
+    futures = collections.deque()
+    try:
+        for group_paths in groups:
+            futures.append(executor.submit(
+                open_whp_dataset, group_paths, session=session, convention=convention,
+                **kwargs))
+            if len(futures) > prefetch:
+                yield futures.popleft().result()
+        while len(futures):
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if own_session:
+            session.close()
+
+
+def bbox_window(
+    lat: xr.DataArray,
+    lon: xr.DataArray,
+    bbox: tuple,
+    dims: tuple = None
+) -> dict:
+    """The window (of index slices) of the grid cells in a lat/lon bounding box, for
+    open_whp_restarts. Restart files have no coordinates, the lat/lon come from the domain,
+    e.g. XLAT_M/XLONG_M of the geogrid file for RESTART (south_north, west_east) or
+    LATITUDE/LONGITUDE of the Fulldom file for HYDRO_RST (iy, ix).
+    Args:
+        lat, lon: 2-D latitude and longitude of the grid, dims (y, x).
+        bbox: (min_lon, min_lat, max_lon, max_lat).
+        dims: The names of the (y, x) dimensions in the restart files, by default those of
+            lat.
+    Returns:
+        A dict of slices by dimension.
+    """
+    lat = lat.squeeze(drop=True)
+    lon = lon.squeeze(drop=True).transpose(*lat.dims)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    inside = ((lon.values >= min_lon) & (lon.values <= max_lon) &
+              (lat.values >= min_lat) & (lat.values <= max_lat))
+    if not inside.any():
+        raise ValueError('No grid cells in the bounding box ' + str(bbox))
+    if dims is None:
+        dims = lat.dims
+    window = {}
+    for axis, dim in enumerate(dims):
+        where = np.where(inside.any(axis=1 - axis))[0]
+        window[dim] = slice(int(where[0]), int(where[-1]) + 1)
+    return window
+
+
+def combine_lazy(ds_list: list, concat_dims: list) -> xr.Dataset:
+    """Concatenate (dask-backed) preprocessed files along the concat_dims, the last one
+    outermost as in the cascade of open_whp_dataset_inner. Missing files are holes."""
+    if len(concat_dims) == 0:
+        if len(ds_list) > 1:
+            raise ValueError('More than one file for the same member and times.')
+        return ds_list[0]
+    dim = concat_dims[-1]
+    groups = collections.defaultdict(list)
+    for ds in ds_list:
+        groups[block_key(ds, dim)].append(ds)
+    parts = [combine_lazy(groups[key], concat_dims[:-1]) for key in sorted(groups)]
+    return xr.concat(parts, dim=dim, coords='minimal', join='outer', compat='override')
+
+
+def open_whp_restarts(
+    paths: list,
+    variables: list = None,
+    window: dict = None,
+    chunks: dict = {},
+    attrs_keep: list = ['featureType', 'proj4',
+                        'station_dimension', 'esri_pe_string',
+                        'Conventions', 'model_version'],
+    convention: Union[str, CollectionConvention] = 'whp'
+) -> xr.Dataset:
+    """Lazily collect RESTART or HYDRO_RST files (one type at a time) across members and
+    casts (or times) into a dask-backed dataset. Only the metadata are read here, in the
+    calling process: the variables and window are selected on the lazy arrays and nothing
+    else is read until compute. For large (e.g. CONUS) restarts, where open_whp_dataset
+    would read every file in full through the workers.
+        ds = open_whp_restarts(files, variables=['SMC'], window={'south_north': (100, 200)})
+        spread = ds.SMC.std('member').compute()
+    Args:
+        paths: List of the restart files.
+        variables: List of the variables to collect, all by default.
+        window: Dictionary of index ranges, slice or (start, stop), by dimension (e.g.
+            south_north/west_east for RESTART, iy/ix or links for HYDRO_RST). Dimensions
+            a file does not have are ignored. See bbox_window for lat/lon boxes.
+        chunks: Dask chunks of each file, passed to xarray.open_dataset. The default {} is
+            a chunk per variable per file.
+        attrs_keep: A list of the global attributes to be retained.
+        convention: The file convention, see CollectionConvention.
+    Returns:
+        A dask-backed xarray dataset, None if no files could be opened.
+    """
+    convention = get_convention(convention)
+    if window is not None:
+        window = {
+            dim: val if isinstance(val, slice) else slice(*val)
+            for dim, val in window.items()}
+
+    ds_list = []
+    for info in convention.scan(paths):
+        ds = preprocess_whp_record(
+            info, variables=variables, chunks=chunks, convention=convention)
+        if ds is None:
+            continue
+        if window is not None:
+            ds = ds.isel(window, missing_dims='ignore')
+        ds_list.append(ds)
+    if len(ds_list) == 0:
+        return None
+
+    have_members = 'member' in ds_list[0].coords
+    have_lead_time = 'lead_time' in ds_list[0].coords
+    whp_ds = combine_lazy(ds_list, block_concat_dims(have_members, have_lead_time))
+    whp_ds = finish_whp_dataset(whp_ds, have_lead_time, attrs_keep, lazy_valid_time=True)
+    return convention.finish(whp_ds)
+
+
+# The index columns of the long-format (parquet) tables, those a collection has.
+whp_long_index = ['feature_id', 'reference_time', 'lead_time', 'member', 'time']
+
+
+def whp_long_frame(ds: xr.Dataset, variables: list = None, n_buckets: int = 64) -> pd.DataFrame:
+    """The long-format table of the point (feature_id) variables of a preprocessed file:
+    a row per feature with its feature_id, reference_time, lead_time and member (those the
+    file has), its (valid) time and the variables, plus the date and feature_bucket
+    (feature_id modulo n_buckets) partition columns.
+    Args:
+        ds: From preprocess_whp_data.
+        variables: The variables, by default the numeric ones over feature_id.
+        n_buckets: The number of feature_id buckets.
+    """
+    if variables is None:
+        variables = [
+            name for name, var in ds.data_vars.items()
+            if [dd for dd in var.dims if dd not in whp_record_dims] == ['feature_id'] and
+            var.dtype.kind in 'iuf']
+    feature_id = ds['feature_id'].values
+    n_features = len(feature_id)
+
+    def scalar(name):
+        return np.atleast_1d(ds[name].values)[0]
+
+    columns = collections.OrderedDict()
+    columns['feature_id'] = feature_id
+    for name in ['reference_time', 'lead_time', 'member']:
+        if name in ds.coords:
+            columns[name] = np.repeat(scalar(name), n_features)
+    if 'lead_time' in columns:
+        time = scalar('reference_time') + scalar('lead_time')
+    else:
+        time = scalar('time')
+    columns['time'] = np.repeat(np.datetime64(time, 'ns'), n_features)
+    for name in variables:
+        columns[name] = ds[name].values.reshape(n_features)
+    columns['date'] = np.repeat(str(np.datetime64(time, 'D')), n_features)
+    columns['feature_bucket'] = (feature_id % n_buckets).astype(np.int16)
+    return pd.DataFrame(columns)
+
+
+def export_parquet_batch(
+    batch: dict,
+    root: str,
+    n_buckets: int,
+    variables: list = None,
+    isel: dict = None,
+    feature_index: dict = None,
+    convention: Union[str, CollectionConvention] = None
+) -> int:
+    """Write the long-format table of a batch of files into the date and feature_bucket
+    partitions of a parquet dataset. Runs in the collection workers.
+    Returns:
+        The number of rows written.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    frames = []
+    for info in batch['infos']:
+        ds = preprocess_whp_record(
+            info, isel=isel, variables=variables, feature_index=feature_index,
+            convention=convention)
+        if ds is not None:
+            frames.append(whp_long_frame(ds, variables=variables, n_buckets=n_buckets))
+            ds.close()
+    if len(frames) == 0:
+        return 0
+    frame = pd.concat(frames, ignore_index=True)
+    del frames
+
+    # Compact types: times to the second, durations in seconds and small members.
+    arrays = collections.OrderedDict()
+    for name, values in frame.items():
+        values = values.values
+        if name in ['time', 'reference_time']:
+            values = values.astype('datetime64[s]')
+        elif name == 'lead_time':
+            values = values.astype('timedelta64[s]')
+        elif name == 'member':
+            values = values.astype(np.int16)
+        arrays[name] = pyarrow.array(values)
+    table = pyarrow.table(arrays)
+    pyarrow.parquet.write_to_dataset(
+        table, root, partition_cols=['date', 'feature_bucket'],
+        basename_template='part-' + str(batch['batch']) + '-{i}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        use_dictionary=[name for name in ['feature_id', 'member'] if name in arrays],
+        compression='zstd')
+    return table.num_rows
+
+
+def export_whp_parquet(
+    paths: list,
+    root: Union[str, pathlib.Path],
+    variables: list = None,
+    n_buckets: int = 64,
+    batch_files: int = 24,
+    isel: dict = None,
+    feature_ids: list = None,
+    npartitions: int = None,
+    session: CollectionSession = None,
+    n_cores: int = 1,
+    convention: Union[str, CollectionConvention] = 'whp'
+) -> int:
+    """Export point outputs (CHRTOUT, LAKEOUT, GWOUT, ...) to a long-format parquet dataset
+    instead of collecting them: a row per feature_id, (reference_time, lead_time, member)
+    and time with a column per variable. It is partitioned (hive style) by the date of the
+    (valid) time and a feature_id bucket, root/date=YYYY-MM-DD/feature_bucket=N/, so reads
+    of some gages or dates only touch their partitions (see read_whp_parquet). The workers
+    write their batches of files straight into the partitions, nothing is gathered in the
+    calling process. Ids are dictionary encoded, times are stored to the second. Requires
+    pyarrow.
+    Args:
+        paths: List of file paths to wrf-hydro netcdf output files.
+        root: The directory of the parquet dataset. Files are added to its partitions, so
+            export to a new (or emptied) directory.
+        variables: The variables to export, by default the numeric ones over feature_id.
+        n_buckets: The number of feature_id buckets (feature_id modulo n_buckets).
+        batch_files: The number of files written by a worker at a time.
+        isel: Dictionary of positional (dimension) indices to select from each file.
+        feature_ids: List of the feature_ids to export, see open_whp_dataset.
+        npartitions: The number of dask.bag partitions.
+        session: A CollectionSession whose workers write the batches. Without one, a pool of
+            n_cores processes is used for the call.
+        n_cores: The number of processes used, without a session.
+        convention: The file convention, see CollectionConvention.
+    Returns:
+        The number of rows written.
+    """
+    import json
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError('export_whp_parquet requires pyarrow, pip install wrfhydropy[parquet].')
+
+    if session is None:
+        with CollectionSession(n_cores) as session:
+            return export_whp_parquet(
+                paths, root, variables=variables, n_buckets=n_buckets,
+                batch_files=batch_files, isel=isel, feature_ids=feature_ids,
+                npartitions=npartitions, session=session, convention=convention)
+
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    feature_index = None
+    if feature_ids is not None:
+        feature_index = feature_id_index(paths, feature_ids)
+
+    # Batches of files in time order, so that each writes to few date partitions.
+    file_infos = get_convention(convention).scan(paths)
+    file_infos = sorted(
+        file_infos, key=lambda info: (info['reference_time'] or datetime.min,
+                                      info['time'] or datetime.min))
+    batches = [
+        {'batch': ii // batch_files, 'infos': file_infos[ii:(ii + batch_files)]}
+        for ii in range(0, len(file_infos), batch_files)]
+
+    with session.scheduler():
+        n_rows = dask.bag.from_sequence(batches, npartitions=npartitions).map(
+            export_parquet_batch,
+            root=str(root),
+            n_buckets=n_buckets,
+            variables=variables,
+            isel=isel,
+            feature_index=feature_index,
+            convention=convention
+        ).sum().compute(**session_compute_kwargs())
+
+    # What read_whp_parquet needs to find the partitions of some feature_ids (the leading
+    # underscore keeps it out of the parquet dataset).
+    with open(str(root / '_whp_parquet.json'), 'w') as meta_file:
+        json.dump({'n_buckets': n_buckets}, meta_file)
+    return n_rows
+
+
+def read_whp_parquet(
+    root: Union[str, pathlib.Path],
+    variables: list = None,
+    feature_ids: list = None,
+    start: Union[str, datetime] = None,
+    end: Union[str, datetime] = None
+) -> pd.DataFrame:
+    """Read (some of) a parquet dataset written by export_whp_parquet, only the partitions
+    of the feature_ids and dates are read. The result is indexed by feature_id,
+    reference_time, lead_time, member and time (those it has), as Evaluation joins on.
+        modeled = read_whp_parquet(root, ['streamflow'], feature_ids=gages)
+    Args:
+        root: The directory of the parquet dataset.
+        variables: The variables (columns) to read, all by default.
+        feature_ids: The feature_ids to read, all by default.
+        start, end: The first and last date (of the valid time) to read.
+    Returns:
+        A pandas DataFrame.
+    """
+    import json
+    root = pathlib.Path(root)
+    with open(str(root / '_whp_parquet.json')) as meta_file:
+        n_buckets = json.load(meta_file)['n_buckets']
+
+    filters = []
+    if feature_ids is not None:
+        feature_ids = [int(ff) for ff in feature_ids]
+        filters.append(('feature_bucket', 'in', sorted(set(ff % n_buckets for ff in feature_ids))))
+        filters.append(('feature_id', 'in', feature_ids))
+    if start is not None:
+        filters.append(('date', '>=', str(np.datetime64(pd.Timestamp(start), 'D'))))
+    if end is not None:
+        filters.append(('date', '<=', str(np.datetime64(pd.Timestamp(end), 'D'))))
+
+    columns = None
+    if variables is not None:
+        import pyarrow.parquet
+        schema = pyarrow.parquet.read_schema(next(root.glob('date=*/feature_bucket=*/*.parquet')))
+        columns = [name for name in whp_long_index if name in schema.names] + list(variables)
+    frame = pd.read_parquet(str(root), columns=columns, filters=filters or None)
+    frame = frame.drop(columns=[name for name in ['date', 'feature_bucket'] if name in frame])
+    return frame.set_index([name for name in whp_long_index if name in frame.columns])
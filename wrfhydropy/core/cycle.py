@@ -14,7 +14,9 @@ except ImportError:
 else:
     cleanup_on_sigterm()
 
+from .collection import CollectionSession, open_whp_dataset
 from .ensemble_tools import mute
+from .ioutils import InputFileCache
 from .job import Job
 from .schedulers import Scheduler
 from .simulation import Simulation
@@ -144,9 +146,11 @@ def parallel_compose_casts(arg_dict):
     os.mkdir(cast.run_dir)
     os.chdir(cast.run_dir)
     if isinstance(cast, Simulation):
-        cast.compose()
+        cast.compose(file_cache=arg_dict['file_cache'])
     else:
-        cast.compose(rm_members_from_memory=arg_dict['rm_members_from_memory'])
+        cast.compose(
+            rm_members_from_memory=arg_dict['rm_members_from_memory'],
+            file_cache=arg_dict['file_cache'])
 
     # The Simulation object clean up.
     if 'model' in dir(cast):
@@ -470,6 +474,10 @@ class CycleSimulation(object):
                 comp_dir = self._compose_dir / 'compile'
                 self._simulation.model.compile(comp_dir)
 
+        # The casts (and their members) validate the same domain files. With ncores > 1,
+        # each cast starts its own cache.
+        file_cache = InputFileCache()
+
         # Set the ensemble jobs on the casts before composing (this is a loop over the jobs).
         if self.ncores == 1:
 
@@ -483,6 +491,7 @@ class CycleSimulation(object):
                         'job': self._job,
                         'scheduler': self._scheduler,
                         'rm_members_from_memory': rm_members_from_memory,
+                        'file_cache': file_cache,
                     }
                 ) for init_time, restart_dir, forcing_dir in zip(
                     self._init_times,
@@ -506,6 +515,7 @@ class CycleSimulation(object):
                         'job': self._job,
                         'scheduler': self._scheduler,
                         'rm_members_from_memory': rm_members_from_memory,
+                        'file_cache': file_cache,
                     } for init_time, restart_dir, forcing_dir in zip(
                         self._init_times,
                         self._restart_dirs,
@@ -633,3 +643,26 @@ class CycleSimulation(object):
         path = pathlib.Path(path)
         with path.open(mode='wb') as f:
             pickle.dump(self, f, 2)
+
+    def open_output(
+        self,
+        file_glob: str,
+        session: CollectionSession = None,
+        **kwargs
+    ):
+        """Collect one type of output across the casts (and their members) of the composed
+        cycle with open_whp_dataset.
+        Args:
+            file_glob: The glob of the output files in the run dirs, e.g. '*CHRTOUT_DOMAIN1'.
+            session: A CollectionSession to share (warm) workers with other collections.
+            **kwargs: Passed to open_whp_dataset.
+        Returns:
+            The collected xarray dataset.
+        """
+        if '_compose_dir' not in dir(self):
+            raise ValueError('The cycle has not been composed.')
+        cast_glob = 'cast_*/'
+        if len(list(self._compose_dir.glob(cast_glob + 'member_*'))) > 0:
+            cast_glob = cast_glob + 'member_*/'
+        files = sorted(self._compose_dir.glob(cast_glob + file_glob))
+        return open_whp_dataset(files, session=session, **kwargs)
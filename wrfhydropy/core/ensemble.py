@@ -15,7 +15,9 @@ except ImportError:
 else:
     cleanup_on_sigterm()
 
+from .collection import CollectionSession
 from .ensemble_tools import DeepDiffEq, dictify, get_sub_objs, mute
+from .ioutils import InputFileCache
 from .job import Job
 from .schedulers import Scheduler
 from .simulation import Simulation
@@ -283,7 +285,8 @@ class EnsembleSimulation(object):
         symlink_domain: bool = True,
         force: bool = False,
         check_nlst_warn: bool = False,
-        rm_members_from_memory: bool = True
+        rm_members_from_memory: bool = True,
+        file_cache: InputFileCache = None
     ):
         """Ensemble compose simulation directories and files
         Args:
@@ -294,6 +297,8 @@ class EnsembleSimulation(object):
             ensemble object upon compose. Testing and other reasons may keep them around.
             check_nlst_warn: Allow the namelist checking/validation to only result in warnings.
             This is also not great practice, but necessary in certain circumstances.
+            file_cache: An InputFileCache for validating the member input files, by default
+            one for the members (each member starts its own with ncores > 1).
         """
 
         if len(self) < 1:
@@ -333,6 +338,8 @@ class EnsembleSimulation(object):
                 ]
 
         # Ensemble compose
+        if file_cache is None:
+            file_cache = InputFileCache()
         ens_dir = pathlib.Path(os.getcwd())
         self._compose_dir = ens_dir.resolve()
         ens_dir_files = list(ens_dir.rglob('*'))
@@ -352,7 +359,8 @@ class EnsembleSimulation(object):
                         'args': {
                             'symlink_domain': symlink_domain,
                             'force': force,
-                            'check_nlst_warn': check_nlst_warn
+                            'check_nlst_warn': check_nlst_warn,
+                            'file_cache': file_cache
                         }
                     } for mm in self.members)
                 )
@@ -366,7 +374,8 @@ class EnsembleSimulation(object):
                         'args': {
                             'symlink_domain': symlink_domain,
                             'force': force,
-                            'check_nlst_warn': check_nlst_warn
+                            'check_nlst_warn': check_nlst_warn,
+                            'file_cache': file_cache
                         }
                     }
                 ) for mm in self.members
@@ -503,6 +512,25 @@ class EnsembleSimulation(object):
         with path.open(mode='wb') as f:
             pickle.dump(self, f, 2)
 
-    def collect(self, output=True):
-        for mm in self.members:
-            mm.collect(output=output)
+    def collect(self, output=True, open_outputs: list = None, session=None):
+        """Collect the members after a run.
+        Args:
+            output: Collect the members' output files.
+            open_outputs: Output types to open on each member after collection, e.g.
+                ['channel_rt']. See SimulationOutput.open.
+            session: A CollectionSession shared by the members' opens. If None and
+                open_outputs are requested, one session is used for all the members.
+        """
+        if open_outputs is None:
+            open_outputs = []
+        own_session = session is None and len(open_outputs) > 0
+        if own_session:
+            session = CollectionSession()
+        try:
+            for mm in self.members:
+                mm.collect(output=output)
+                for name in open_outputs:
+                    mm.output.open(name, session=session)
+        finally:
+            if own_session:
+                session.close()
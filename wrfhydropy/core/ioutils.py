@@ -2,12 +2,15 @@ from boltons import iterutils
 from typing import Union
 
 import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import dask
 import dask.bag
 import datetime
+import functools
 import hashlib
 import io
-import itertools
+import json
 import numpy as np
 import os
 import pandas as pd
@@ -17,6 +20,7 @@ import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import warnings
 import xarray as xr
@@ -24,10 +28,6 @@ import xarray as xr
 from wrfhydropy.util.xrnan import xrnan
 
 
-def is_not_none(x):
-    return x is not None
-
-
 def timesince(when=None):
     if when is None:
         return time.time()
@@ -38,76 +38,286 @@ def timesince(when=None):
         return time.time()
 
 
-def group_lead_time(ds: xr.Dataset) -> int:
-    return ds.lead_time.item(0)
+def process_rss() -> int:
+    """The resident memory (bytes) of this process, None if it can not be read."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
 
 
-def group_member_lead_time(ds: xr.Dataset) -> int:
-    return str(ds.member.item(0)) + '-' + str(ds.lead_time.item(0))
+def peak_rss() -> int:
+    """The peak resident memory (bytes) of this process, None if it can not be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
-def group_member(ds: xr.Dataset) -> int:
-    return ds.member.item(0)
+def span_start() -> tuple:
+    """The (wall, cpu) start of a timed span."""
+    return (time.perf_counter(), time.process_time())
 
 
-def merge_reference_time(ds_list: list) -> xr.Dataset:
-    return xr.concat(ds_list, dim='reference_time', coords='minimal')
+def span_elapsed(start: tuple) -> tuple:
+    """The (wall, cpu) seconds since span_start."""
+    return (time.perf_counter() - start[0], time.process_time() - start[1])
 
 
-def merge_member(ds_list: list) -> xr.Dataset:
-    return xr.concat(ds_list, dim='member', coords='minimal')
+class CollectionProfile(object):
+    """Named timing spans of a collection: scan, template, open, preprocess, gather, group,
+    merge, sort, valid_time, chunk and cache. Pass one as the profile of open_whp_dataset or
+    open_nwm_dataset to collect the spans into it (profile=True prints the report instead):
+        profile = CollectionProfile()
+        ds = open_whp_dataset(files, profile=profile)
+        print(profile.report())
+        profile.to_json('profile.json')
+    Each span has its wall and cpu seconds, numbers of files and bytes (when known) and the
+    rss and peak rss (bytes) at its end. The open and preprocess spans are measured in the
+    workers ('where': 'workers'), their times are totals over the files and their peak_rss is
+    the largest of the workers. Spans of the same name (e.g. of several file chunks) are
+    added up in the report and totals.
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, n_files: int = None, nbytes: int = None):
+        """Time the enclosed block as a span. Yields the span record, so its n_files and
+        nbytes can be filled in from inside the block."""
+        record = {
+            'name': name, 'where': 'parent', 'n_files': n_files, 'nbytes': nbytes}
+        start = span_start()
+        try:
+            yield record
+        finally:
+            record['wall'], record['cpu'] = span_elapsed(start)
+            record['rss'] = process_rss()
+            record['peak_rss'] = peak_rss()
+            self.spans.append(record)
+
+    def add_worker_timings(self, timings: list):
+        """Add the open and preprocess spans from the per-file timings returned by the
+        workers (see preprocess_nwm_data)."""
+        if len(timings) == 0:
+            return
+        for name in ['open', 'preprocess']:
+            self.spans.append({
+                'name': name,
+                'where': 'workers',
+                'n_files': len(timings),
+                'nbytes': sum(tt['nbytes'] for tt in timings) if name == 'open' else None,
+                'wall': sum(tt[name][0] for tt in timings),
+                'cpu': sum(tt[name][1] for tt in timings),
+                'rss': None,
+                'peak_rss': max(
+                    [tt['peak_rss'] for tt in timings if tt['peak_rss'] is not None],
+                    default=None)})
+
+    def totals(self) -> collections.OrderedDict:
+        """The spans added up by name, in order of first appearance."""
+        totals = collections.OrderedDict()
+        for span in self.spans:
+            if span['name'] not in totals:
+                totals[span['name']] = {
+                    'where': span['where'], 'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                    'n_files': None, 'nbytes': None, 'rss': None, 'peak_rss': None}
+            total = totals[span['name']]
+            total['count'] += 1
+            total['wall'] += span['wall']
+            total['cpu'] += span['cpu']
+            for key in ['n_files', 'nbytes']:
+                if span[key] is not None:
+                    total[key] = (total[key] or 0) + span[key]
+            for key in ['rss', 'peak_rss']:
+                if span[key] is not None:
+                    total[key] = max(total[key] or 0, span[key])
+        return totals
+
+    def report(self) -> str:
+        """A table of the totals."""
+        def fmt(val, scale=1):
+            return '-' if val is None else '{:.4g}'.format(val / scale)
+        lines = ['{:<12}{:>9}{:>6}{:>10}{:>10}{:>8}{:>10}{:>10}'.format(
+            'span', 'where', 'count', 'wall_s', 'cpu_s', 'files', 'MB', 'peak_MB')]
+        for name, total in self.totals().items():
+            lines.append('{:<12}{:>9}{:>6}{:>10}{:>10}{:>8}{:>10}{:>10}'.format(
+                name, total['where'], total['count'], fmt(total['wall']), fmt(total['cpu']),
+                fmt(total['n_files']), fmt(total['nbytes'], 1e6),
+                fmt(total['peak_rss'], 1e6)))
+        return '\n'.join(lines)
+
+    def to_json(self, path: Union[str, pathlib.Path] = None) -> str:
+        """The spans and totals as JSON, also written to path if given."""
+        the_json = json.dumps(
+            {'spans': self.spans, 'totals': self.totals()}, indent=1)
+        if path is not None:
+            pathlib.Path(path).write_text(the_json)
+        return the_json
+
+
+def profile_span(profile: CollectionProfile, name: str, **kwargs):
+    """profile.span(name), or a do-nothing context without a profile."""
+    if profile:
+        return profile.span(name, **kwargs)
+    return contextlib.nullcontext({})
 
 
-def merge_lead_time(ds_list: list) -> xr.Dataset:
-    return xr.concat(ds_list, dim='lead_time', coords='minimal')
+# The compute arguments of the collection.CollectionSession.scheduler context of each thread.
+session_compute = threading.local()
 
 
-def merge_time(ds_list: list) -> xr.Dataset:
-    return xr.concat(ds_list, dim='time', coords='minimal')
+def session_compute_kwargs() -> dict:
+    """The scheduler and pool to pass to the compute calls of the collection, from the
+    CollectionSession.scheduler context of this thread. Empty outside one, the dask config
+    applies."""
+    return getattr(session_compute, 'kwargs', {})
+
+
+def calc_valid_time(ds: xr.Dataset, lazy: bool = False) -> xr.Variable:
+    """The valid_time (reference_time + lead_time) of a forecast collection, broadcast
+    over (reference_time, lead_time) in one datetime64 + timedelta64 operation.
+    Args:
+        ds: A dataset with reference_time and lead_time.
+        lazy: Return a dask-backed variable, computed only when used.
+    Returns:
+        The valid_time variable (datetime64[ns]) on (reference_time, lead_time).
+    """
+    reference_time = ds['reference_time'].variable.to_base_variable()
+    lead_time = ds['lead_time'].variable.to_base_variable()
+    if lazy:
+        reference_time = reference_time.chunk()
+        lead_time = lead_time.chunk()
+    valid_time = reference_time + lead_time
+    return valid_time.astype('datetime64[ns]')
+
+
+def pivot_valid_time(ds: xr.Dataset) -> xr.Dataset:
+    """Pivot forecasts from (reference_time, lead_time) onto (valid_time, lead_time), for
+    verification against observations at valid times. Each (valid_time, lead_time) cell takes
+    the forecast issued at valid_time - lead_time, cells with no such forecast are missing.
+    The reference_time of each cell is kept as a 2D coordinate.
+    Args:
+        ds: A collected forecast dataset with reference_time and lead_time dimensions.
+    Returns:
+        The dataset on valid_time and lead_time.
+    """
+    ds = ds.sortby('reference_time')
+    reference_time = ds['reference_time'].values.astype('datetime64[ns]')
+    lead_time = ds['lead_time'].values.astype('timedelta64[ns]')
+    valid_time = np.unique(reference_time[:, np.newaxis] + lead_time[np.newaxis, :])
+
+    # The position of the reference_time of each (valid_time, lead_time) cell.
+    want = valid_time[:, np.newaxis] - lead_time[np.newaxis, :]
+    ref_pos = np.minimum(np.searchsorted(reference_time, want), len(reference_time) - 1)
+    found = reference_time[ref_pos] == want
+    lead_pos = np.broadcast_to(np.arange(len(lead_time))[np.newaxis, :], want.shape)
+
+    pivot_dims = ('valid_time', 'lead_time')
+    pivoted = ds.drop_vars(
+        [name for name in ['reference_time', 'lead_time', 'valid_time'] if name in ds.variables]
+    ).isel(
+        reference_time=xr.DataArray(ref_pos, dims=pivot_dims),
+        lead_time=xr.DataArray(lead_pos, dims=pivot_dims))
+    found = xr.DataArray(found, dims=pivot_dims)
+    if not found.values.all():
+        pivoted = pivoted.where(found)
+    pivoted = pivoted.assign_coords(
+        valid_time=valid_time,
+        lead_time=lead_time,
+        reference_time=(pivot_dims, np.where(found.values, want, np.datetime64('NaT'))))
+    return pivoted
+
+
+def feature_id_index(
+    paths: list,
+    feature_ids: list,
+    dim: str = 'feature_id'
+) -> dict:
+    """Resolve feature ids to their positions once, from the first file that opens, for
+    selection in every file with select_feature_index.
+    Args:
+        paths: List of file paths, the first which opens is used.
+        feature_ids: The ids to select.
+        dim: The feature dimension (coordinate) name.
+    Returns:
+        A dict with the dim, the number of features in the file (size) and the positions and
+        feature_ids selected, both in file order. Small enough to ship to every worker.
+    """
+    file_ids = None
+    for path in paths:
+        try:
+            with xr.open_dataset(path, mask_and_scale=False) as ds:
+                file_ids = ds[dim].values
+            break
+        except OSError:
+            continue
+    if file_ids is None:
+        raise ValueError('None of the files could be opened to index ' + dim + '.')
+
+    feature_ids = np.unique(np.asarray(feature_ids, dtype=file_ids.dtype))
+    # Search the sorted ids, the files are usually already sorted.
+    if np.all(file_ids[1:] > file_ids[:-1]):
+        order = None
+        sorted_ids = file_ids
+    else:
+        order = np.argsort(file_ids, kind='stable')
+        sorted_ids = file_ids[order]
+    sorted_pos = np.searchsorted(sorted_ids, feature_ids)
+    sorted_pos[sorted_pos == len(sorted_ids)] = 0
+    found = sorted_ids[sorted_pos] == feature_ids
+    if not np.all(found):
+        raise ValueError(
+            str(int(np.sum(~found))) + ' of the feature_ids are not in the files, e.g.: ' +
+            str(feature_ids[~found][0:5].tolist()))
+    positions = sorted_pos if order is None else order[sorted_pos]
+    positions = np.sort(positions)
+
+    return {
+        'dim': dim,
+        'size': len(file_ids),
+        'positions': positions,
+        'feature_ids': file_ids[positions]}
+
+
+def select_feature_index(ds: xr.Dataset, feature_index: dict, path=None) -> xr.Dataset:
+    """Select the features of a feature_id_index from a (lazily) opened dataset. The file
+    is checked to have the same feature ordering at the selected positions, only the
+    selected positions of the variables are then read.
+    """
+    dim = feature_index['dim']
+    positions = feature_index['positions']
+    if (dim not in ds.dims or
+            ds.sizes[dim] != feature_index['size'] or
+            not np.array_equal(ds[dim].values[positions], feature_index['feature_ids'])):
+        raise ValueError(
+            'The ' + dim + ' ordering of the file differs from the indexed file: ' +
+            str(path))
+    return ds.isel({dim: positions})
 
 
 def preprocess_nwm_data(
     path,
     spatial_indices: list = None,
-    drop_variables: list = None
+    drop_variables: list = None,
+    feature_index: dict = None,
+    profile: bool = False
 ) -> xr.Dataset:
-
-    try:
-        ds = xr.open_dataset(path, mask_and_scale=False)
-    except OSError:
-        print("Skipping file, unable to open: ", path)
-        return None
-
-    if drop_variables is not None:
-        to_drop = set(ds.variables).intersection(set(drop_variables))
-        if to_drop != set():
-            ds = ds.drop_vars(to_drop)
-
-    # TODO JLM? Check range (e.g. "medium_range")
-    # TODO JLM? Check file type (e.g "channel_rt")
-
-    # Member preprocess
-    filename_info = pathlib.Path(path).name.split('.')
-    try:
-        member = int(filename_info[3].split('_')[-1])
-    except ValueError:
-        member = None
-
-    if member is not None:
-        ds.coords['member'] = member
-
-    # Lead time preprocess
-    ds.coords['lead_time'] = np.array(
-        ds.time.values - ds.reference_time.values,
-        dtype='timedelta64[ns]'
-    )
-    ds = ds.drop_vars('time')
-
-    # Spatial subsetting
-    if spatial_indices is not None:
-        ds = ds.isel(feature_id=spatial_indices)
-
-    return ds
+    """Open and preprocess a National Water Model file, see collection.NwmConvention."""
+    from wrfhydropy.core.collection import preprocess_whp_data
+    isel = None if spatial_indices is None else {'feature_id': spatial_indices}
+    return preprocess_whp_data(
+        path, isel=isel, drop_variables=drop_variables, feature_index=feature_index,
+        profile=profile, convention='nwm')
 
 
 def open_nwm_dataset(
@@ -119,103 +329,49 @@ def open_nwm_dataset(
     spatial_indices: list = None,
     drop_variables: list = None,
     npartitions: int = None,
-    profile: int = False
+    profile: Union[bool, CollectionProfile] = False,
+    feature_ids: list = None,
+    lazy_valid_time: bool = False,
+    assembly: str = 'concat'
 ) -> xr.Dataset:
+    """Open a multi-file National Water Model output dataset (files named
+    nwm.tHHz.range.type_m.fFFF.domain.nc) on the reference_time, member (when the files have
+    it) and lead_time dimensions. This is the collection engine of
+    collection.open_whp_dataset with the 'nwm' convention, run under the current dask
+    scheduler.
+    Args:
+        paths: List of file paths to nwm netcdf output files.
+        chunks: chunks argument passed on to xarray DataFrame.chunk() method
+        attrs_keep: A list of the global attributes to be retained.
+        spatial_indices: The feature_id positions to select from each file.
+        drop_variables: List of variables to drop from each file.
+        npartitions: The number of dask.bag partitions.
+        profile: As for open_whp_dataset.
+        feature_ids: List of the feature_ids to collect, as for open_whp_dataset.
+        lazy_valid_time: Add valid_time as a lazy (dask) coordinate.
+        assembly: As for open_whp_dataset.
+    Returns:
+        An xarray dataset.
+    """
+    from wrfhydropy.core.collection import open_whp_dataset_inner
 
-    if profile:
-        then = timesince()
-
-    # This is totally arbitrary be seems to work ok.
-    if npartitions is None:
-        npartitions = dask.config.get('pool')._processes * 4
-    # This choice does not seem to work well or at all, error?
-    # npartitions = len(sorted(paths))
-    paths_bag = dask.bag.from_sequence(paths, npartitions=npartitions)
-
-    if profile:
-        then = timesince(then)
-        print('after paths_bag')
+    # Resolve the feature_ids to positions once for all the files.
+    feature_index = None
+    if feature_ids is not None:
+        feature_index = feature_id_index(paths, feature_ids)
 
-    ds_list = paths_bag.map(
-        preprocess_nwm_data,
+    return open_whp_dataset_inner(
+        paths,
         chunks=chunks,
-        spatial_indices=spatial_indices,
-        drop_variables=drop_variables
-    ).filter(is_not_none).compute()
-
-    if profile:
-        then = timesince(then)
-        print("after ds_list preprocess/filter")
-
-    # Group by and merge by choices
-    have_members = 'member' in ds_list[0].coords
-    if have_members:
-        group_list = [group_member_lead_time, group_lead_time]
-        merge_list = [merge_reference_time, merge_member]
-    else:
-        group_list = [group_lead_time]
-        merge_list = [merge_reference_time]
-
-    for group, merge in zip(group_list, merge_list):
-
-        if profile:
-            then = timesince(then)
-            print('before sort')
-
-        the_sort = sorted(ds_list, key=group)
-
-        if profile:
-            then = timesince(then)
-            print('after sort, before group')
-
-        ds_groups = [list(it) for k, it in itertools.groupby(the_sort, group)]
-
-        if profile:
-            then = timesince(then)
-            print('after group, before merge')
-
-        # npartitons = len(ds_groups)
-        group_bag = dask.bag.from_sequence(ds_groups, npartitions=npartitions)
-        ds_list = group_bag.map(merge).compute()
-
-        if profile:
-            then = timesince(then)
-            print('after merge')
-
-        del group_bag, ds_groups, the_sort
-
-    nwm_dataset = merge_lead_time(ds_list)
-    del ds_list
-
-    # Create a valid_time variable.
-    def calc_valid_time(ref, lead):
-        return np.datetime64(int(ref) + int(lead), 'ns')
-    nwm_dataset['valid_time'] = xr.apply_ufunc(
-        calc_valid_time,
-        nwm_dataset['reference_time'],
-        nwm_dataset['lead_time'],
-        vectorize=True
-    )
-
-    # Xarray sets nan as the fill value when there is none. Dont allow that...
-    for key, val in nwm_dataset.variables.items():
-        if '_FillValue' not in nwm_dataset[key].encoding:
-            nwm_dataset[key].encoding.update({'_FillValue': None})
-
-    # Clean up attributes
-    new_attrs = collections.OrderedDict()
-    if attrs_keep is not None:
-        for key, value in nwm_dataset.attrs.items():
-            if key in attrs_keep:
-                new_attrs[key] = nwm_dataset.attrs[key]
-
-    nwm_dataset.attrs = new_attrs
-
-    # Break into chunked dask array
-    if chunks is not None:
-        nwm_dataset = nwm_dataset.chunk(chunks=chunks)
-
-    return nwm_dataset
+        attrs_keep=attrs_keep,
+        isel=None if spatial_indices is None else {'feature_id': spatial_indices},
+        drop_variables=drop_variables,
+        npartitions=npartitions,
+        profile=profile,
+        assembly=assembly,
+        feature_index=feature_index,
+        lazy_valid_time=lazy_valid_time,
+        convention='nwm')
 
 
 def preprocess_dart_data(
@@ -224,36 +380,12 @@ def preprocess_dart_data(
     spatial_indices: list = None,
     drop_variables: list = None
 ) -> xr.Dataset:
-
-    # This non-optional is different from preprocess_nwm_data
-    # I kinda dont think this should be optional for dart experiment/run collection.
-    # try:
-    ds = xr.open_dataset(path)
-    # except OSError:
-    #    print("Skipping file, unable to open: ", path)
-    #    return None
-
-    # May need to add time... do this before changing any dimensions.
-    for key in ds.variables.keys():
-        if 'time' not in ds[key].dims:
-            ds[key] = ds[key].expand_dims('time')
-
-    if drop_variables is not None:
-        to_drop = set(ds.variables).intersection(set(drop_variables))
-        if to_drop != set():
-            ds = ds.drop_vars(to_drop)
-
-    # This member definition is different from preprocess_nwm_data
-    member = int(ds.attrs['DART_file_information'].split()[-1])
-    ds.coords['member'] = member
-
-    # Spatial subsetting
-    if spatial_indices is not None:
-        ds = ds.isel(feature_id=spatial_indices)
-
-    # Chunk here?
-
-    return ds
+    """Open and preprocess a DART member file, see collection.DartConvention. chunks is
+    not used."""
+    from wrfhydropy.core.collection import preprocess_whp_data
+    isel = None if spatial_indices is None else {'feature_id': spatial_indices}
+    return preprocess_whp_data(
+        path, isel=isel, drop_variables=drop_variables, convention='dart')
 
 
 def open_dart_dataset(
@@ -262,122 +394,224 @@ def open_dart_dataset(
     spatial_indices: list = None,
     drop_variables: list = None,
     npartitions: int = None,
-    attrs_keep: list = None
+    attrs_keep: list = None,
+    assembly: str = 'concat'
 ) -> xr.Dataset:
     """Open a multi-file ensemble wrf-hydro output dataset
     Args:
 paths: List ,iterable, or generator of file paths to wrf-hydro netcdf output files
         chunks: chunks argument passed on to xarray DataFrame.chunk() method
-        preprocess_member: A function that identifies the member from the file or filename.
+        spatial_indices: The feature_id positions to select from each file.
+        drop_variables: List of variables to drop from each file.
+        npartitions: The number of dask.bag partitions.
         attrs_keep: A list of the global attributes to be retained.
+        assembly: As for collection.open_whp_dataset ('concat' or 'block').
     Returns:
         An xarray dataset of dask arrays chunked by chunk_size along the feature_id
         dimension concatenated along the time and member dimensions.
     """
-
-    # TODO JLM: Can this be combined with open_wh_dataset?
-    # Explanation:
-    # Xarray currently first requires concatenation along existing dimensions (e.g. time)
-    # over the individual member groups, then it allows concatenation along the member
-    # dimensions.
-
-    # Set partitions
-    # This is arbitrary
-    if npartitions is None:
-        npartitions = dask.config.get('pool')._processes * 4
-
-    paths_bag = dask.bag.from_sequence(paths)
-
-    ds_list = paths_bag.map(
-        preprocess_dart_data,
+    # The collection engine of open_whp_dataset with the 'dart' convention: the member
+    # is from the DART_file_information attribute.
+    from wrfhydropy.core.collection import open_whp_dataset_inner
+    return open_whp_dataset_inner(
+        paths,
         chunks=chunks,
-        spatial_indices=spatial_indices,
-        drop_variables=drop_variables
-    ).filter(is_not_none).compute()
-
-    the_sort = sorted(ds_list, key=group_member)
-    ds_groups = [list(it) for k, it in itertools.groupby(the_sort, group_member)]
-    group_bag = dask.bag.from_sequence(ds_groups)  # , npartitions=npartitions)
-    ds_list = group_bag.map(merge_time).compute()
-    del group_bag, ds_groups, the_sort
-    dart_dataset = merge_member(ds_list)
-    del ds_list
-
-    # Xarray sets nan as the fill value when there is none. Dont allow that...
-    for key, val in dart_dataset.variables.items():
-        if '_FillValue' not in dart_dataset[key].encoding:
-            dart_dataset[key].encoding.update({'_FillValue': None})
-
-    # Clean up attributes
-    new_attrs = collections.OrderedDict()
-    if attrs_keep is not None:
-        for key, value in dart_dataset.attrs.items():
-            if key in attrs_keep:
-                new_attrs[key] = dart_dataset.attrs[key]
-
-    dart_dataset.attrs = new_attrs
-
-    # The existing DART convention.
-    dart_dataset = dart_dataset.transpose('time', 'member', 'links')
-
-    # Break into chunked dask array
-    if chunks is not None:
-        dart_dataset = dart_dataset.chunk(chunks=chunks)
-
-    return dart_dataset
+        attrs_keep=attrs_keep,
+        isel=None if spatial_indices is None else {'feature_id': spatial_indices},
+        drop_variables=drop_variables,
+        npartitions=npartitions,
+        assembly=assembly,
+        convention='dart')
+
+
+def drop_reference_time(ds: xr.Dataset) -> xr.Dataset:
+    """The dataset without its reference_time (dimension or coordinate)."""
+    if 'reference_time' in ds.dims:
+        return ds.isel(reference_time=0, drop=True)
+    return ds.drop_vars('reference_time', errors='ignore')
+
+
+def read_wh_file_times(path, global_attrs: list = None) -> dict:
+    """The decoded time and reference_time values of a file, read with netCDF4 without
+    opening the file's other variables. The global_attrs the file has are also returned,
+    by name."""
+    import netCDF4
+    from wrfhydropy.core.collection import whp_netcdf_lock
+    times = {}
+    attr_values = {}
+    # NetCDF-C and HDF5 are not thread safe, the lock is per process.
+    with whp_netcdf_lock:
+        with netCDF4.Dataset(str(path)) as nc:
+            nc.set_auto_maskandscale(False)
+            for name in global_attrs or []:
+                if name in nc.ncattrs():
+                    attr_values[name] = nc.getncattr(name)
+            for name in ['time', 'reference_time']:
+                if name not in nc.variables:
+                    continue
+                var = nc.variables[name]
+                attrs = {
+                    att: var.getncattr(att) for att in ['units', 'calendar']
+                    if att in var.ncattrs()}
+                times[name] = (np.atleast_1d(var[:]).ravel(), attrs)
+    for name, (raw, attrs) in times.items():
+        times[name] = xr.conventions.decode_cf_variable(
+            name, xr.Variable('time', raw, attrs=attrs)).values
+    times.update(attr_values)
+    return times
 
 
 def open_wh_dataset(paths: list,
                     chunks: dict = None,
-                    forecast: bool = True) -> xr.Dataset:
-    """Open a multi-file wrf-hydro output dataset
+                    forecast: bool = True,
+                    n_threads: int = 8) -> xr.Dataset:
+    """Open a multi-file wrf-hydro output dataset. Only the time and reference_time of the
+    files are read first (with netCDF4, in threads) to index the files, then without chunks
+    each variable is filled into a single (reference_time, time, ...) array, file by file.
+    The files are concatenated in order: the reference_times as they appear and the times
+    of each reference_time in file order, repeated times are kept. When the reference_times
+    have different times, they are aligned on the union of their times (which must not
+    repeat) and (reference_time, time) without a file are missing.
     Args:
         paths: List ,iterable, or generator of file paths to wrf-hydro netcdf output files
         chunks: chunks argument passed on to xarray DataFrame.chunk() method
         forecast: If forecast the reference time dimension is retained, if not then
         reference_time dimension is set to a dummy value (1970-01-01) to ease concatenation
         and analysis
+        n_threads: The number of threads reading the file times.
     Returns:
         An xarray dataset of dask arrays chunked by chunk_size along the feature_id
         dimension concatenated along the time and
         reference_time dimensions
     """
+    paths = list(paths)
+    if len(paths) == 0:
+        raise ValueError('No files to open.')
+    with ThreadPoolExecutor(n_threads) as executor:
+        file_headers = list(executor.map(read_wh_file_times, paths))
+
+    # The index: the reference_time and times of each file.
+    template = xr.open_dataset(paths[0], chunks=chunks, mask_and_scale=False)
+    dummy_ref_time = np.datetime64('1970-01-01T00:00:00', 'ns')
+    if forecast:
+        ref_time_var = template['reference_time'].variable
+        file_ref_times = np.array([header['reference_time'][0] for header in file_headers])
+    else:
+        ref_time_var = xr.Variable('reference_time', [dummy_ref_time])
+        file_ref_times = np.repeat(dummy_ref_time, len(paths))
+    file_times = [header['time'] for header in file_headers]
+    template = drop_reference_time(template)
 
-    # Create dictionary of forecasts, i.e. reference times
-    ds_dict = dict()
-    for a_file in paths:
-        ds = xr.open_dataset(a_file, chunks=chunks, mask_and_scale=False)
-        # Check if forecast and set reference_time to zero if not
-        if not forecast:
-            ds.coords['reference_time'] = np.array(
-                [np.datetime64('1970-01-01T00:00:00', 'ns')])
-
-        ref_time = ds['reference_time'].values[0]
-        if ref_time in ds_dict:
-            # append the new number to the existing array at this slot
-            ds_dict[ref_time].append(ds)
-        else:
-            # create a new array in this slot
-            ds_dict[ref_time] = [ds]
-
-    # Concatenate along time axis for each forecast
-    forecast_list = list()
-    for key in ds_dict.keys():
-        forecast_list.append(xr.concat(ds_dict[key],
-                                       dim='time',
-                                       coords='minimal'))
-
-    # Concatenate along reference_time axis for all forecasts
-    wh_dataset = xr.concat(
-        forecast_list,
-        dim='reference_time',
-        coords='minimal'
-    )
+    # The forecasts in order of appearance, each with its files in order.
+    ref_times = pd.unique(file_ref_times)
+    groups = [np.flatnonzero(file_ref_times == ref_time) for ref_time in ref_times]
 
-    # Break into chunked dask array
     if chunks is not None:
-        wh_dataset = wh_dataset.chunk(chunks=chunks)
+        # Lazy: one concatenation per forecast.
+        forecast_list = []
+        for ref_time, group in zip(ref_times, groups):
+            ds_list = [
+                drop_reference_time(
+                    xr.open_dataset(paths[ii], chunks=chunks, mask_and_scale=False))
+                for ii in group]
+            forecast_list.append(
+                xr.concat(ds_list, dim='time', coords='minimal')
+                .expand_dims(reference_time=[ref_time]))
+        wh_dataset = forecast_list[0]
+        if len(forecast_list) > 1:
+            wh_dataset = xr.concat(forecast_list, dim='reference_time', coords='minimal')
+        wh_dataset['reference_time'].attrs = ref_time_var.attrs
+        wh_dataset['reference_time'].encoding = ref_time_var.encoding
+        return wh_dataset.chunk(chunks=chunks)
+
+    # The times of each forecast are its files' times in file order (repeated times are
+    # kept). Forecasts with other times are aligned on the union of their times, as by
+    # xr.concat, which needs the times of each forecast to be unique.
+    group_times = [np.concatenate([file_times[ii] for ii in group]) for group in groups]
+    file_ref_inds = np.empty(len(paths), dtype=int)
+    file_time_inds = [None] * len(paths)
+    if all(np.array_equal(gt, group_times[0]) for gt in group_times):
+        times = group_times[0]
+        for ref_ind, group in enumerate(groups):
+            offset = 0
+            for ii in group:
+                file_ref_inds[ii] = ref_ind
+                file_time_inds[ii] = np.arange(offset, offset + len(file_times[ii]))
+                offset += len(file_times[ii])
+    else:
+        time_indexes = [pd.Index(gt) for gt in group_times]
+        if not all(ti.is_unique for ti in time_indexes):
+            raise ValueError(
+                'The forecasts have different times and some repeat times, they can not '
+                'be aligned along time.')
+        times = functools.reduce(pd.Index.union, time_indexes).values
+        for ref_ind, group in enumerate(groups):
+            for ii in group:
+                file_ref_inds[ii] = ref_ind
+                file_time_inds[ii] = pd.Index(times).get_indexer(file_times[ii])
+    missing = len(times) * len(ref_times) > len(np.concatenate(file_times))
+
+    # The variables concatenated along time: all the data variables and the coordinates
+    # with time.
+    names = list(template.data_vars) + [
+        name for name, var in template.coords.items()
+        if 'time' in var.dims and name != 'time']
+    cube = collections.OrderedDict()
+    cube_dims = {}
+    for name in names:
+        var = template[name].variable
+        dims = ('reference_time',) + (() if 'time' in var.dims else ('time',)) + var.dims
+        shape = tuple(
+            len(ref_times) if dd == 'reference_time' else len(times) if dd == 'time' else
+            template.sizes[dd] for dd in dims)
+        dtype, fill_value = var.dtype, None
+        if missing:
+            if var.dtype.kind == 'f':
+                fill_value = np.nan
+            elif var.dtype.kind in 'iub':
+                dtype, fill_value = np.float64, np.nan
+            elif var.dtype.kind in 'mM':
+                fill_value = np.array('NaT', dtype=var.dtype)
+            else:
+                dtype = object
+        cube[name] = np.empty(shape, dtype=dtype)
+        if fill_value is not None:
+            cube[name][...] = fill_value
+        cube_dims[name] = dims
+
+    # Fill the cube, one file at a time. Only the cube variables are decoded.
+    drop_names = [name for name in template.variables if name not in cube] + ['reference_time']
+    for path, ref_ind, time_inds in zip(paths, file_ref_inds, file_time_inds):
+        with xr.open_dataset(path, mask_and_scale=False, drop_variables=drop_names) as ds:
+            for name, data in cube.items():
+                file_var = ds[name].variable
+                if 'time' not in file_var.dims:
+                    file_var = file_var.set_dims(
+                        {'time': len(time_inds), **dict(file_var.sizes)})
+                index = tuple(
+                    time_inds if dd == 'time' else slice(None) for dd in cube_dims[name][1:])
+                data[ref_ind][index] = file_var.values
+
+    time_var = template['time'].variable
+    coords = collections.OrderedDict()
+    coords['reference_time'] = xr.Variable(
+        'reference_time', ref_times, attrs=ref_time_var.attrs, encoding=ref_time_var.encoding)
+    coords['time'] = xr.Variable(
+        'time', times, attrs=time_var.attrs, encoding=time_var.encoding)
+    for name, var in template.coords.items():
+        if name not in cube and name != 'time':
+            coords[name] = var.variable.load()
+    data_vars = collections.OrderedDict()
+    for name, data in cube.items():
+        var = template[name].variable
+        new_var = xr.Variable(cube_dims[name], data, attrs=var.attrs, encoding=var.encoding)
+        if name in template.coords:
+            coords[name] = new_var
+        else:
+            data_vars[name] = new_var
 
+    wh_dataset = xr.Dataset(data_vars, coords=coords, attrs=template.attrs)
+    template.close()
     return wh_dataset
 
 
@@ -410,24 +644,27 @@ def open_ensemble_dataset(
     # Explanation:
     # Xarray currently first requires concatenation along existing dimensions (e.g. time)
     # over the individual member groups, then it allows concatenation along the member
-    # dimensions. A dictionary is built wherein the member groups are identified/kept as
-    # lists of data sets (per member). Once this dictionary is complete, each list in
-    # the dict is concatenated along time. Once all members are concatenated along time,
-    # the all the members can be concatenated along "member".
-
-    paths_bag = dask.bag.from_sequence(paths)
-    ds_all = paths_bag.map(xr.open_dataset, chunks=chunks, mask_and_scale=False).compute()
-    all_bag = dask.bag.from_sequence(ds_all)
-
-    def member_grouper(ds):
-        return preprocess_member(ds).member.item(0)
-
-    def concat_time(total, x):
-        return xr.concat([total, x], dim='time', coords='minimal')
-
-    # Foldby returns a tuple of (member_number, xarray.Dataset), strip off the member number.
-    ds_members = [tup[1] for tup in all_bag.foldby(member_grouper, concat_time).compute()]
-    del all_bag
+    # dimensions. The files are opened lazily, only their attributes and coordinates are
+    # read to find the member, and grouped by member, keeping their order. Each member
+    # group is then concatenated along time in one go, which is where the data are read
+    # (without chunks), so each file is read once. Once all members are concatenated along
+    # time, the all the members can be concatenated along "member".
+
+    member_groups = collections.OrderedDict()
+    for path in paths:
+        ds = preprocess_member(xr.open_dataset(path, chunks=chunks, mask_and_scale=False))
+        member_groups.setdefault(ds.member.item(0), []).append(ds)
+
+    ds_members = []
+    for member in sorted(member_groups.keys()):
+        ds_list = member_groups.pop(member)
+        ds_members.append(xr.concat(ds_list, dim='time', coords='minimal'))
+        if chunks is None:
+            # Also read what was not concatenated, then the files are no longer needed.
+            ds_members[-1].load()
+            for ds in ds_list:
+                ds.close()
+        del ds_list
 
     ens_dataset = xr.concat(ds_members, dim='member', coords='minimal')
     del ds_members
@@ -490,22 +727,108 @@ class WrfHydroStatic(pathlib.PosixPath):
         return check_file_nans(self)
 
 
-def _check_file_exist_colon(dirpath: str, file_str: str):
+class InputFileCache(object):
+    """Which input files exist, for validating many jobs, members and casts which mostly
+    point at the same (symlinked) domain files. Each directory is listed once (scandir) and
+    symlinks are followed through the listings, so the files behind the links of every
+    member are looked up once. Missing files are checked again on disk, the cache can only
+    be stale for files removed after they were seen. Use one cache per compose.
+    """
+
+    # Symlink depth, as the OS.
+    max_links = 40
+
+    def __init__(self):
+        self.real_dirs = {}
+        self.listings = {}
+        self.exists_paths = set()
+
+    def __reduce__(self):
+        # Start empty in other processes.
+        return (InputFileCache, ())
+
+    def real_dir(self, dir_path: str, _depth: int = 0) -> str:
+        """The real path of a directory, resolved a (cached) component at a time."""
+        if dir_path not in self.real_dirs:
+            parent, name = os.path.split(dir_path)
+            if parent == dir_path:
+                real = dir_path
+            elif name in ['', '.']:
+                real = self.real_dir(parent)
+            elif name == '..':
+                real = os.path.dirname(self.real_dir(parent))
+            else:
+                real = os.path.join(self.real_dir(parent), name)
+                if os.path.islink(real) and _depth < InputFileCache.max_links:
+                    real = self.real_dir(
+                        os.path.join(os.path.dirname(real), os.readlink(real)), _depth + 1)
+            self.real_dirs[dir_path] = real
+        return self.real_dirs[dir_path]
+
+    def listing(self, dir_path: str) -> dict:
+        """The entries of a directory, by name. Empty if it is not a directory."""
+        if dir_path not in self.listings:
+            try:
+                with os.scandir(dir_path) as entries:
+                    self.listings[dir_path] = {entry.name: entry for entry in entries}
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                self.listings[dir_path] = {}
+        return self.listings[dir_path]
+
+    def exists(self, path: Union[pathlib.Path, str]) -> bool:
+        """As pathlib.Path.exists(), symlinks followed."""
+        path = pathlib.Path(path).absolute()
+        if self.listed_exists(str(path)):
+            return True
+        # Not cached: made after its directory was listed?
+        return path.exists()
+
+    def listed_exists(self, path: str, _depth: int = 0) -> bool:
+        if path in self.exists_paths:
+            return True
+        if _depth > InputFileCache.max_links:
+            return False
+        parent, name = os.path.split(path)
+        if name in ['', '.', '..']:
+            return os.path.isdir(self.real_dir(path))
+        parent = self.real_dir(parent)
+        entry = self.listing(parent).get(name)
+        if entry is None:
+            return False
+        if entry.is_symlink():
+            try:
+                target = os.path.join(parent, os.readlink(entry.path))
+            except OSError:
+                return False
+            if not self.listed_exists(target, _depth=_depth + 1):
+                return False
+        self.exists_paths.add(path)
+        return True
+
+
+def _check_file_exist_colon(
+    dirpath: str,
+    file_str: str,
+    file_cache: InputFileCache = None
+):
     """Private method to check if a filename containing a colon exists, accounting for renaming
     to an underscore that is done by some systems.
     Args:
         dirpath: Path to directory containing files
         file_str: Name of file containing colons to search
+        file_cache: An InputFileCache for the existence checks.
     """
     if type(file_str) is not str:
         file_str = str(file_str)
     file_colon = pathlib.Path(file_str)
     file_no_colon = pathlib.Path(file_str.replace(':', '_'))
     run_dir = pathlib.Path(dirpath)
+    if file_cache is None:
+        file_cache = InputFileCache()
 
-    if (run_dir / file_colon).exists():
+    if file_cache.exists(run_dir / file_colon):
         return './' + str(file_colon)
-    if (run_dir / file_no_colon).exists():
+    if file_cache.exists(run_dir / file_no_colon):
         return './' + str(file_no_colon)
     return None
 
@@ -524,7 +847,8 @@ def check_input_files(
     hrldas_namelist: dict,
     sim_dir: str,
     ignore_restarts: bool = False,
-    check_nlst_warn: bool = False
+    check_nlst_warn: bool = False,
+    file_cache: InputFileCache = None
 ):
     """Given hydro and hrldas namelists and a directory, check that all files listed in the
     namelist exist in the specified directory.
@@ -535,27 +859,22 @@ def check_input_files(
         sim_dir: The path to the directory containing input files.
         ignore_restarts: Ignore restart files.
         check_nlst_warn: Allow the namelist checking/validation to only result in warnings.
+        file_cache: An InputFileCache shared by the checks of many jobs/members/casts, by
+            default one for this call.
     """
-
-    def visit_is_file(path, key, value):
-        if value is None:
-            return False
-        return type(value) is str or type(value) is dict
-
-    def visit_not_none(path, key, value):
-        return bool(value)
+    if file_cache is None:
+        file_cache = InputFileCache()
 
     def visit_str_posix_exists(path, key, value):
+        # Dicts are visited after their items, empty ones (no files) are removed.
         if type(value) is dict:
-            return True
-        return key, (sim_dir / pathlib.PosixPath(value)).exists()
+            return bool(value)
+        if type(value) is not str or not value:
+            return False
+        return key, file_cache.exists(sim_dir / pathlib.PosixPath(value))
 
     def remap_nlst(nlst):
-        # The outer remap removes empty dicts
-        files = iterutils.remap(nlst, visit=visit_is_file)
-        files = iterutils.remap(files, visit=visit_not_none)
-        exists = iterutils.remap(files, visit=visit_str_posix_exists)
-        return exists
+        return iterutils.remap(nlst, visit=visit_str_posix_exists)
 
     hrldas_file_dict = remap_nlst(hrldas_namelist)
     hydro_file_dict = remap_nlst(hydro_namelist)
@@ -565,11 +884,13 @@ def check_input_files(
     # What are the colon cases? Hydro/nudging restart files
     hydro_file_dict['hydro_nlist']['restart_file'] = \
         bool(_check_file_exist_colon(sim_dir,
-                                     hydro_namelist['hydro_nlist']['restart_file']))
+                                     hydro_namelist['hydro_nlist']['restart_file'],
+                                     file_cache=file_cache))
     if 'nudging_nlist' in hydro_file_dict.keys():
         hydro_file_dict['nudging_nlist']['nudginglastobsfile'] = \
             bool(_check_file_exist_colon(sim_dir,
-                                         hydro_namelist['nudging_nlist']['nudginglastobsfile']))
+                                         hydro_namelist['nudging_nlist']['nudginglastobsfile'],
+                                         file_cache=file_cache))
 
     hrldas_exempt_list = []
     hydro_exempt_list = ['nudginglastobsfile', 'timeslicepath']
@@ -649,42 +970,36 @@ def sort_files_by_time(file_list: list):
     return file_list_sorted
 
 
-def nwm_forcing_to_ldasin(
-    nwm_forcing_dir: Union[pathlib.Path, str],
+def plan_nwm_forcing_to_ldasin(
+    nwm_forcing_dir: Union[pathlib.Path, str, list],
     ldasin_dir: Union[pathlib.Path, str],
     range: str,
-    copy: bool = False,
     forc_type=1
-):
-    """Convert nwm dir and naming format to wrf-hydro read format.
-    Args:
-        nwm_forcing_dir: the pathlib.Path or str for the source dir or a list of source
-            directories. If a pathlib.Path object or str is provided, it is assume that this
-            single directory contains nwm.YYYYMMDDHH downloaded from NOMADS and that their
-            subdirectory structure is unchanged. If a list of pathlib.Path (or str) is provided,
-            these should be the desired nwm.YYYYMMDD to translate with no changed to their
-            subdirectory structure.
-        ldasin_dir: the pathlib.Path or str for a new NONEXISTANT output dir.
-        range: str range as on nomads in: analysis_assim, analysis_assim_extend,
-            analysis_assim_hawaii, medium_range, short_range,
-            short_range_hawaii
-        copy: True or false. Default is false creates symlinks.
-        forc_type: 1 (hour) or 2 (minute) formats are supported.
+) -> pd.DataFrame:
+    """The nwm forcing files and their wrf-hydro (LDASIN) names, without touching the
+    ldasin_dir. See nwm_forcing_to_ldasin for the arguments.
     Returns:
-        None on success.
-"""
+        A pandas DataFrame with a row per file: the (absolute) source path, the target path,
+        the init_time (forecast) and the (valid) time of the file, sorted by target.
+    """
 
     # The proper range specification is as in args above, but if "forcing_" is
     # prepended, try our best.
     if 'forcing_' in range:
         range = range.split('forcing_')[1]
 
-    # Ldasin dir
-    # Might move this to the individual forecast folder creation below.
-    if isinstance(ldasin_dir, str):
-        ldasin_dir = pathlib.Path(ldasin_dir)
-    if not ldasin_dir.exists():
-        os.mkdir(str(ldasin_dir))
+    # Solve the forcing type/format
+    channel = forc_type == 9 or forc_type == 10
+    if forc_type == 1:
+        fmt = '%Y%m%d%H.LDASIN_DOMAIN1'
+    elif forc_type == 2:
+        fmt = '%Y%m%d%H00.LDASIN_DOMAIN1'
+    elif channel:
+        fmt = '%Y%m%d%H00.CHRTOUT_DOMAIN1'
+    else:
+        raise ValueError("Only forc_types 1, 2, 9, & 10 are supported.")
+
+    ldasin_dir = pathlib.Path(ldasin_dir)
 
     if isinstance(nwm_forcing_dir, list):
 
@@ -695,11 +1010,9 @@ def nwm_forcing_to_ldasin(
 
     else:
 
-        if isinstance(nwm_forcing_dir, str):
-            nwm_forcing_dir = pathlib.Path(nwm_forcing_dir)
+        nwm_forcing_dir = pathlib.Path(nwm_forcing_dir)
         if not nwm_forcing_dir.exists():
             raise FileNotFoundError("The nwm_forcing_dir does not exist, exiting.")
-        os.chdir(str(nwm_forcing_dir))
         daily_dirs = sorted(nwm_forcing_dir.glob("nwm.*[0-9]"))
         if len(daily_dirs) == 0:
             warnings.warn(
@@ -707,10 +1020,23 @@ def nwm_forcing_to_ldasin(
                 "If you passed a daily directory, it must be conatined in a list."
             )
 
+    re_range = range
+    if '_hawaii' in range:
+        re_range = range.split('_hawaii')[0]
+    elif '_puertorico' in range:
+        re_range = range.split('_puertorico')[0]
+    if channel:
+        file_glob = '*' + re_range + '.channel_rt.*'
+    else:
+        file_glob = '*' + re_range + '.forcing.*'
+    digits = re.compile(r'\d+')
+
+    rows = []
     for daily_dir in daily_dirs:
         the_day = datetime.datetime.strptime(daily_dir.name, 'nwm.%Y%m%d')
+        daily_dir = daily_dir.absolute()
 
-        if forc_type == 9 or forc_type == 10:
+        if channel:
             member_dirs = sorted(daily_dir.glob(range))
         else:
             member_dirs = sorted(daily_dir.glob('forcing_' + range))
@@ -719,57 +1045,275 @@ def nwm_forcing_to_ldasin(
             if not member_dir.is_dir():
                 continue
 
-            re_range = range
-            if '_hawaii' in range:
-                re_range = range.split('_hawaii')[0]
-            elif '_puertorico' in range:
-                re_range = range.split('_puertorico')[0]
-
-            if forc_type == 9 or forc_type == 10:
-                forcing_files = member_dir.glob('*' + re_range + '.channel_rt.*')
-            else:
-                forcing_files = member_dir.glob('*' + re_range + '.forcing.*')
-
-            for forcing_file in forcing_files:
+            for forcing_file in member_dir.glob(file_glob):
                 name_split = forcing_file.name.split('.')
-                init_hour = int(re.findall(r'\d+', name_split[1])[0])
+                init_hour = int(digits.search(name_split[1]).group())
 
                 # Each init time will have it's own directory.
                 init_time = the_day + datetime.timedelta(hours=init_hour)
-                init_time_dir = ldasin_dir / init_time.strftime('%Y%m%d%H')
-                init_time_dir.mkdir(mode=0o777, parents=False, exist_ok=True)
 
                 # Them each file inside has it's own time on the file.
-                cast_hour = int(re.findall(r'\d+', name_split[4])[0])
+                cast_hour = int(digits.search(name_split[4]).group())
                 if 'analysis_assim' in range:
                     model_time = init_hour - cast_hour
                 else:
                     model_time = init_hour + cast_hour
-
                 ldasin_time = the_day + datetime.timedelta(hours=model_time)
 
-                # Solve the forcing type/format
-                if forc_type == 1:
-                    fmt = '%Y%m%d%H.LDASIN_DOMAIN1'
-                elif forc_type == 2:
-                    fmt = '%Y%m%d%H00.LDASIN_DOMAIN1'
-                elif forc_type == 9 or forc_type == 10:
-                    fmt = '%Y%m%d%H00.CHRTOUT_DOMAIN1'
-                else:
-                    raise ValueError("Only forc_types 1, 2, 9, & 10 are supported.")
-                ldasin_file_name = init_time_dir / ldasin_time.strftime(fmt)
+                rows.append({
+                    'source': forcing_file,
+                    'target': ldasin_dir / init_time.strftime('%Y%m%d%H') /
+                    ldasin_time.strftime(fmt),
+                    'init_time': init_time,
+                    'time': ldasin_time})
 
-                if copy:
-                    shutil.copy(forcing_file, ldasin_file_name)
-                else:
-                    ldasin_file_name.symlink_to(forcing_file)
+    plan = pd.DataFrame(rows, columns=['source', 'target', 'init_time', 'time'])
+    return plan.sort_values('target', key=lambda col: col.map(str)).reset_index(drop=True)
 
-    return
+
+# How nwm_forcing_to_ldasin makes the targets.
+ldasin_link_modes = ['symlink', 'hardlink', 'reflink', 'copy']
+
+
+def reflink_file(source: pathlib.Path, target: pathlib.Path) -> bool:
+    """Clone source to target (copy on write, linux FICLONE). False where the file system or
+    the platform can not."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    ficlone = 0x40049409
+    with open(str(source), 'rb') as src, open(str(target), 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        except OSError:
+            return False
+    shutil.copymode(str(source), str(target))
+    return True
+
+
+def link_ldasin_file(source: pathlib.Path, target: pathlib.Path, link: str = 'symlink'):
+    """Make target from source, see nwm_forcing_to_ldasin."""
+    if link == 'symlink':
+        target.symlink_to(source)
+    elif link == 'hardlink':
+        os.link(str(source), str(target))
+    else:
+        # Copies are written aside and renamed, so a target never is a partial copy.
+        tmp_target = target.with_name('.' + target.name + '.tmp')
+        if link == 'copy' or not reflink_file(source, tmp_target):
+            shutil.copy(str(source), str(tmp_target))
+        os.replace(str(tmp_target), str(target))
+
+
+def nwm_forcing_to_ldasin(
+    nwm_forcing_dir: Union[pathlib.Path, str],
+    ldasin_dir: Union[pathlib.Path, str],
+    range: str,
+    copy: bool = False,
+    forc_type=1,
+    link: str = None,
+    skip_existing: bool = False,
+    dry_run: bool = False,
+    n_threads: int = 8
+) -> pd.DataFrame:
+    """Convert nwm dir and naming format to wrf-hydro read format. The files are first
+    planned (plan_nwm_forcing_to_ldasin), then the init time directories are made and the
+    files are linked or copied by a pool of threads.
+    Args:
+        nwm_forcing_dir: the pathlib.Path or str for the source dir or a list of source
+            directories. If a pathlib.Path object or str is provided, it is assume that this
+            single directory contains nwm.YYYYMMDDHH downloaded from NOMADS and that their
+            subdirectory structure is unchanged. If a list of pathlib.Path (or str) is provided,
+            these should be the desired nwm.YYYYMMDD to translate with no changed to their
+            subdirectory structure.
+        ldasin_dir: the pathlib.Path or str for a new NONEXISTANT output dir.
+        range: str range as on nomads in: analysis_assim, analysis_assim_extend,
+            analysis_assim_hawaii, medium_range, short_range,
+            short_range_hawaii
+        copy: True or false. Default is false creates symlinks.
+        forc_type: 1 (hour) or 2 (minute) formats are supported.
+        link: How the targets are made, overrides copy: 'symlink', 'hardlink' (same file
+            system), 'reflink' (a copy on write clone, a copy where the file system can not
+            clone) or 'copy'.
+        skip_existing: Skip the targets which exist, e.g. to finish an interrupted
+            conversion or to add new forecasts.
+        dry_run: Only return the plan, nothing is made.
+        n_threads: The number of threads making the targets.
+    Returns:
+        The plan (see plan_nwm_forcing_to_ldasin) of the targets made (or to make, if
+        dry_run).
+"""
+    if link is None:
+        link = 'copy' if copy else 'symlink'
+    if link not in ldasin_link_modes:
+        raise ValueError(
+            'Unknown link ' + str(link) + ', the options are: ' + ', '.join(ldasin_link_modes))
+
+    plan = plan_nwm_forcing_to_ldasin(nwm_forcing_dir, ldasin_dir, range, forc_type=forc_type)
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        if skip_existing:
+            exists = list(executor.map(os.path.lexists, plan['target'].map(str)))
+            plan = plan[~np.array(exists, dtype=bool)].reset_index(drop=True)
+        if dry_run:
+            return plan
+
+        # Ldasin dir
+        ldasin_dir = pathlib.Path(ldasin_dir)
+        if not ldasin_dir.exists():
+            os.mkdir(str(ldasin_dir))
+        for init_time_dir in sorted(set(target.parent for target in plan['target'])):
+            init_time_dir.mkdir(mode=0o777, parents=False, exist_ok=True)
+
+        # list() to raise the first error.
+        list(executor.map(
+            functools.partial(link_ldasin_file, link=link), plan['source'], plan['target']))
+
+    return plan
+
+
+def file_fingerprint(path) -> tuple:
+    """The (size, mtime, inode) of a file, which change when it is rewritten."""
+    stat = os.stat(str(path))
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+# Read size for hashing.
+hash_buffer_size = 4 * 2**20
+
+
+def new_hasher(algorithm: str = 'md5'):
+    """A hash object for a hashlib algorithm (md5, sha256, blake2b, ...) or an xxhash
+    algorithm (xxh64, xxh3_64, xxh3_128, xxh128) if xxhash is installed."""
+    if algorithm.startswith('xxh'):
+        try:
+            import xxhash
+        except ImportError:
+            raise ImportError('The ' + algorithm + ' algorithm requires xxhash.')
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def hash_file(
+    path: Union[pathlib.Path, str],
+    algorithm: str = 'md5',
+    buffer_size: int = hash_buffer_size
+) -> str:
+    """The hex digest of a file, read in large blocks. hashlib does not hold the GIL while
+    hashing large blocks, so files hash concurrently in threads (see hash_files).
+    Args:
+        path: The file.
+        algorithm: See new_hasher. blake2b is faster than md5 on 64 bit machines,
+            xxh3_128 much faster (not cryptographic).
+        buffer_size: The read size in bytes.
+    Returns:
+        The hex digest.
+    """
+    hasher = new_hasher(algorithm)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(str(path), 'rb', buffering=0) as opened_file:
+        while True:
+            n_read = opened_file.readinto(buffer)
+            if not n_read:
+                break
+            hasher.update(view[:n_read])
+    return hasher.hexdigest()
+
+
+class FileHashCache(object):
+    """A persistent cache of file hashes keyed by the path, algorithm and the (size, mtime,
+    inode) fingerprint of the file: unchanged files are not read again. The cache is a json
+    file, written when save() is called (hash_files does).
+    """
+
+    def __init__(self, cache_file: Union[pathlib.Path, str]):
+        """Args:
+            cache_file: The json cache file, created by save() if it does not exist.
+        """
+        self.cache_file = pathlib.Path(cache_file)
+        self.hashes = {}
+        if self.cache_file.exists():
+            try:
+                with self.cache_file.open() as opened_file:
+                    self.hashes = json.load(opened_file)
+            except ValueError:
+                warnings.warn('Ignoring the unreadable hash cache ' + str(self.cache_file))
+
+    @staticmethod
+    def key(path: Union[pathlib.Path, str], algorithm: str) -> str:
+        return algorithm + ':' + os.path.abspath(str(path))
+
+    def get(self, path: Union[pathlib.Path, str], algorithm: str, fingerprint: tuple) -> str:
+        """The cached digest, None unless the file has the fingerprint it was hashed with."""
+        entry = self.hashes.get(FileHashCache.key(path, algorithm))
+        if entry is None or tuple(entry['fingerprint']) != tuple(fingerprint):
+            return None
+        return entry['digest']
+
+    def set(self, path: Union[pathlib.Path, str], algorithm: str, fingerprint: tuple,
+            digest: str):
+        self.hashes[FileHashCache.key(path, algorithm)] = {
+            'fingerprint': list(fingerprint), 'digest': digest}
+
+    def save(self):
+        # Written aside and renamed, never a partial cache file.
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_name(
+            '.' + self.cache_file.name + '.' + str(os.getpid()) + '.tmp')
+        with tmp_file.open('w') as opened_file:
+            json.dump(self.hashes, opened_file)
+        os.replace(str(tmp_file), str(self.cache_file))
+
+
+def hash_files(
+    paths: list,
+    algorithm: str = 'md5',
+    n_threads: int = 8,
+    cache: Union[FileHashCache, pathlib.Path, str] = None,
+    buffer_size: int = hash_buffer_size
+) -> dict:
+    """Hash many files concurrently (threads), e.g. to fingerprint domain, restart and
+    forcing files. With a cache, only new or changed files are read.
+    Args:
+        paths: The files.
+        algorithm: See hash_file.
+        n_threads: The number of files hashed at a time.
+        cache: A FileHashCache or its file.
+        buffer_size: The read size in bytes.
+    Returns:
+        A dictionary of the digests, by (str) path.
+    """
+    if cache is not None and not isinstance(cache, FileHashCache):
+        cache = FileHashCache(cache)
+
+    paths = [str(path) for path in paths]
+    digests = {}
+    fingerprints = {}
+    for path in paths:
+        fingerprints[path] = file_fingerprint(path)
+        if cache is not None:
+            digest = cache.get(path, algorithm, fingerprints[path])
+            if digest is not None:
+                digests[path] = digest
+
+    to_hash = [path for path in paths if path not in digests]
+    if len(to_hash):
+        # The biggest first, they set the time.
+        to_hash = sorted(to_hash, key=lambda path: fingerprints[path][0], reverse=True)
+        with ThreadPoolExecutor(n_threads) as executor:
+            new_digests = executor.map(
+                functools.partial(hash_file, algorithm=algorithm, buffer_size=buffer_size),
+                to_hash)
+            digests.update(zip(to_hash, new_digests))
+        if cache is not None:
+            for path in to_hash:
+                cache.set(path, algorithm, fingerprints[path], digests[path])
+            cache.save()
+
+    return {path: digests[path] for path in paths}
 
 
 def md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_file(fname, 'md5')
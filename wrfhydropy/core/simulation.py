@@ -8,13 +8,14 @@ from typing import Union
 import warnings
 import xarray
 
-from .collection import open_whp_dataset
+from .collection import CollectionCache, CollectionSession, open_whp_dataset
 
 from .domain import Domain
 from .ioutils import WrfHydroStatic, \
     WrfHydroTs, \
     check_input_files, \
     check_file_nans, \
+    InputFileCache, \
     sort_files_by_time
 from .job import Job
 from .model import Model
@@ -71,7 +72,8 @@ class Simulation(object):
         self,
         symlink_domain: bool = True,
         force: bool = False,
-        check_nlst_warn: bool = False
+        check_nlst_warn: bool = False,
+        file_cache: InputFileCache = None
     ):
         """Compose simulation directories and files
         Args:
@@ -80,6 +82,8 @@ class Simulation(object):
             is necessary in certain circumstances.
             check_nlst_warn: Allow the namelist checking/validation to only result in warnings.
             This is also not great practice, but necessary in certain circumstances.
+            file_cache: An InputFileCache for validating the job input files, shared by the
+            members and casts of ensembles and cycles.
         """
 
         print("Composing simulation into directory:'" + os.getcwd() + "'")
@@ -110,7 +114,7 @@ class Simulation(object):
 
         # Validate jobs
         print('Validating job input files')
-        self._validate_jobs(check_nlst_warn=check_nlst_warn)
+        self._validate_jobs(check_nlst_warn=check_nlst_warn, file_cache=file_cache)
 
         # Compile model or copy files
         if self.model.compile_log is not None:
@@ -269,13 +273,17 @@ class Simulation(object):
 
     def _validate_jobs(
         self,
-        check_nlst_warn: bool = False
+        check_nlst_warn: bool = False,
+        file_cache: InputFileCache = None
     ):
         """Private method to check that all files are present for each job.
         Args:
             check_nlst_warn: Allow the namelist checking/validation to only result in warnings.
             This is also not great practice, but necessary in certain circumstances.
+            file_cache: An InputFileCache, by default one for the jobs.
         """
+        if file_cache is None:
+            file_cache = InputFileCache()
         counter = 0
         for job in self.jobs:
             counter += 1
@@ -290,7 +298,8 @@ class Simulation(object):
                 hydro_namelist=job.hydro_namelist,
                 sim_dir=os.getcwd(),
                 ignore_restarts=ignore_restarts,
-                check_nlst_warn=check_nlst_warn
+                check_nlst_warn=check_nlst_warn,
+                file_cache=file_cache
             )
 
     def _set_base_namelists(self):
@@ -436,12 +445,33 @@ class SimulationOutput(object):
             if key == 'ldasout':
                 self.__dict__[key] = self.__dict__[key][1:]
 
-    def open(self, name, n_cores=None):
+    def open(
+        self,
+        name,
+        n_cores=None,
+        zarr_store: Union[str, pathlib.Path] = None,
+        session: CollectionSession = None,
+        cache: Union[str, pathlib.Path, CollectionCache] = None
+    ):
+        """Open (collect) an output type in place of its file list.
+        Args:
+            name: The output type, e.g. 'channel_rt'.
+            n_cores: The number of cores for the collection.
+            zarr_store: Optional path of a zarr store to collect into, the output is then
+                lazily opened from the store. See open_whp_dataset.
+            session: Optional CollectionSession to collect on its (warm) workers.
+            cache: Optional CollectionCache (or its directory) to reuse the collection of
+                unchanged files from. See open_whp_dataset.
+        """
         if not hasattr(self, name):
             raise ValueError('Simulation output does not contain ' + name)
         the_files = self.__dict__[name]
         if isinstance(the_files, list):
-            self.__dict__[name] = open_whp_dataset(the_files)
+            if n_cores is None:
+                n_cores = 1
+            self.__dict__[name] = open_whp_dataset(
+                the_files, n_cores=n_cores, zarr_store=zarr_store, session=session,
+                cache=cache)
         elif isinstance(the_files, xarray.core.dataset.Dataset):
             print("This output appears to already be open: " + name)
         else:
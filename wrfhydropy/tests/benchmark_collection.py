@@ -0,0 +1,193 @@
+"""Collection benchmarks on synthetic wrf-hydro output.
+
+Times open_whp_dataset (by file type, core count and file chunk size), open_nwm_dataset,
+open_dart_dataset and open_ensemble_dataset on data from data/synthetic_collection_data.py,
+recording the throughput and the peak memory of the calling process and its workers. Each
+case runs in a fresh process so the peaks are its own.
+    python -m wrfhydropy.tests.benchmark_collection --out bench.json
+    python -m wrfhydropy.tests.benchmark_collection --out new.json --compare bench.json
+With --compare, cases slower or larger than the previous results by more than --tolerance
+are listed and the exit status is 1.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+from wrfhydropy.tests.data.synthetic_collection_data import \
+    make_dart_collection, make_nwm_collection, make_whp_collection, whp_file_types
+
+
+def run_case(case: dict) -> dict:
+    """Run and time one benchmark case, in its own process."""
+    from wrfhydropy.core.collection import CollectionSession, open_whp_dataset
+    from wrfhydropy.core.ioutils import \
+        open_dart_dataset, open_ensemble_dataset, open_nwm_dataset
+
+    paths = [pathlib.Path(pp) for pp in case['paths']]
+    result = {key: val for key, val in case.items() if key != 'paths'}
+    result['n_files'] = len(paths)
+    result['bytes'] = sum(pp.stat().st_size for pp in paths)
+    result['error'] = None
+
+    session = CollectionSession(case['n_cores'])
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        if case['function'] == 'open_whp_dataset':
+            ds = open_whp_dataset(
+                paths, file_chunk_size=case['file_chunk_size'], session=session)
+        else:
+            with session.scheduler():
+                if case['function'] == 'open_nwm_dataset':
+                    ds = open_nwm_dataset(paths)
+                elif case['function'] == 'open_dart_dataset':
+                    ds = open_dart_dataset(paths)
+                elif case['function'] == 'open_ensemble_dataset':
+                    ds = open_ensemble_dataset(paths)
+        ds.load()
+        result['output_bytes'] = ds.nbytes
+    except Exception:
+        result['error'] = traceback.format_exc(limit=2)
+    result['seconds'] = time.perf_counter() - start
+    result['cpu_seconds'] = time.process_time() - cpu_start
+    session.close()
+
+    result['files_per_second'] = result['n_files'] / result['seconds']
+    result['mb_per_second'] = result['bytes'] / 1e6 / result['seconds']
+    # ru_maxrss is in kilobytes on linux. The workers are children, done after close().
+    result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result['peak_rss_workers'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return result
+
+
+def benchmark_cases(
+    root: pathlib.Path,
+    layout: str,
+    n_features: int,
+    nx: int,
+    n_members: int,
+    n_casts: int,
+    n_lead_times: int,
+    n_cores_list: list,
+    file_chunk_sizes: list
+) -> list:
+    """Write the synthetic data under root and list the benchmark cases."""
+    whp_files = make_whp_collection(
+        root / layout, layout=layout, file_types=whp_file_types, n_features=n_features,
+        nx=nx, ny=nx, n_members=n_members, n_casts=n_casts, n_lead_times=n_lead_times)
+    nwm_files = make_nwm_collection(
+        root / 'nwm', n_features=n_features, n_members=n_members, n_casts=n_casts,
+        n_lead_times=n_lead_times)
+    dart_files = make_dart_collection(
+        root / 'dart', n_links=n_features, n_members=n_members, n_times=n_lead_times)
+
+    cases = []
+    for n_cores in n_cores_list:
+        for file_type, files in whp_files.items():
+            for file_chunk_size in file_chunk_sizes:
+                cases.append({
+                    'name': 'open_whp_dataset-' + layout + '-' + file_type + '-cores' +
+                            str(n_cores) + '-chunk' + str(file_chunk_size),
+                    'function': 'open_whp_dataset',
+                    'file_type': file_type,
+                    'n_cores': n_cores,
+                    'file_chunk_size': file_chunk_size,
+                    'paths': [str(ff) for ff in files]})
+        for function, files in [
+                ('open_nwm_dataset', nwm_files),
+                ('open_dart_dataset', dart_files),
+                ('open_ensemble_dataset', dart_files)]:
+            cases.append({
+                'name': function + '-cores' + str(n_cores),
+                'function': function,
+                'file_type': None,
+                'n_cores': n_cores,
+                'file_chunk_size': None,
+                'paths': [str(ff) for ff in files]})
+    return cases
+
+
+def compare_results(results: list, previous: list, tolerance: float) -> list:
+    """The cases which are slower or use more memory than before, by more than tolerance."""
+    previous = {res['name']: res for res in previous}
+    regressions = []
+    for res in results:
+        prev = previous.get(res['name'])
+        if prev is None or res['error'] is not None or prev['error'] is not None:
+            continue
+        for key in ['seconds', 'peak_rss', 'peak_rss_workers']:
+            if res[key] > prev[key] * (1 + tolerance):
+                regressions.append(
+                    res['name'] + ' ' + key + ': ' + '{:.4g}'.format(prev[key]) + ' -> ' +
+                    '{:.4g}'.format(res[key]))
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the wrfhydropy collection.')
+    parser.add_argument('--root', default=None,
+                        help='Directory for the synthetic data, a temporary one by default.')
+    parser.add_argument('--layout', default='ensemble_cycle',
+                        choices=['simulation', 'ensemble', 'cycle', 'ensemble_cycle'])
+    parser.add_argument('--n_features', type=int, default=10000)
+    parser.add_argument('--nx', type=int, default=64)
+    parser.add_argument('--n_members', type=int, default=4)
+    parser.add_argument('--n_casts', type=int, default=4)
+    parser.add_argument('--n_lead_times', type=int, default=12)
+    parser.add_argument('--n_cores', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--file_chunk_sizes', type=int, nargs='+', default=[0, 48],
+                        help='0 collects all the files at once.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per case, the fastest is kept.')
+    parser.add_argument('--out', default=None, help='JSON file for the results.')
+    parser.add_argument('--compare', default=None, help='JSON results to compare to.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = pathlib.Path(tmp_dir if args.root is None else args.root)
+        cases = benchmark_cases(
+            root, args.layout, args.n_features, args.nx, args.n_members, args.n_casts,
+            args.n_lead_times, args.n_cores,
+            [None if size == 0 else size for size in args.file_chunk_sizes])
+
+        results = []
+        spawn = multiprocessing.get_context('spawn')
+        for case in cases:
+            runs = []
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                    runs.append(executor.submit(run_case, case).result())
+            res = min(runs, key=lambda run: run['seconds'])
+            results.append(res)
+            status = 'ERROR' if res['error'] is not None else ''
+            print('{:<70} {:8.3f} s {:8.1f} files/s {:8.1f} MB peak {}'.format(
+                res['name'], res['seconds'], res['files_per_second'],
+                max(res['peak_rss'], res['peak_rss_workers']) / 1e6, status))
+            sys.stdout.flush()
+
+    if args.out is not None:
+        with open(args.out, 'w') as out_file:
+            json.dump(results, out_file, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)
+        regressions = compare_results(results, previous, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if len(regressions):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""Synthetic wrf-hydro output for collection tests and benchmarks.
+
+Writes CHRTOUT, LDASOUT, RTOUT and HYDRO_RST files (and NWM and DART style files) in the
+wrfhydropy simulation, ensemble (member_mmm), cycle (cast_YYYYMMDDHH) and ensemble cycle
+directory layouts, including the WrfHydroEns.pkl and WrfHydroCycle.pkl files the collection
+checks for. Nothing needs to be downloaded and the sizes are configurable, e.g.
+    python synthetic_collection_data.py /scratch/synth --layout ensemble_cycle \\
+        --n_features 100000 --n_members 10 --n_casts 8 --n_lead_times 24
+"""
+
+import argparse
+import datetime
+import numpy as np
+import pathlib
+import pickle
+import xarray as xr
+
+whp_layouts = ['simulation', 'ensemble', 'cycle', 'ensemble_cycle']
+whp_file_types = ['CHRTOUT', 'LDASOUT', 'RTOUT', 'HYDRO_RST']
+
+# The file name formats of the output files.
+whp_file_name_formats = {
+    'CHRTOUT': '%Y%m%d%H%M.CHRTOUT_DOMAIN1',
+    'LDASOUT': '%Y%m%d%H%M.LDASOUT_DOMAIN1',
+    'RTOUT': '%Y%m%d%H%M.RTOUT_DOMAIN1',
+    'HYDRO_RST': 'HYDRO_RST.%Y-%m-%d_%H:%M_DOMAIN1'}
+
+# The globs for collecting each file type.
+whp_file_globs = {
+    'CHRTOUT': '*CHRTOUT_DOMAIN1',
+    'LDASOUT': '*LDASOUT_DOMAIN1',
+    'RTOUT': '*[0-9].RTOUT_DOMAIN1',
+    'HYDRO_RST': 'HYDRO_RST.*_DOMAIN1'}
+
+time_encoding = {'units': 'minutes since 1970-01-01 00:00:00', 'dtype': 'int32'}
+
+
+def write_chrtout(path, time, reference_time, n_features, rng):
+    feature_id = np.arange(1, n_features + 1, dtype='int32')
+    ds = xr.Dataset(
+        {
+            'streamflow': (('feature_id',), rng.random(n_features, dtype='float32'),
+                           {'units': 'm3 s-1', 'coordinates': 'latitude longitude'}),
+            'q_lateral': (('feature_id',), rng.random(n_features, dtype='float32'),
+                          {'units': 'm3 s-1', 'coordinates': 'latitude longitude'}),
+            'velocity': (('feature_id',), rng.random(n_features, dtype='float32'),
+                         {'units': 'm s-1', 'coordinates': 'latitude longitude'}),
+            'Head': (('feature_id',), rng.random(n_features, dtype='float32'),
+                     {'units': 'meter', 'coordinates': 'latitude longitude'}),
+            'crs': ((), np.array(b'', dtype='S1'))
+        },
+        coords={
+            'feature_id': feature_id,
+            'latitude': (('feature_id',), np.linspace(40.0, 42.0, n_features, dtype='float32')),
+            'longitude': (('feature_id',), np.linspace(-75.0, -73.0, n_features, dtype='float32')),
+            'time': [np.datetime64(time, 'ns')],
+            'reference_time': [np.datetime64(reference_time, 'ns')]
+        },
+        attrs={'featureType': 'timeSeries', 'model_output_type': 'channel_rt'}
+    )
+    ds.to_netcdf(
+        path, encoding={'time': time_encoding, 'reference_time': time_encoding})
+
+
+def write_ldasout(path, time, reference_time, nx, ny, rng):
+    ds = xr.Dataset(
+        {
+            'SOIL_M': (('time', 'y', 'soil_layers_stag', 'x'),
+                       rng.random((1, ny, 4, nx), dtype='float32')),
+            'SNEQV': (('time', 'y', 'x'), rng.random((1, ny, nx), dtype='float32')),
+            'ACCET': (('time', 'y', 'x'), rng.random((1, ny, nx), dtype='float32'))
+        },
+        coords={
+            'time': [np.datetime64(time, 'ns')],
+            'reference_time': [np.datetime64(reference_time, 'ns')],
+            'x': np.arange(nx, dtype='float64') * 1000.0,
+            'y': np.arange(ny, dtype='float64') * 1000.0
+        },
+        attrs={'model_output_type': 'land'}
+    )
+    ds.to_netcdf(
+        path, encoding={'time': time_encoding, 'reference_time': time_encoding})
+
+
+def write_rtout(path, time, reference_time, nx, ny, rng):
+    ds = xr.Dataset(
+        {
+            'zwattablrt': (('time', 'y', 'x'), rng.random((1, ny, nx), dtype='float32')),
+            'sfcheadsubrt': (('time', 'y', 'x'), rng.random((1, ny, nx), dtype='float32'))
+        },
+        coords={
+            'time': [np.datetime64(time, 'ns')],
+            'reference_time': [np.datetime64(reference_time, 'ns')],
+            'x': np.arange(nx, dtype='float64') * 250.0,
+            'y': np.arange(ny, dtype='float64') * 250.0
+        },
+        attrs={'model_output_type': 'terrain_rt'}
+    )
+    ds.to_netcdf(
+        path, encoding={'time': time_encoding, 'reference_time': time_encoding})
+
+
+def write_hydro_rst(path, time, n_features, nx, ny, rng):
+    ds = xr.Dataset(
+        {
+            'qlink1': (('links',), rng.random(n_features, dtype='float32')),
+            'qlink2': (('links',), rng.random(n_features, dtype='float32')),
+            'resht': (('lakes',), rng.random(2, dtype='float32')),
+            'sfcheadsubrt': (('iy', 'ix'), rng.random((ny, nx), dtype='float32'))
+        },
+        attrs={'Restart_Time': time.strftime('%Y-%m-%d_%H:%M:%S')}
+    )
+    ds.to_netcdf(path)
+
+
+def write_sentinel(path):
+    # The collection only checks that these exist.
+    with open(str(path), 'wb') as sentinel:
+        pickle.dump({'synthetic': True}, sentinel)
+
+
+def make_whp_collection(
+    root,
+    layout: str = 'ensemble_cycle',
+    file_types: list = whp_file_types,
+    n_features: int = 100,
+    nx: int = 16,
+    ny: int = 16,
+    n_members: int = 3,
+    n_casts: int = 2,
+    n_lead_times: int = 6,
+    start_time: datetime.datetime = datetime.datetime(2011, 8, 26),
+    cast_interval: datetime.timedelta = datetime.timedelta(hours=6),
+    output_interval: datetime.timedelta = datetime.timedelta(hours=1),
+    seed: int = 0
+) -> dict:
+    """Write a synthetic collection of wrf-hydro output.
+    Args:
+        root: The directory of the simulation, ensemble or cycle (created).
+        layout: One of 'simulation', 'ensemble', 'cycle', 'ensemble_cycle'.
+        file_types: The output types to write, from 'CHRTOUT', 'LDASOUT', 'RTOUT',
+            'HYDRO_RST'.
+        n_features: The number of channel features (and restart links).
+        nx, ny: The size of the grids.
+        n_members: The number of members (ensemble layouts).
+        n_casts: The number of casts (cycle layouts).
+        n_lead_times: The number of output times per simulation (or member or cast).
+        start_time: The first reference time.
+        cast_interval: The time between the casts.
+        output_interval: The time between output files.
+        seed: The random seed of the data.
+    Returns:
+        A dict of the sorted lists of files written by file type.
+    """
+    if layout not in whp_layouts:
+        raise ValueError('layout must be one of ' + str(whp_layouts))
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    have_casts = 'cycle' in layout
+    have_members = 'ensemble' in layout
+    if not have_casts:
+        n_casts = 1
+    if not have_members:
+        n_members = 1
+    if have_casts:
+        write_sentinel(root / 'WrfHydroCycle.pkl')
+
+    files = {file_type: [] for file_type in file_types}
+    for cc in range(n_casts):
+        reference_time = start_time + cc * cast_interval
+        cast_dir = root
+        if have_casts:
+            cast_dir = root / reference_time.strftime('cast_%Y%m%d%H')
+            cast_dir.mkdir(exist_ok=True)
+        if have_members:
+            write_sentinel(cast_dir / 'WrfHydroEns.pkl')
+
+        for mm in range(n_members):
+            run_dir = cast_dir
+            if have_members:
+                run_dir = cast_dir / ('member_' + '{:03d}'.format(mm))
+                run_dir.mkdir(exist_ok=True)
+
+            for ll in range(n_lead_times):
+                time = reference_time + (ll + 1) * output_interval
+                for file_type in file_types:
+                    path = run_dir / time.strftime(whp_file_name_formats[file_type])
+                    if file_type == 'CHRTOUT':
+                        write_chrtout(path, time, reference_time, n_features, rng)
+                    elif file_type == 'LDASOUT':
+                        write_ldasout(path, time, reference_time, nx, ny, rng)
+                    elif file_type == 'RTOUT':
+                        write_rtout(path, time, reference_time, nx, ny, rng)
+                    elif file_type == 'HYDRO_RST':
+                        write_hydro_rst(path, time, n_features, nx, ny, rng)
+                    else:
+                        raise ValueError('Unknown file type: ' + file_type)
+                    files[file_type].append(path)
+
+    return {file_type: sorted(file_list) for file_type, file_list in files.items()}
+
+
+def make_nwm_collection(
+    root,
+    n_features: int = 100,
+    n_members: int = 3,
+    n_casts: int = 2,
+    n_lead_times: int = 6,
+    start_time: datetime.datetime = datetime.datetime(2011, 8, 26),
+    cast_interval: datetime.timedelta = datetime.timedelta(hours=6),
+    seed: int = 0
+) -> list:
+    """Write synthetic NWM channel_rt files, named e.g.
+    nwm.t00z.medium_range.channel_rt_1.f001.conus.nc (for open_nwm_dataset).
+    Returns:
+        The sorted list of the files.
+    """
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for cc in range(n_casts):
+        reference_time = start_time + cc * cast_interval
+        date_dir = root / reference_time.strftime('nwm.%Y%m%d')
+        date_dir.mkdir(exist_ok=True)
+        for mm in range(1, n_members + 1):
+            for ll in range(1, n_lead_times + 1):
+                time = reference_time + datetime.timedelta(hours=ll)
+                path = date_dir / (
+                    'nwm.t' + reference_time.strftime('%H') + 'z.medium_range.channel_rt_' +
+                    str(mm) + '.f' + '{:03d}'.format(ll) + '.conus.nc')
+                write_chrtout(path, time, reference_time, n_features, rng)
+                files.append(path)
+    return sorted(files)
+
+
+def make_dart_collection(
+    root,
+    n_links: int = 100,
+    n_members: int = 3,
+    n_times: int = 6,
+    start_time: datetime.datetime = datetime.datetime(2011, 8, 26),
+    output_interval: datetime.timedelta = datetime.timedelta(hours=1),
+    seed: int = 0
+) -> list:
+    """Write synthetic DART member restart files, identified by their
+    DART_file_information attribute (for open_dart_dataset and open_ensemble_dataset).
+    Returns:
+        The sorted list of the files.
+    """
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for tt in range(n_times):
+        time = start_time + tt * output_interval
+        for mm in range(1, n_members + 1):
+            ds = xr.Dataset(
+                {
+                    'qlink1': (('time', 'links'), rng.random((1, n_links), dtype='float32')),
+                    'z_gwsubbas': (('time', 'links'), rng.random((1, n_links), dtype='float32'))
+                },
+                coords={'time': [np.datetime64(time, 'ns')]},
+                attrs={'DART_file_information': 'restart for member ' + str(mm)}
+            )
+            path = root / ('restart.' + time.strftime('%Y%m%d%H') + '.' +
+                           '{:04d}'.format(mm) + '.nc')
+            ds.to_netcdf(path, encoding={'time': time_encoding})
+            files.append(path)
+    return sorted(files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic wrf-hydro output.')
+    parser.add_argument('root', help='The output directory.')
+    parser.add_argument('--layout', default='ensemble_cycle', choices=whp_layouts)
+    parser.add_argument('--file_types', nargs='+', default=whp_file_types)
+    parser.add_argument('--n_features', type=int, default=100)
+    parser.add_argument('--nx', type=int, default=16)
+    parser.add_argument('--ny', type=int, default=16)
+    parser.add_argument('--n_members', type=int, default=3)
+    parser.add_argument('--n_casts', type=int, default=2)
+    parser.add_argument('--n_lead_times', type=int, default=6)
+    args = parser.parse_args()
+    files = make_whp_collection(
+        args.root, layout=args.layout, file_types=args.file_types,
+        n_features=args.n_features, nx=args.nx, ny=args.ny, n_members=args.n_members,
+        n_casts=args.n_casts, n_lead_times=args.n_lead_times)
+    for file_type, file_list in files.items():
+        print(file_type, len(file_list))
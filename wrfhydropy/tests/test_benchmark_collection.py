@@ -0,0 +1,26 @@
+import pathlib
+
+from wrfhydropy.tests.benchmark_collection import benchmark_cases, compare_results, run_case
+
+
+def test_benchmark_collection(tmpdir):
+    cases = benchmark_cases(
+        pathlib.Path(tmpdir), layout='ensemble_cycle', n_features=5, nx=3, n_members=2,
+        n_casts=2, n_lead_times=2, n_cores_list=[1], file_chunk_sizes=[None, 3])
+    # 4 whp file types by 2 chunk sizes, nwm, dart and ensemble.
+    assert len(cases) == 11
+
+    results = []
+    for case in cases:
+        if case['function'] in ['open_whp_dataset', 'open_dart_dataset']:
+            results.append(run_case(case))
+    for result in results:
+        assert result['error'] is None
+        # members x times, and x casts for whp.
+        assert result['n_files'] == (8 if result['function'] == 'open_whp_dataset' else 4)
+        assert result['peak_rss'] > 0
+
+    previous = [dict(result) for result in results]
+    assert compare_results(results, previous, tolerance=0.25) == []
+    previous[0]['seconds'] = results[0]['seconds'] / 2
+    assert len(compare_results(results, previous, tolerance=0.25)) == 1
@@ -1,9 +1,15 @@
+import numpy as np
 import os
 import pathlib
 import pytest
 import shutil
 import xarray as xr
-from wrfhydropy import open_whp_dataset
+from wrfhydropy import \
+    CollectionCache, CollectionSession, iter_whp_dataset, open_whp_dataset
+from wrfhydropy.core.collection import \
+    export_whp_parquet, MemoryBudget, open_whp_restarts, read_whp_parquet, \
+    rechunk_whp_dataset, scan_whp_files, scan_whp_manifest
+from wrfhydropy.core.ioutils import process_rss
 from .data import collection_data_download
 
 test_dir = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))
@@ -66,6 +72,9 @@ def test_collect_simulation(
     ans = xr.open_dataset(answer_dir / ans_file)
     xr.testing.assert_equal(sim_ds, ans)
 
+    sim_ds_block = open_whp_dataset(files, n_cores=n_cores, assembly='block')
+    xr.testing.assert_equal(sim_ds_block, ans)
+
 
 # Cycle
 # Make a cycle dir and set it up from the ensemble cycle.
@@ -247,6 +256,258 @@ def test_collect_ensemble_cycle(
         files, n_cores=n_cores, file_chunk_size=file_chunk_size)
     xr.testing.assert_equal(ens_cycle_ds_chunk, ens_cycle_ds)
 
+    # Block assembly is identical to the cascaded concatenation.
+    ens_cycle_ds_block = open_whp_dataset(files, n_cores=n_cores, assembly='block')
+    xr.testing.assert_equal(ens_cycle_ds_block, ens_cycle_ds)
+
+
+# Lazy restart collection with variable and window selection.
+@pytest.mark.parametrize('file_glob', ['*/*/RESTART.*_DOMAIN1', '*/*/HYDRO_RST.*_DOMAIN1'])
+def test_collect_ensemble_cycle_restarts_lazy(file_glob):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob(file_glob))
+    ens_cycle_ds = open_whp_dataset(files, lazy_valid_time=True)
+    lazy_ds = open_whp_restarts(files)
+    assert all(var.chunks is not None for var in lazy_ds.data_vars.values())
+    xr.testing.assert_equal(lazy_ds.load(), ens_cycle_ds)
+
+    variable = list(ens_cycle_ds.data_vars)[0]
+    window = {'south_north': (0, 2), 'iy': (1, 3), 'links': (2, 5)}
+    lazy_ds = open_whp_restarts(files, variables=[variable], window=window)
+    xr.testing.assert_equal(
+        lazy_ds.load(),
+        ens_cycle_ds[[variable]].isel(
+            {dim: slice(*val) for dim, val in window.items()}, missing_dims='ignore'))
+
+
+# Incremental append to a cumulative file, resumed from its .files.pkl.
+@pytest.mark.parametrize('suffix', ['.nc', '.zarr'], ids=['append-netcdf', 'append-zarr'])
+def test_collect_ensemble_cycle_append(suffix, tmpdir):
+    if suffix == '.zarr':
+        pytest.importorskip('zarr')
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    cumulative_file = pathlib.Path(tmpdir) / ('CHRTOUT' + suffix)
+
+    # Collect the first cast, then everything: only the new casts are collected.
+    first_cast = sorted(ens_cycle_path.glob('cast_*'))[0]
+    first_files = [ff for ff in files if first_cast in ff.parents]
+    open_whp_dataset(
+        first_files, file_chunk_size=2,
+        write_cumulative_file=cumulative_file, append=True)
+    ens_cycle_ds = open_whp_dataset(
+        files, file_chunk_size=2,
+        write_cumulative_file=cumulative_file, append=True)
+    xr.testing.assert_equal(ens_cycle_ds.load(), ans)
+
+
+# Region writes into a zarr store from the workers.
+def test_collect_ensemble_cycle_zarr(tmpdir):
+    pytest.importorskip('zarr')
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    zarr_store = pathlib.Path(tmpdir) / 'CHRTOUT.zarr'
+    ens_cycle_ds = open_whp_dataset(files, n_cores=2, zarr_store=zarr_store)
+    assert ens_cycle_ds.streamflow.chunks is not None
+    xr.testing.assert_equal(ens_cycle_ds.load(), ans)
+
+
+# One cast (or member) at a time, prefetched.
+@pytest.mark.parametrize('by', ['reference_time', 'member'])
+def test_iter_ensemble_cycle(by):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    with CollectionSession(2) as session:
+        ds_list = list(iter_whp_dataset(files, by=by, session=session))
+    assert len(ds_list) == ans.sizes[by]
+    assert all(ds.sizes[by] == 1 for ds in ds_list)
+    iter_ds = xr.concat(ds_list, dim=by, data_vars='minimal', coords='minimal')
+    xr.testing.assert_equal(iter_ds.streamflow.transpose(*ans.streamflow.dims), ans.streamflow)
+
+
+# Time windows aggregated in the workers, across file chunks.
+@pytest.mark.parametrize('how', ['mean', 'max', 'min', 'sum'])
+def test_collect_ensemble_aggregate(how):
+    files = sorted(ens_dir.glob('*/*CHRTOUT_DOMAIN1'))
+    # Without the 02 and 03 hour files, their windows are missing as in resample.
+    gap_files = [ff for ff in files if ff.name[8:10] not in ['02', '03']]
+    for the_files, freq in [(files, '2h'), (gap_files, '1h')]:
+        ens_ds = open_whp_dataset(the_files)
+        ans = getattr(ens_ds.resample(time=freq), how)(keep_attrs=True)
+        for file_chunk_size in [None, 3]:
+            ens_ds_agg = open_whp_dataset(
+                the_files, aggregate={'freq': freq, 'how': how},
+                file_chunk_size=file_chunk_size)
+            for name in ['streamflow', 'Head']:
+                xr.testing.assert_allclose(
+                    ens_ds_agg[name], ans[name].transpose(*ens_ds[name].dims))
+
+
+# Long-format parquet, partitioned by date and feature bucket, and read back by gage.
+def test_export_parquet_ensemble_cycle(tmpdir):
+    pytest.importorskip('pyarrow')
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    root = pathlib.Path(tmpdir) / 'CHRTOUT.parquet'
+    with CollectionSession(2) as session:
+        n_rows = export_whp_parquet(
+            files, root, variables=['streamflow'], n_buckets=4, batch_files=5,
+            session=session)
+    assert n_rows == ans.streamflow.size
+    assert len(list(root.glob('date=*/feature_bucket=*/*.parquet'))) > 0
+
+    feature_ids = ans.feature_id.values[:2]
+    modeled = read_whp_parquet(root, ['streamflow'], feature_ids=feature_ids)
+    ans_df = ans.streamflow.sel(feature_id=feature_ids).to_dataframe().reset_index()
+    # The (valid) time is also in the parquet index, the collected cycle has lead_time.
+    index = [name for name in modeled.index.names if name in ans_df.columns]
+    modeled = modeled.reset_index().set_index(index)
+    ans_df = ans_df.set_index(index)
+    assert len(modeled) == len(ans_df)
+    assert np.allclose(
+        modeled.streamflow.sort_index().values, ans_df.streamflow.sort_index().values)
+
+
+# Feature-major copies, in one pass and through the intermediate store.
+@pytest.mark.parametrize('max_mem', ['1GB', 20000])
+def test_rechunk_ensemble_cycle(max_mem, tmpdir):
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    target_store = pathlib.Path(tmpdir) / 'CHRTOUT.zarr'
+    rechunked = rechunk_whp_dataset(
+        ans, target_store, chunks={'feature_id': 1}, max_mem=max_mem)
+    assert rechunked.streamflow.encoding['chunks'] == \
+        tuple(1 if dd == 'feature_id' else ans.sizes[dd] for dd in ans.streamflow.dims)
+    assert not pathlib.Path(str(target_store) + '.tmp').exists()
+    xr.testing.assert_equal(rechunked.load(), ans)
+
+
+# Only the requested variables (and their coordinates) are read.
+def test_collect_variables():
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    ens_cycle_ds = open_whp_dataset(files, variables=['streamflow'])
+    assert set(ens_cycle_ds.data_vars).issubset({'streamflow', 'crs'})
+    xr.testing.assert_equal(ens_cycle_ds.streamflow, ans.streamflow)
+
+
+# Feature selection by id.
+def test_collect_feature_ids():
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    feature_ids = ans.feature_id.values[[-1, 0, 2]]
+    ens_cycle_ds = open_whp_dataset(files, feature_ids=feature_ids)
+    xr.testing.assert_equal(ens_cycle_ds, ans.isel(feature_id=[0, 2, -1]))
+
+
+# The raw reader of homogeneous point outputs.
+@pytest.mark.parametrize('file_type', ['CHRTOUT', 'LAKEOUT', 'GWOUT'])
+def test_collect_raw(file_type):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*' + file_type + '_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/' + file_type + '.nc'))
+    ens_cycle_ds = open_whp_dataset(files, n_cores=2, assembly='raw')
+    xr.testing.assert_equal(ens_cycle_ds, ans)
+
+    restart_files = sorted(ens_cycle_path.glob('*/*/HYDRO_RST.*_DOMAIN1'))
+    with pytest.raises(ValueError):
+        open_whp_dataset(restart_files, assembly='raw')
+
+
+# Workers write into memory mapped arrays instead of returning their files.
+@pytest.mark.parametrize('workers', ['processes', 'threads'])
+def test_collect_memmap(workers):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    with CollectionSession(2, workers=workers) as session:
+        ens_cycle_ds = open_whp_dataset(files, session=session, transport='memmap')
+    xr.testing.assert_equal(ens_cycle_ds, ans)
+
+
+# Files are copied into the template's feature slots, so a reordered file is refused.
+@pytest.mark.parametrize('assembly', ['block', 'raw', 'memmap'])
+def test_collect_reordered_features(assembly, tmpdir):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    pkl_files = sorted(ens_cycle_path.rglob('*.pkl'))
+    links = []
+    for ff in pkl_files + files:
+        link = pathlib.Path(tmpdir).joinpath(ff.relative_to(ens_cycle_path))
+        link.parent.mkdir(parents=True, exist_ok=True)
+        link.symlink_to(ff)
+        links.append(link)
+    links = links[len(pkl_files):]
+    links[-1].unlink()
+    with xr.open_dataset(files[-1], mask_and_scale=False, decode_times=False) as ds:
+        ds.isel(feature_id=slice(None, None, -1)).to_netcdf(links[-1])
+    with pytest.raises(ValueError, match='feature_id'):
+        if assembly == 'memmap':
+            open_whp_dataset(links, n_cores=2, transport='memmap')
+        else:
+            open_whp_dataset(links, n_cores=2, assembly=assembly)
+
+    # As for the feature selection.
+    with xr.open_dataset(files[0]) as ds:
+        feature_ids = ds.feature_id.values[[0, -1]]
+    with pytest.raises(ValueError, match='feature_id ordering'):
+        if assembly == 'memmap':
+            open_whp_dataset(links, feature_ids=feature_ids, transport='memmap')
+        else:
+            open_whp_dataset(links, feature_ids=feature_ids, assembly=assembly)
+
+
+# Collections cached on disk, extended when files are added.
+def test_collect_cache(tmpdir):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    cache = CollectionCache(pathlib.Path(tmpdir) / 'cache')
+    ens_cycle_ds = open_whp_dataset(files[0:5], cache=cache)
+    xr.testing.assert_equal(ens_cycle_ds, open_whp_dataset(files[0:5]))
+    for _ in range(2):
+        ens_cycle_ds = open_whp_dataset(files, cache=cache)
+        xr.testing.assert_equal(ens_cycle_ds, ans)
+    ens_cycle_ds = open_whp_dataset(files, cache=cache, lazy_valid_time=True)
+    assert ens_cycle_ds.valid_time.chunks is not None
+    xr.testing.assert_identical(ens_cycle_ds, open_whp_dataset(files, lazy_valid_time=True))
+    assert len(cache.entries()) == 1
+    cache.max_size = 0
+    cache.evict()
+    assert len(cache.entries()) == 0
+
+
+# File chunks sized to a memory budget.
+def test_collect_memory_limit():
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    budget = MemoryBudget(0, scan_whp_files(files))
+    assert budget.file_nbytes > 0
+    # Room for about 3 files per chunk.
+    memory_limit = process_rss() + 3 * MemoryBudget.chunk_factor * budget.file_nbytes
+    ens_cycle_ds = open_whp_dataset(files, memory_limit=memory_limit)
+    xr.testing.assert_equal(ens_cycle_ds, ans)
+
+
+# Warm workers shared across calls and file chunks.
+@pytest.mark.parametrize('workers', ['processes', 'threads'])
+def test_collect_session(workers):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/*CHRTOUT_DOMAIN1'))
+    ans = xr.open_dataset(answer_dir / (version + '/ensemble_cycle/CHRTOUT.nc'))
+    with CollectionSession(n_cores=2, workers=workers) as session:
+        for file_chunk_size in [None, 5]:
+            ens_cycle_ds = open_whp_dataset(
+                files, file_chunk_size=file_chunk_size, session=session)
+            xr.testing.assert_equal(ens_cycle_ds, ans)
+    assert session._pool is None
+
 
 # Missing/bogus files.
 # Do this for ensemble cycle as that's the most complicated relationship to the missing file.
@@ -335,6 +596,11 @@ def test_collect_missing_ens_cycle(
         ens_cycle_ds_chunk['crs'] = ens_cycle_ds_chunk['crs'].astype('S8')
     xr.testing.assert_equal(ens_cycle_ds_chunk, ens_cycle_ds)
 
+    ens_cycle_ds_block = open_whp_dataset(files, n_cores=n_cores, assembly='block')
+    if 'crs' in ens_cycle_ds.variables:
+        ens_cycle_ds_block['crs'] = ens_cycle_ds_block['crs'].astype('S8')
+    xr.testing.assert_equal(ens_cycle_ds_block, ens_cycle_ds)
+
 
 # Exercise profile and chunking.
 @pytest.mark.parametrize(
@@ -454,3 +720,28 @@ def test_collect_ensemble_cycle_drop_vars(
     ens_cycle_ds_chunk = open_whp_dataset(
         files, n_cores=n_cores, drop_variables=drop_vars, file_chunk_size=1)
     xr.testing.assert_equal(ens_cycle_ds_chunk, ans)
+
+
+# Test the file manifest scan against the collected coordinates.
+@pytest.mark.parametrize(
+    ['file_glob'],
+    [('*CHRTOUT_DOMAIN1',), ('RESTART.*_DOMAIN1',), ('HYDRO_RST.*_DOMAIN1',)],
+    ids=['manifest-CHRTOUT_DOMAIN1', 'manifest-RESTART', 'manifest-HYDRO_RST']
+)
+def test_scan_whp_manifest(file_glob):
+    ens_cycle_path = test_dir.joinpath('data/collection_data/ens_ana')
+    files = sorted(ens_cycle_path.glob('*/*/' + file_glob))
+    manifest = scan_whp_manifest(ens_cycle_path, file_glob=file_glob)
+    assert manifest.path.tolist() == files
+    manifest_list = scan_whp_manifest(files)
+    assert manifest_list.equals(manifest)
+
+    ens_cycle_ds = open_whp_dataset(files)
+    assert sorted(manifest.member.unique()) == ens_cycle_ds.member.values.tolist()
+    assert manifest.reference_time.nunique() == len(ens_cycle_ds.reference_time)
+    assert manifest.lead_time.nunique() == len(ens_cycle_ds.lead_time)
+
+    # Files which do not exist are dropped.
+    miss_files = sorted(miss_ens_cycle_dir.glob('*/*/' + file_glob))
+    miss_manifest = scan_whp_manifest(miss_files)
+    assert len(miss_manifest) == len([ff for ff in miss_files if ff.exists()])
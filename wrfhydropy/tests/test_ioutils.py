@@ -1,6 +1,9 @@
 from bs4 import BeautifulSoup
 import datetime
+import hashlib
+import json
 import numpy as np
+import os
 import pandas as pd
 import pathlib
 import pytest
@@ -10,7 +13,14 @@ import warnings
 import xarray as xr
 
 from wrfhydropy.core.ioutils import \
-    open_wh_dataset, WrfHydroTs, WrfHydroStatic, check_input_files, nwm_forcing_to_ldasin
+    open_wh_dataset, WrfHydroTs, WrfHydroStatic, check_input_files, nwm_forcing_to_ldasin, \
+    feature_id_index, select_feature_index, calc_valid_time, pivot_valid_time, \
+    CollectionProfile, profile_span, open_nwm_dataset, open_dart_dataset, \
+    open_ensemble_dataset, InputFileCache, FileHashCache, file_fingerprint, hash_file, \
+    hash_files, md5
+from wrfhydropy.core.collection import open_whp_dataset, CollectionSession
+from wrfhydropy.tests.data.synthetic_collection_data import \
+    make_nwm_collection, make_dart_collection
 
 from wrfhydropy.core.namelist import JSONNamelist
 
@@ -93,6 +103,33 @@ def test_open_wh_dataset_forecast(ds_timeseries):
     # assert np.all(the_ds['var1'].values == np.array([[[1.0,2.0,3.0]]], dtype='int'))
 
 
+def test_open_wh_dataset_cube(ds_timeseries):
+    ds_paths = sorted(ds_timeseries.rglob('*.nc'))
+    the_ds = open_wh_dataset(paths=ds_paths[::-1], forecast=True, n_threads=2)
+    the_ds_chunked = open_wh_dataset(
+        paths=ds_paths[::-1], chunks={'location': 2}, forecast=True)
+    the_ds_no_forecast = open_wh_dataset(paths=ds_paths[::-1], forecast=False)
+
+    # The reference_times in file order, aligned on the union of their times. One forecast
+    # time per reference_time, the others are missing.
+    assert the_ds['var1'].dims == ('reference_time', 'time', 'location')
+    assert the_ds['var1'].shape == (3, 3, 3)
+    assert np.all(the_ds['reference_time'].values == np.sort(the_ds['reference_time'].values)[::-1])
+    assert np.all(the_ds['time'].values == np.sort(the_ds['time'].values))
+    var1 = the_ds['var1'].values
+    assert np.all(var1[[0, 1, 2], [2, 1, 0], 1:] == [2.0, 3.0])
+    assert np.isnan(var1[0, :2, :]).all()
+    xr.testing.assert_identical(the_ds_chunked.load(), the_ds)
+
+    # Without forecasts the times are in file order, repeated times are kept.
+    assert the_ds_no_forecast['var1'].shape == (1, 3, 3)
+    assert np.all(the_ds_no_forecast['time'].values == the_ds['time'].values[::-1])
+    assert np.all(the_ds_no_forecast['var1'].values[0, :, 1:] == [2.0, 3.0])
+    the_ds_repeat = open_wh_dataset(paths=ds_paths + ds_paths[:1], forecast=False)
+    assert np.all(
+        the_ds_repeat['time'].values == the_ds['time'].values[[0, 1, 2, 0]])
+
+
 def test_wrfhydrots(ds_timeseries):
     ts_obj = WrfHydroTs(list(ds_timeseries.rglob('*.nc')))
 
@@ -112,6 +149,218 @@ def test_wrfhydrostatic(ds_timeseries):
     assert type(static_obj.check_nans()) == dict
 
 
+# The nwm and dart readers are conventions of the collection engine.
+def test_open_nwm_dataset(tmpdir):
+    files = make_nwm_collection(
+        pathlib.Path(tmpdir), n_features=10, n_members=2, n_casts=2, n_lead_times=3)
+    with CollectionSession(2, workers='threads') as session:
+        with session.scheduler():
+            nwm_ds = open_nwm_dataset(files)
+            nwm_ds_block = open_nwm_dataset(files, assembly='block', spatial_indices=[1, 3])
+        nwm_ds_whp = open_whp_dataset(
+            files, convention='nwm', assembly='raw', file_chunk_size=5, session=session)
+    assert dict(nwm_ds.streamflow.sizes) == {
+        'lead_time': 3, 'member': 2, 'reference_time': 2, 'feature_id': 10}
+    assert nwm_ds.valid_time.dims == ('reference_time', 'lead_time')
+    xr.testing.assert_identical(nwm_ds_block, nwm_ds.isel(feature_id=[1, 3]))
+    xr.testing.assert_identical(nwm_ds_whp, nwm_ds)
+
+
+def test_open_dart_dataset(tmpdir):
+    files = make_dart_collection(pathlib.Path(tmpdir), n_links=10, n_members=3, n_times=4)
+    with CollectionSession(2, workers='threads') as session:
+        with session.scheduler():
+            dart_ds = open_dart_dataset(files)
+            dart_ds_block = open_dart_dataset(files, assembly='block')
+    assert dart_ds.qlink1.dims == ('time', 'member', 'links')
+    assert dart_ds.member.values.tolist() == [1, 2, 3]
+    xr.testing.assert_identical(dart_ds_block, dart_ds)
+    with pytest.raises(ValueError):
+        open_whp_dataset(files, convention='dart', assembly='raw')
+
+
+# The options which place the files before opening them read the nwm and dart keys from
+# the file headers.
+def test_collect_conventions_planned(tmpdir):
+    pytest.importorskip('zarr')
+    tmpdir = pathlib.Path(tmpdir)
+    nwm_files = make_nwm_collection(
+        tmpdir / 'nwm', n_features=10, n_members=2, n_casts=2, n_lead_times=3)
+    dart_files = make_dart_collection(tmpdir / 'dart', n_links=10, n_members=3, n_times=4)
+    with CollectionSession(2, workers='threads') as session:
+        for convention, files in [('nwm', nwm_files), ('dart', dart_files)]:
+            ans = open_whp_dataset(files, convention=convention, session=session)
+            memmap_ds = open_whp_dataset(
+                files, convention=convention, transport='memmap', session=session)
+            xr.testing.assert_equal(memmap_ds, ans)
+            zarr_ds = open_whp_dataset(
+                files, convention=convention, session=session,
+                zarr_store=tmpdir / (convention + '.zarr'))
+            xr.testing.assert_equal(zarr_ds.load(), ans)
+            append_ds = open_whp_dataset(
+                files, convention=convention, session=session, append=True,
+                write_cumulative_file=tmpdir / (convention + '.nc'), file_chunk_size=5)
+            xr.testing.assert_equal(append_ds.load(), ans)
+
+        dart_agg = open_whp_dataset(
+            dart_files, convention='dart', aggregate={'freq': '2h'}, session=session)
+        ans = open_whp_dataset(dart_files, convention='dart', session=session)
+        xr.testing.assert_allclose(dart_agg.qlink1, ans.qlink1.resample(time='2h').mean())
+        # The nwm forecasts are cycles.
+        with pytest.raises(ValueError, match='not cycles'):
+            open_whp_dataset(
+                nwm_files, convention='nwm', aggregate={'freq': '2h'}, session=session)
+
+
+@pytest.mark.parametrize('chunks', [None, {'links': 5}])
+def test_open_ensemble_dataset(chunks, tmpdir):
+    files = make_dart_collection(pathlib.Path(tmpdir), n_links=10, n_members=3, n_times=4)
+    with CollectionSession(2, workers='threads') as session:
+        with session.scheduler():
+            dart_ds = open_dart_dataset(files)
+            # The members in any order, their files in time order.
+            files_by_member = sorted(files, key=lambda path: -int(path.suffixes[-2][1:]))
+            ens_ds = open_ensemble_dataset(files_by_member, chunks=chunks)
+    assert ens_ds.member.values.tolist() == [1, 2, 3]
+    assert (ens_ds.qlink1.chunks is None) == (chunks is None)
+    xr.testing.assert_equal(ens_ds.qlink1.transpose(*dart_ds.qlink1.dims), dart_ds.qlink1)
+
+
+def test_feature_id_index(tmpdir):
+    # Unsorted feature_ids, as in the route link files.
+    ds = xr.Dataset(
+        {'streamflow': ('feature_id', np.arange(6.0))},
+        coords={'feature_id': [50, 10, 40, 20, 60, 30]})
+    file = pathlib.Path(tmpdir) / 'chrtout.nc'
+    ds.to_netcdf(file)
+
+    index = feature_id_index([file], [30, 50, 20, 50])
+    assert np.all(index['positions'] == np.array([0, 3, 5]))
+    assert np.all(index['feature_ids'] == np.array([50, 20, 30]))
+    with xr.open_dataset(file) as ds_file:
+        assert np.all(select_feature_index(ds_file, index).streamflow.values == [0, 3, 5])
+
+    with pytest.raises(ValueError):
+        feature_id_index([file], [30, 55])
+
+    # A file with a different ordering is caught.
+    file_2 = pathlib.Path(tmpdir) / 'chrtout_2.nc'
+    ds.isel(feature_id=[1, 0, 2, 3, 4, 5]).to_netcdf(file_2)
+    with xr.open_dataset(file_2) as ds_file:
+        with pytest.raises(ValueError):
+            select_feature_index(ds_file, index)
+
+
+def test_valid_time():
+    reference_time = pd.to_datetime(['1984-10-14 00:00', '1984-10-14 06:00'])
+    lead_time = pd.to_timedelta([3, 6, 9], unit='h')
+    ds = xr.Dataset(
+        {'streamflow': (('reference_time', 'lead_time', 'feature_id'),
+                        np.arange(12.0).reshape(2, 3, 2))},
+        coords={'reference_time': reference_time, 'lead_time': lead_time,
+                'feature_id': [1, 2]})
+
+    valid_time = calc_valid_time(ds)
+    assert valid_time.dims == ('reference_time', 'lead_time')
+    assert valid_time.values[1, 2] == np.datetime64('1984-10-14T15:00', 'ns')
+    lazy_valid_time = calc_valid_time(ds, lazy=True)
+    assert lazy_valid_time.chunks is not None
+    assert np.all(lazy_valid_time.values == valid_time.values)
+
+    pivoted = pivot_valid_time(ds)
+    assert pivoted.streamflow.dims == ('valid_time', 'lead_time', 'feature_id')
+    assert len(pivoted.valid_time) == 5
+    # 1984-10-14 09:00 is forecast by both casts, at lead times 9h and 3h.
+    nine = pivoted.sel(valid_time='1984-10-14 09:00')
+    np.testing.assert_array_equal(
+        nine.streamflow.values, np.array([[6.0, 7.0], [np.nan, np.nan], [4.0, 5.0]]))
+    assert nine.reference_time.values[0] == np.datetime64('1984-10-14T06:00', 'ns')
+
+
+def test_collection_profile(tmpdir):
+    profile = CollectionProfile()
+    with profile.span('scan', n_files=2):
+        pass
+    for _ in range(2):
+        with profile_span(profile, 'merge') as span:
+            span['nbytes'] = 100
+    profile.add_worker_timings([
+        {'open': (1.0, 0.5), 'preprocess': (2.0, 1.0), 'nbytes': 10, 'peak_rss': 5},
+        {'open': (1.0, 0.5), 'preprocess': (2.0, 1.0), 'nbytes': 20, 'peak_rss': 7}])
+
+    totals = profile.totals()
+    assert list(totals.keys()) == ['scan', 'merge', 'open', 'preprocess']
+    assert totals['merge']['count'] == 2
+    assert totals['merge']['nbytes'] == 200
+    assert totals['open'] == {
+        'where': 'workers', 'count': 1, 'wall': 2.0, 'cpu': 1.0, 'n_files': 2,
+        'nbytes': 30, 'rss': None, 'peak_rss': 7}
+    assert totals['preprocess']['nbytes'] is None
+    assert 'preprocess' in profile.report()
+
+    json_path = pathlib.Path(tmpdir) / 'profile.json'
+    profile.to_json(json_path)
+    assert json.loads(json_path.read_text())['totals']['scan']['n_files'] == 2
+
+    # Without a profile nothing is recorded.
+    with profile_span(None, 'scan') as span:
+        span['n_files'] = 1
+
+
+def test_input_file_cache(tmpdir):
+    tmpdir = pathlib.Path(tmpdir)
+    domain = tmpdir / 'domain/DOMAIN'
+    domain.mkdir(parents=True)
+    domain.joinpath('Fulldom.nc').touch()
+    member_dirs = [tmpdir / 'ens' / ('member_' + str(mm)) for mm in range(3)]
+    for member_dir in member_dirs:
+        member_dir.mkdir(parents=True)
+        member_dir.joinpath('DOMAIN').symlink_to(domain)
+        member_dir.joinpath('Fulldom.nc').symlink_to('DOMAIN/Fulldom.nc')
+        member_dir.joinpath('broken.nc').symlink_to(domain / 'no_such_file.nc')
+
+    file_cache = InputFileCache()
+    names = ['DOMAIN', 'DOMAIN/Fulldom.nc', 'Fulldom.nc', 'broken.nc', 'missing.nc',
+             'DOMAIN/../DOMAIN/Fulldom.nc', '../member_0/Fulldom.nc']
+    for member_dir in member_dirs:
+        for name in names:
+            assert file_cache.exists(member_dir / name) == (member_dir / name).exists()
+    # The domain directories are listed once for all the members.
+    listed = [os.path.realpath(str(dd)) for dd in [domain.parent, domain] + member_dirs]
+    assert sorted(file_cache.listings.keys()) == sorted(listed)
+
+    # Files made after their directory was listed are found.
+    member_dirs[0].joinpath('missing.nc').touch()
+    assert file_cache.exists(member_dirs[0] / 'missing.nc')
+
+
+def test_hash_files(tmpdir):
+    tmpdir = pathlib.Path(tmpdir)
+    files = []
+    for ii, size in enumerate([0, 10, 3 * 2**20 + 1]):
+        files.append(tmpdir / ('file_' + str(ii)))
+        files[-1].write_bytes(np.random.default_rng(ii).bytes(size))
+    for file in files:
+        assert md5(file) == hashlib.md5(file.read_bytes()).hexdigest()
+        assert hash_file(file, 'blake2b', buffer_size=2**20) == \
+            hashlib.blake2b(file.read_bytes()).hexdigest()
+
+    cache_file = tmpdir / 'hashes.json'
+    digests = hash_files(files, n_threads=2, cache=cache_file)
+    assert digests == {str(file): md5(file) for file in files}
+    cache = FileHashCache(cache_file)
+    assert cache.get(files[1], 'md5', file_fingerprint(files[1])) == digests[str(files[1])]
+    assert cache.get(files[1], 'blake2b', file_fingerprint(files[1])) is None
+
+    # A changed file is hashed again.
+    files[1].write_bytes(b'changed')
+    assert cache.get(files[1], 'md5', file_fingerprint(files[1])) is None
+    digests = hash_files(files, cache=cache)
+    assert digests[str(files[1])] == hashlib.md5(b'changed').hexdigest()
+    assert FileHashCache(cache_file).get(
+        files[1], 'md5', file_fingerprint(files[1])) == digests[str(files[1])]
+
+
 def test_check_input_files(domain_dir):
     hrldas_namelist = JSONNamelist(domain_dir.joinpath('hrldas_namelist_patches.json'))
     hrldas_namelist = hrldas_namelist.get_config('nwm_ana')
@@ -190,3 +439,36 @@ def test_nwm_forcing_to_ldasin(tmpdir):
             )
             ldasin_files = sorted(ldasin_dir.glob('*/*'))
             assert len(ldasin_files) == len(forcing_files)
+
+
+@pytest.mark.parametrize('link', ['symlink', 'hardlink', 'reflink', 'copy'])
+def test_nwm_forcing_to_ldasin_plan(link, tmpdir):
+    tmpdir = pathlib.Path(tmpdir)
+    forcing_dir = tmpdir / 'prod/nwm.20190101/forcing_short_range'
+    forcing_dir.mkdir(parents=True)
+    for init_hour in [0, 6]:
+        for cast_hour in [1, 2, 3]:
+            name = 'nwm.t{:02d}z.short_range.forcing.f{:03d}.conus.nc'.format(
+                init_hour, cast_hour)
+            forcing_dir.joinpath(name).write_text(name)
+    ldasin_dir = tmpdir / 'ldasin'
+
+    plan = nwm_forcing_to_ldasin(
+        tmpdir / 'prod', ldasin_dir, 'short_range', link=link, dry_run=True)
+    assert not ldasin_dir.exists()
+    assert len(plan) == 6
+    assert plan['target'][0] == ldasin_dir / '2019010100/2019010101.LDASIN_DOMAIN1'
+    assert plan['target'][5] == ldasin_dir / '2019010106/2019010109.LDASIN_DOMAIN1'
+
+    made = nwm_forcing_to_ldasin(tmpdir / 'prod', ldasin_dir, 'short_range', link=link)
+    assert made.equals(plan)
+    for source, target in zip(plan['source'], plan['target']):
+        assert target.is_symlink() == (link == 'symlink')
+        assert target.read_text() == source.read_text()
+
+    # Resuming only makes the missing targets.
+    plan['target'][2].unlink()
+    made = nwm_forcing_to_ldasin(
+        tmpdir / 'prod', ldasin_dir, 'short_range', link=link, skip_existing=True)
+    assert made['target'].tolist() == [plan['target'][2]]
+    assert sorted(ldasin_dir.glob('*/*')) == sorted(plan['target'])